@@ -9,15 +9,21 @@
 """
 from __future__ import unicode_literals
 import os
-from flask import Flask, request, render_template, redirect, url_for, g, flash
+from time import time
+from flask import Flask, request, render_template, redirect, url_for, g, \
+    flash, session
 from flask.ext.elasticsearch import FlaskElasticsearch
 from flask.ext.login import LoginManager
 from flask.ext.migrate import Migrate
-from flask.ext.misaka import Misaka
 
+from cache import AppCache, invalidate_on_commit
+from conditional import conditional
 from forms import Search_Form
-from make_searchable import make_searchable
-from models import db, Snippet, User
+from fts import FTSClient
+from make_searchable import make_searchable, CircuitBreaker
+from models import db, Snippet, User, IndexOutbox
+from rendering import HIGHLIGHT_CODE, render_markdown, rendered, excerpt, \
+    store_rendered, highlight_css, fragment_cache, cached_panel
 from views import snippet, login, user
 
 
@@ -29,9 +35,32 @@ app.config.from_object(os.environ.get('APP_SETTINGS',
 
 # Data stores related stuff
 db.init_app(app)
-es = FlaskElasticsearch(app)
+if app.config.get('SEARCH_BACKEND') == 'sqlite':
+    es = FTSClient(db)
+else:
+    es = FlaskElasticsearch(app)
 Migrate(app, db)
-make_searchable(es, Snippet)
+# Searches are only cached, and writes only wait for the changes to be
+# searchable so the cache can be invalidated, with a cache that can hold
+# anything.
+search_cache = None
+if app.config.get('SEARCH_CACHE_TYPE', 'lru') != 'null':
+    search_cache = AppCache('SEARCH_CACHE')
+# The web app talks to the search backend through a circuit breaker so that
+# a slow backend degrades searches rather than tying up every worker. The
+# management commands use es directly.
+search_client = CircuitBreaker(
+    es,
+    threshold=app.config.get('ES_BREAKER_THRESHOLD', 5),
+    reset_timeout=app.config.get('ES_BREAKER_RESET', 30),
+    timeouts={'search': app.config.get('ES_SEARCH_TIMEOUT'),
+              'msearch': app.config.get('ES_SEARCH_TIMEOUT'),
+              'bulk': app.config.get('ES_WRITE_TIMEOUT')})
+make_searchable(search_client, Snippet,
+                outbox=IndexOutbox if app.config.get('ES_OUTBOX') else None,
+                cache=search_cache)
+store_rendered(Snippet)
+invalidate_on_commit(Snippet, fragment_cache, 'snippets')
 
 
 # Login stuff
@@ -53,9 +82,12 @@ def load_user(userid):
 
 
 # Front end stuff
-Misaka(app, autolink=True, escape=True, fenced_code=True, no_html=True,
-       no_intra_emphasis=True, strikethrough=True, superscript=True,
-       safelink=True)
+app.jinja_env.filters['markdown'] = render_markdown
+app.jinja_env.filters['rendered'] = rendered
+app.jinja_env.filters['excerpt'] = excerpt
+app.jinja_env.globals['cached_panel'] = cached_panel
+# When code is highlighted on the server highlight.js isn't needed.
+app.jinja_env.globals['server_highlighting'] = HIGHLIGHT_CODE
 
 
 #-- Hooks --------------------------------------------------------------------#
@@ -63,6 +95,30 @@ Misaka(app, autolink=True, escape=True, fenced_code=True, no_html=True,
 def before_request():
     "Pre request hook"
     g.search_form = Search_Form()
+    # GET requests read from a replica, unless this client wrote recently
+    # and the replicas may not have its changes yet.
+    db_session = db.session()
+    db_session.wrote = False
+    if request.method in ('GET', 'HEAD') and \
+            session.get('_read_primary_until', 0) < time():
+        db_session.use_replica()
+    else:
+        db_session.use_primary()
+
+
+@app.after_request
+def after_request(response):
+    """Post request hook, clients that wrote read from the primary for
+       SQLALCHEMY_REPLICA_LAG seconds.
+
+       :param response: The response.
+
+       :returns: The response.
+    """
+    if app.config.get('SQLALCHEMY_REPLICAS') and db.session().wrote:
+        session['_read_primary_until'] = \
+            time() + app.config.get('SQLALCHEMY_REPLICA_LAG', 5)
+    return response
 
 
 #-- Blueprints ---------------------------------------------------------------#
@@ -95,13 +151,25 @@ def internal_error(error):
 
 #-- Views - General Pages ----------------------------------------------------#
 @app.route('/')
+@conditional(snippet.newest_validators)
 def index():
     """Index page for the all users.
 
        :returns: The rendered index template.
     """
-    results = Snippet.query.order_by(-Snippet.id).limit(10).all()
-    return render_template('index.html', results=results)
+    return snippet.render_newest()
+
+
+@app.route('/highlight.css')
+def highlight_stylesheet():
+    """Stylesheet for code highlighted on the server.
+
+       :returns: The Pygments CSS, empty if Pygments isn't installed.
+    """
+    response = app.response_class(highlight_css(), mimetype='text/css')
+    response.cache_control.public = True
+    response.cache_control.max_age = 60 * 60 * 24
+    return response
 
 
 @app.route('/search', methods=['POST'])
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+    Cache
+    ~~~~~
+    Cache backends for Snippets, configured from the app config.
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import threading
+from collections import OrderedDict
+from time import time
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from werkzeug.contrib.cache import BaseCache, NullCache, MemcachedCache, \
+    RedisCache, FileSystemCache
+
+
+# How long to keep generation numbers, as long as memcached allows.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+#-- Backends -----------------------------------------------------------------#
+class LRUCache(BaseCache):
+    """A bounded in-process cache that throws away the least recently used
+       items once it is full. Safe to share between threads.
+
+       Values are stored as they are passed in, not copied, so they must not
+       be changed once they have been added to the cache.
+    """
+    def __init__(self, threshold=500, default_timeout=300):
+        """Create a new LRUCache
+
+           :param threshold: The maximum number of items to keep.
+           :param default_timeout: The default number of seconds to keep an
+                                   item for, 0 keeps them until they are
+                                   pushed out.
+        """
+        BaseCache.__init__(self, default_timeout)
+        self._threshold = threshold
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time() + timeout if timeout else None
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._cache.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires <= time():
+                return None
+            # Move the item to the most recently used end
+            self._cache[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (self._expires(timeout), value)
+            while len(self._cache) > self._threshold:
+                self._cache.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if key in self._cache:
+                return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return True
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            expires, value = self._cache.pop(key, (None, 0))
+            value = (value or 0) + delta
+            self._cache[key] = (expires, value)
+            return value
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def create_cache(config, prefix):
+    """Create a cache backend from the config values starting with prefix.
+
+       * '<prefix>_TYPE' is one of 'lru' (the default), 'null', 'filesystem',
+         'memcached' or 'redis'.
+       * '<prefix>_SIZE' is the maximum number of items for 'lru' and
+         'filesystem' caches.
+       * '<prefix>_TIMEOUT' is the default number of seconds to keep items.
+       * '<prefix>_DIR' is the directory for a 'filesystem' cache.
+       * '<prefix>_SERVERS' is a list of 'host:port' for a 'memcached' cache,
+         only the first is used for a 'redis' cache.
+
+       :param config: The app config.
+       :param prefix: The prefix of the config values for this cache.
+
+       :returns: A werkzeug BaseCache.
+
+       :raises ValueError: If the cache type isn't known.
+    """
+    cache_type = config.get(prefix + '_TYPE', 'lru')
+    size = config.get(prefix + '_SIZE', 500)
+    timeout = config.get(prefix + '_TIMEOUT', 300)
+    servers = config.get(prefix + '_SERVERS') or ['localhost:11211']
+    key_prefix = prefix.lower() + ':'
+
+    if cache_type == 'lru':
+        return LRUCache(size, timeout)
+    elif cache_type == 'null':
+        return NullCache(timeout)
+    elif cache_type == 'filesystem':
+        return FileSystemCache(config[prefix + '_DIR'], size, timeout)
+    elif cache_type == 'memcached':
+        return MemcachedCache(servers, timeout, key_prefix)
+    elif cache_type == 'redis':
+        host, _, port = servers[0].partition(':')
+        return RedisCache(host, int(port or 6379), default_timeout=timeout,
+                          key_prefix=key_prefix)
+    raise ValueError("Unknown cache type '{}'".format(cache_type))
+
+
+#-- Main ---------------------------------------------------------------------#
+class AppCache(object):
+    """A cache that is created from the config of the current app the first
+       time it is used, so it can be set up before the app is configured.
+       All attributes are passed through to the backend, see create_cache.
+    """
+    def __init__(self, prefix):
+        """Create a new AppCache
+
+           :param prefix: The prefix of the config values for this cache.
+        """
+        self.prefix = prefix
+
+    @property
+    def backend(self):
+        caches = current_app.extensions.setdefault('caches', {})
+        if self.prefix not in caches:
+            caches[self.prefix] = create_cache(current_app.config, self.prefix)
+        return caches[self.prefix]
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+class GenerationCache(object):
+    """Base for caches whose keys include a generation number for a name,
+       like an index or a group of fragments.
+
+       The generation is bumped by invalidate, so everything cached under
+       the name is dropped at once without having to find it.
+    """
+    def __init__(self, backend):
+        """Create a new GenerationCache
+
+           :param backend: A werkzeug BaseCache to store the items in, it
+                           should be shared between processes if there is
+                           more than one.
+        """
+        self.backend = backend
+
+    @property
+    def enabled(self):
+        """False if the backend is a NullCache, so nothing is ever cached
+           and there is nothing to invalidate.
+        """
+        backend = self.backend
+        if isinstance(backend, AppCache):
+            backend = backend.backend
+        return not isinstance(backend, NullCache)
+
+    def _generation_key(self, name):
+        return 'generation:{}'.format(name)
+
+    def _new_generation(self, name):
+        # Start from the current time rather than 0 so that if the
+        # generation is ever lost items cached before it was lost can't be
+        # matched again.
+        generation = int(time() * 1000)
+        self.backend.set(self._generation_key(name), generation,
+                         timeout=GENERATION_TIMEOUT)
+        return generation
+
+    def generation(self, name):
+        """Get the current generation number for a name.
+
+           :param name: The name, like an index or a group.
+
+           :returns: The generation number.
+        """
+        generation = self.backend.get(self._generation_key(name))
+        if generation is None:
+            generation = self._new_generation(name)
+        return generation
+
+    def invalidate(self, name):
+        """Bump the generation for a name so that nothing cached under it
+           will be used again.
+
+           :param name: The name, like an index or a group.
+        """
+        if not self.backend.inc(self._generation_key(name)):
+            self._new_generation(name)
+
+
+class FragmentCache(GenerationCache):
+    """Caches rendered HTML fragments in named groups.
+
+       Every key includes the generation of its group, see GenerationCache.
+       Fragments that can't go out of date, because their key includes a
+       version, can use a group that is never invalidated.
+    """
+    def key(self, group, key):
+        """Build the cache key for a fragment.
+
+           :param group: The name of the group.
+           :param key: A string or a tuple of values that identify the
+                       fragment within the group.
+
+           :returns: A string key that includes the group generation.
+        """
+        if isinstance(key, tuple):
+            key = ':'.join(unicode(part) for part in key)
+        return 'fragment:{}:{}:{}'.format(group, self.generation(group), key)
+
+    def cached(self, group, key, render):
+        """Get a fragment from the cache, rendering and caching it if it
+           isn't there.
+
+           :param group: The name of the group.
+           :param key: The key of the fragment within the group, see key.
+           :param render: A function with no arguments that renders the
+                          fragment.
+
+           :returns: The fragment as Markup.
+        """
+        cache_key = self.key(group, key)
+        html = self.backend.get(cache_key)
+        if html is None:
+            html = unicode(render())
+            self.backend.set(cache_key, html)
+        return Markup(html)
+
+
+#-- Session Hooks ------------------------------------------------------------#
+def invalidate_fragments(session):
+    """Invalidate the fragment groups of the items changed in a session once
+       it is committed.
+
+       :param session: The SQLAlchemy session that has been committed.
+    """
+    for fragment_cache, group in session.info.pop('fragment_groups', ()):
+        fragment_cache.invalidate(group)
+
+
+def discard_fragments(session):
+    """Forget the changed fragment groups when a session is rolled back, as
+       nothing changed.
+
+       :param session: The SQLAlchemy session that has been rolled back.
+    """
+    session.info.pop('fragment_groups', None)
+
+
+def invalidate_on_commit(model, fragment_cache, group):
+    """Invalidate a group of fragments whenever items of a model are added,
+       changed or removed.
+
+       :param model: The SQLAlchemy database model.
+       :param fragment_cache: The FragmentCache with the group.
+       :param group: The name of the group to invalidate.
+    """
+    def changed(mapper, connection, target):
+        groups = object_session(target).info.setdefault('fragment_groups',
+                                                        set())
+        groups.add((fragment_cache, group))
+
+    event.listen(model, 'after_insert', changed)
+    event.listen(model, 'after_update', changed)
+    event.listen(model, 'after_delete', changed)
+
+    if not event.contains(Session, 'after_commit', invalidate_fragments):
+        event.listen(Session, 'after_commit', invalidate_fragments)
+        event.listen(Session, 'after_rollback', discard_fragments)
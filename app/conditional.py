@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    Conditional
+    ~~~~~~~~~~~
+    ETag and Last-Modified validators for pages, so clients and proxies that
+    already have the current page get a 304 without it being rendered.
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import hashlib
+import json
+from functools import wraps
+from flask import current_app, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+from models import db, Snippet
+from rendering import RENDERER_KEY
+
+
+#-- Helpers ------------------------------------------------------------------#
+def page_etag(*parts):
+    """Get a strong ETag for a page from the values it is built from.
+
+       :param *parts: JSON serialisable values that change whenever the page
+                      does.
+
+       :returns: A hex digest, which includes the renderer key so pages are
+                 revalidated when the markdown options change.
+    """
+    data = json.dumps([RENDERER_KEY] + list(parts))
+    return hashlib.sha1(data).hexdigest()
+
+
+def snippet_validators(id):
+    """Get the validators for the page of a Snippet, without loading the
+       text.
+
+       :param id: The id of the Snippet.
+
+       :returns: A tuple of the ETag and the Last-Modified time, or None if
+                 there is no such Snippet so the view can 404.
+    """
+    row = db.session.query(Snippet.version, Snippet.updated_at).filter(
+        Snippet.id == id).first()
+    if row is None:
+        return None
+    version, updated_at = row
+    return page_etag('snippet', id, version), updated_at
+
+
+def listing_validators(query):
+    """Get the validators for a listing page from the ids and versions of
+       the Snippets on it, so adding, editing or removing any of them
+       changes the ETag.
+
+       :param query: The query for the Snippets on the page.
+
+       :returns: A tuple of the ETag and None, as a Last-Modified time can't
+                 show that a Snippet was removed.
+    """
+    rows = query.with_entities(Snippet.id, Snippet.version).all()
+    return page_etag('listing', [list(row) for row in rows]), None
+
+
+#-- Main ---------------------------------------------------------------------#
+def conditional(get_validators):
+    """Decorator for views that answers conditional GETs.
+
+       The validators are worked out before the view is called. If the
+       request's If-None-Match or If-Modified-Since match them a 304 is sent
+       without calling the view, otherwise the view's response gets the
+       ETag, Last-Modified and a Cache-Control that lets it be stored but
+       makes clients and proxies check it is current each time.
+
+       Pages with flashed messages are never answered with a 304 and are
+       marked private, as the messages are only shown once.
+
+       :param get_validators: A function called with the arguments of the
+                              view that returns a tuple of the ETag and the
+                              Last-Modified time, which may be None. If it
+                              returns None the view is called as normal.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            validators = get_validators(*args, **kwargs)
+            if validators is None:
+                return view(*args, **kwargs)
+            etag, last_modified = validators
+
+            if '_flashes' in session:
+                response = make_response(view(*args, **kwargs))
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+                return response
+
+            if not is_resource_modified(request.environ, etag,
+                                        last_modified=last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
@@ -75,12 +75,25 @@ class Snippit_Form(Form):
     "A Form for creating or editing Snippets"
     title = StringField('Title', validators=[DataRequired()])
     text = TextAreaField('Text', validators=[DataRequired()])
+    # The version of the Snippet being edited when the form was filled in.
+    version = HiddenField()
 
 
 class Search_Form(Form):
     "A Form for Search Queries"
     query = StringField('Query', validators=[DataRequired()])
 
+    def __init__(self, *args, **kwargs):
+        # Searching only redirects to the results page so there is nothing
+        # for a CSRF token to protect. Leaving it out keeps the pages the
+        # form is on the same for every session, so they can be revalidated.
+        kwargs.setdefault('csrf_enabled', False)
+        # Searches are only ever form posts. Flask-WTF would otherwise read
+        # the whole body of JSON posts, like previews, when the form is made
+        # for every request, before the view can limit how much is read.
+        kwargs.setdefault('formdata', request.form)
+        Form.__init__(self, *args, **kwargs)
+
 
 class Confirm_Form(Form):
     "A Form for simple yes/no questions"
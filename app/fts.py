@@ -0,0 +1,577 @@
+# -*- coding: utf-8 -*-
+"""
+    FTS
+    ~~~
+    A SQLite FTS5 search backend that can be used in place of ElasticSearch.
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import json
+import re
+import time
+from markupsafe import escape
+from elasticsearch.exceptions import ConflictError, NotFoundError, \
+    TransportError
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from make_searchable import searchable_models, query_text
+from query import parse_query, split_clauses
+
+
+# Maps the fields used in es_search sorts to the columns of the FTS tables.
+SORT_COLUMNS = {'_score': 'score', 'id': 'rowid'}
+
+# The table that maps aliases to index names.
+ALIAS_TABLE = 'fts_aliases'
+
+# Markers FTS5 puts around highlighted words, they are swapped for the
+# 'pre_tags' and 'post_tags' once the rest of the fragment is escaped.
+HIGHLIGHT_MARKERS = ('\x02', '\x03')
+# FTS5 snippets are sized in tokens rather than characters.
+CHARACTERS_PER_TOKEN = 6
+MAX_SNIPPET_TOKENS = 64
+
+
+#-- Helpers ------------------------------------------------------------------#
+def match_term(clause):
+    """Turn a clause from parse_query into a FTS5 phrase.
+
+       :param clause: An (operator, words, prefix) tuple.
+
+       :returns: The quoted phrase, with ' *' after it for a prefix search.
+    """
+    operator, words, prefix = clause
+    return '"{}"{}'.format(' '.join(words), ' *' if prefix else '')
+
+
+def match_expression(query):
+    """Turn the text of a search into a FTS5 MATCH expression.
+
+       The simple_query_string operators, '+' for must, '-' for must not and
+       "phrases", become AND, NOT and FTS5 phrases, and other words are ORed
+       together like the default ElasticSearch operator, see split_clauses.
+       Each word is quoted so that the FTS5 query syntax can't be used. A
+       word ending in '*' is a prefix search.
+
+       :param query: The text of the search.
+
+       :returns: A FTS5 MATCH expression or None if there are no words.
+    """
+    must, should, must_not = split_clauses(parse_query(query))
+    if must:
+        expression = ' AND '.join(match_term(clause) for clause in must)
+    else:
+        expression = ' OR '.join(match_term(clause) for clause in should)
+    if not expression:
+        return None
+    if must_not:
+        expression = '({}) NOT ({})'.format(
+            expression, ' OR '.join(match_term(clause)
+                                    for clause in must_not))
+    return expression
+
+
+def table_prefix(index):
+    """Get the prefix of the names of the FTS tables for an index.
+
+       :param index: The name of the index.
+
+       :returns: A prefix that is safe to use in SQL.
+    """
+    return re.sub(r'[^a-z0-9_]', '_', 'fts_{}__'.format(index))
+
+
+def table_name(index, doc_type):
+    """Get the name of the FTS table for an index and doc_type.
+
+       :param index: The name of the index.
+       :param doc_type: The document type in the index.
+
+       :returns: A table name that is safe to use in SQL.
+    """
+    return table_prefix(index) + re.sub(r'[^a-z0-9]', '_', doc_type)
+
+
+def create_table(connection, table, fields):
+    """Create a FTS table.
+
+       :param connection: The SQLAlchemy connection to use.
+       :param table: The name of the table.
+       :param fields: A list of the names of the full text columns.
+    """
+    columns = ['"{}"'.format(field) for field in fields]
+    connection.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5("
+        "_source UNINDEXED, _version UNINDEXED, {}, "
+        "tokenize='porter unicode61')".format(table, ', '.join(columns)))
+
+
+def highlight_column(table, column, options):
+    """Get the SQL for the highlighted text of a column of a FTS table.
+
+       :param table: The name of the table.
+       :param column: The position of the column in the table.
+       :param options: The ElasticSearch highlight options for the field,
+                       only 'number_of_fragments' and 'fragment_size' are
+                       used and at most one fragment is returned.
+
+       :returns: A SQL expression that can only be used in a MATCH query.
+    """
+    if options.get('number_of_fragments', 5) == 0:
+        return "highlight({}, {}, '{}', '{}')".format(
+            table, column, *HIGHLIGHT_MARKERS)
+    tokens = options.get('fragment_size', 100) // CHARACTERS_PER_TOKEN
+    return "snippet({}, {}, '{}', '{}', '', {})".format(
+        table, column, HIGHLIGHT_MARKERS[0], HIGHLIGHT_MARKERS[1],
+        max(1, min(tokens, MAX_SNIPPET_TOKENS)))
+
+
+def highlight_fragments(highlight, field, fragment, source):
+    """Turn highlighted text from FTS5 into ElasticSearch fragments.
+
+       :param highlight: The 'highlight' of the search body.
+       :param field: The name of the highlighted field.
+       :param fragment: The text from highlight_column, or None.
+       :param source: The source document of the hit.
+
+       :returns: A list of fragments, empty if the field didn't match and
+                 there is no 'no_match_size'.
+    """
+    options = highlight['fields'][field] or {}
+    if not fragment or HIGHLIGHT_MARKERS[0] not in fragment:
+        no_match_size = options.get('no_match_size')
+        fragment = (source.get(field) or '')[:no_match_size]
+        if not no_match_size or not fragment:
+            return []
+    if highlight.get('encoder') == 'html':
+        fragment = unicode(escape(fragment))
+    pre_tag = (highlight.get('pre_tags') or ['<em>'])[0]
+    post_tag = (highlight.get('post_tags') or ['</em>'])[0]
+    return [fragment.replace(HIGHLIGHT_MARKERS[0], pre_tag)
+                    .replace(HIGHLIGHT_MARKERS[1], post_tag)]
+
+
+#-- Indices ------------------------------------------------------------------#
+class FTSIndices(object):
+    """The parts of the elasticsearch-py IndicesClient used to rebuild
+       indexes. Each index is a set of FTS tables and aliases are rows in
+       ALIAS_TABLE, so switching an alias is a single transaction.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def _tables(self, connection, index):
+        prefix = table_prefix(index)
+        # Only the virtual tables, FTS5 drops its own shadow tables
+        names = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND sql LIKE 'CREATE VIRTUAL TABLE%'").fetchall()
+        return [name for (name,) in names
+                if name.startswith(prefix) and
+                '__' not in name[len(prefix):]]
+
+    def create(self, index, body=None, **kwargs):
+        """Create the FTS tables for an index, there is a full text column for
+           each 'text' or 'string' property in the mappings.
+        """
+        mappings = (body or {}).get('mappings', {})
+        with self.client.db.engine.begin() as connection:
+            for doc_type, mapping in mappings.items():
+                fields = [name for name, prop
+                          in sorted(mapping.get('properties', {}).items())
+                          if prop.get('type') in ('text', 'string')]
+                create_table(connection, table_name(index, doc_type), fields)
+        return {'acknowledged': True}
+
+    def exists(self, index, **kwargs):
+        with self.client.db.engine.begin() as connection:
+            return bool(self._tables(connection, index) or
+                        self.client._resolve(connection, index) != index)
+
+    def delete(self, index, **kwargs):
+        "Drop all the FTS tables for an index and remove any aliases to it."
+        with self.client.db.engine.begin() as connection:
+            for table in self._tables(connection, index):
+                connection.execute('DROP TABLE {}'.format(table))
+                self.client._columns.pop(table, None)
+            self.client._ensure_aliases(connection)
+            connection.execute(
+                text('DELETE FROM {} WHERE "index" = :index'.format(
+                    ALIAS_TABLE)), index=index)
+        return {'acknowledged': True}
+
+    def exists_alias(self, name, **kwargs):
+        with self.client.db.engine.begin() as connection:
+            return self.client._resolve(connection, name) != name
+
+    def get_alias(self, name, **kwargs):
+        """Get the index an alias points at.
+
+           :raises NotFoundError: If there is no alias with the name.
+        """
+        with self.client.db.engine.begin() as connection:
+            index = self.client._resolve(connection, name)
+        if index == name:
+            raise NotFoundError(404, 'alias [{}] missing'.format(name))
+        return {index: {'aliases': {name: {}}}}
+
+    def update_aliases(self, body, **kwargs):
+        """Carry out a list of alias 'add' and 'remove' actions in one
+           transaction, each alias can only point at one index.
+        """
+        with self.client.db.engine.begin() as connection:
+            self.client._ensure_aliases(connection)
+            for action in body['actions']:
+                op_type, args = action.items()[0]
+                if op_type == 'remove':
+                    sql = ('DELETE FROM {} WHERE alias = :alias '
+                           'AND "index" = :index')
+                elif op_type == 'add':
+                    sql = ('INSERT OR REPLACE INTO {} (alias, "index") '
+                           'VALUES (:alias, :index)')
+                else:
+                    raise ValueError("Unsupported action {!r}".format(action))
+                connection.execute(text(sql.format(ALIAS_TABLE)),
+                                   alias=args['alias'], index=args['index'])
+        return {'acknowledged': True}
+
+    def put_settings(self, body, index=None, **kwargs):
+        "Settings don't apply to FTS tables so this does nothing."
+        return {'acknowledged': True}
+
+    def refresh(self, index=None, **kwargs):
+        "Changes are searchable once committed so this does nothing."
+        return {'_shards': {}}
+
+
+#-- Main ---------------------------------------------------------------------#
+class FTSClient(object):
+    """A search client that stores documents in SQLite FTS5 tables in the
+       application database and answers searches ranked by bm25.
+
+       It implements the parts of the elasticsearch-py Elasticsearch client
+       used by make_searchable, es_search and the management commands, so it
+       can be passed to make_searchable in place of one. There is one FTS
+       table per index and doc_type, with a column for each of the models
+       '__es_fields__', and the document ids are used as the rowid so they
+       must be integers. Index names can also be aliases, see FTSIndices.
+    """
+    def __init__(self, db):
+        """Create a new FTSClient
+
+           :param db: The Flask-SQLAlchemy object for the database to store
+                      the FTS tables in.
+        """
+        self.db = db
+        self.indices = FTSIndices(self)
+        # The full text columns of each table that has been used, and the
+        # tables that can store external versions.
+        self._columns = {}
+        self._versioned = set()
+
+    def _ensure_aliases(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS {} (alias TEXT PRIMARY KEY, '
+            '"index" TEXT NOT NULL)'.format(ALIAS_TABLE))
+
+    def _resolve(self, connection, index):
+        """Get the name of the index an alias points to.
+
+           :returns: The index name, or the name passed in if it isn't an
+                     alias.
+        """
+        self._ensure_aliases(connection)
+        resolved = connection.execute(
+            text('SELECT "index" FROM {} WHERE alias = :alias'.format(
+                ALIAS_TABLE)), alias=index).scalar()
+        return resolved or index
+
+    def _ensure_table(self, connection, index, doc_type):
+        """Find the FTS table for an index or alias, creating it from the
+           '__es_fields__' of the model if it doesn't already exist.
+
+           :returns: The name of the table and a list of its full text
+                     columns.
+        """
+        table = table_name(self._resolve(connection, index), doc_type)
+        if table not in self._columns:
+            exists = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE name = :table"),
+                table=table).scalar()
+            if exists:
+                columns = connection.execute(
+                    'SELECT * FROM {} LIMIT 0'.format(table)).keys()
+                fields = [column for column in columns
+                          if column not in ('_source', '_version')]
+                if '_version' in columns:
+                    self._versioned.add(table)
+            else:
+                model = searchable_models.get((index, doc_type))
+                if model is None:
+                    raise NotFoundError(404, 'IndexMissingException[{}]'
+                                        .format(index))
+                fields = list(model.__es_fields__)
+                create_table(connection, table, fields)
+                self._versioned.add(table)
+            self._columns[table] = fields
+        return table, self._columns[table]
+
+    def _write(self, connection, op_type, meta, source):
+        """Carry out one index or delete operation.
+
+           :returns: The item for the bulk response.
+        """
+        index, doc_type = meta['_index'], meta['_type']
+        item = {'_index': index, '_type': doc_type, '_id': meta['_id']}
+        table, fields = self._ensure_table(connection, index, doc_type)
+        versioned = table in self._versioned
+
+        # Like ElasticSearch an external version has to be higher than the
+        # stored one, or the same for 'external_gte'.
+        version = meta.get('_version')
+        version_type = meta.get('_version_type')
+        if versioned and version_type in ('external', 'external_gte'):
+            current = connection.execute(
+                text('SELECT _version FROM {} WHERE rowid = :id'.format(
+                    table)), id=int(meta['_id'])).scalar()
+            if current is not None and (
+                    int(current) > int(version) or
+                    (int(current) == int(version) and
+                     version_type == 'external')):
+                item.update(status=409, error='VersionConflictEngineException'
+                            '[current version [{}] is higher or equal to the '
+                            'one provided [{}]]'.format(current, version))
+                return item
+
+        deleted = connection.execute(
+            text('DELETE FROM {} WHERE rowid = :id'.format(table)),
+            id=int(meta['_id'])).rowcount
+
+        if op_type == 'index':
+            values = dict(('f{}'.format(i), source.get(field) or '')
+                          for i, field in enumerate(fields))
+            columns = ['"{}"'.format(field) for field in fields]
+            params = [':f{}'.format(i) for i in range(len(fields))]
+            if versioned:
+                columns.append('_version')
+                params.append(':version')
+                values['version'] = version
+            connection.execute(
+                text('INSERT INTO {} (rowid, _source, {}) VALUES '
+                     '(:id, :source, {})'.format(table, ', '.join(columns),
+                                                 ', '.join(params))),
+                id=int(meta['_id']), source=json.dumps(source), **values)
+            item['status'] = 200 if deleted else 201
+        else:
+            item['found'] = bool(deleted)
+            item['status'] = 200 if deleted else 404
+        return item
+
+    def bulk(self, body, **kwargs):
+        """Carry out a list of 'index' and 'delete' actions in one transaction.
+
+           :param body: A list of action and document dicts as built by
+                        elasticsearch.helpers.bulk.
+
+           :returns: A response in the same format as the ElasticSearch bulk
+                     API.
+        """
+        start = time.time()
+        items = []
+        actions = iter(body)
+        try:
+            with self.db.engine.begin() as connection:
+                for action in actions:
+                    op_type, meta = action.items()[0]
+                    source = next(actions) if op_type != 'delete' else None
+                    if op_type not in ('index', 'delete'):
+                        items.append({op_type: dict(meta, status=400)})
+                        continue
+                    items.append({op_type: self._write(connection, op_type,
+                                                       meta, source)})
+        except SQLAlchemyError as e:
+            raise TransportError('N/A', unicode(e), e)
+
+        return {
+            'took': int((time.time() - start) * 1000),
+            'errors': any(not 200 <= item.values()[0]['status'] < 300
+                          for item in items),
+            'items': items,
+        }
+
+    def index(self, index, doc_type, body, id=None, **kwargs):
+        "Add or replace a single document, see bulk."
+        meta = {'_index': index, '_type': doc_type, '_id': id}
+        if 'version' in kwargs:
+            meta.update(_version=kwargs['version'],
+                        _version_type=kwargs.get('version_type', 'internal'))
+        item = self.bulk([{'index': meta}, body])['items'][0]['index']
+        if item['status'] == 409:
+            raise ConflictError(409, item['error'], item)
+        return item
+
+    def delete(self, index, doc_type, id, **kwargs):
+        """Remove a single document, see bulk.
+
+           :raises NotFoundError: If the document isn't in the index.
+        """
+        meta = {'_index': index, '_type': doc_type, '_id': id}
+        item = self.bulk([{'delete': meta}])['items'][0]['delete']
+        if not item['found']:
+            raise NotFoundError(404, 'not_found', item)
+        return item
+
+    def delete_by_query(self, index, doc_type, q='*', **kwargs):
+        "Remove all the documents from an index, only q='*' is supported."
+        if q != '*':
+            raise ValueError("Only q='*' is supported")
+        with self.db.engine.begin() as connection:
+            table, fields = self._ensure_table(connection, index, doc_type)
+            connection.execute('DELETE FROM {}'.format(table))
+        return {}
+
+    def ping(self, **kwargs):
+        "Check that the database can be used."
+        try:
+            self.db.engine.execute('SELECT 1')
+        except SQLAlchemyError:
+            return False
+        return True
+
+    def search(self, index, doc_type, body=None, **kwargs):
+        """Search an index, supports the parts of the search API used by
+           es_search and iter_index_versions: 'query' (see query_text),
+           'size', 'from', 'sort' on '_score' and 'id', 'search_after',
+           '_source' as False or a list of fields, 'version' and
+           'highlight' (see highlight_column).
+
+           The score of each hit is the negated bm25 rank so that, as with
+           ElasticSearch, higher is better.
+
+           :returns: A response in the same format as the ElasticSearch search
+                     API.
+        """
+        start = time.time()
+        body = body or {}
+        size = body.get('size', 10)
+        offset = body.get('from', 0)
+        sort = body.get('sort') or [{'_score': 'desc'}]
+
+        params = {}
+        query = query_text(body.get('query', {}))
+        highlight = body.get('highlight') or {}
+        with self.db.engine.begin() as connection:
+            table, fields = self._ensure_table(connection, index, doc_type)
+            versioned = table in self._versioned
+            version = '_version' if versioned else 'NULL'
+            highlighted = [field for field in highlight.get('fields', {})
+                           if field in fields]
+            if query is None:
+                matches = ('SELECT rowid, _source, {1} AS version, '
+                           '0.0 AS score{2} FROM {0}')
+                fragments = ['NULL'] * len(highlighted)
+            else:
+                params['match'] = match_expression(query)
+                if params['match'] is None:
+                    return self._response(start, 0, [])
+                matches = ('SELECT rowid, _source, {1} AS version, '
+                           '-bm25({0}) AS score{2} '
+                           'FROM {0} WHERE {0} MATCH :match')
+                # The _source and _version columns come before the fields
+                first = 2 if versioned else 1
+                fragments = [highlight_column(table,
+                                              fields.index(field) + first,
+                                              highlight['fields'][field])
+                             for field in highlighted]
+            total = connection.execute(
+                text('SELECT count(*) FROM ({})'.format(
+                    matches.format(table, version, ''))),
+                **params).scalar()
+            matches = matches.format(table, version, ''.join(
+                ', {} AS fragment{}'.format(fragment, i)
+                for i, fragment in enumerate(fragments)))
+
+            columns, where = [], []
+            for clause in sort:
+                field, order = clause.items()[0]
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+                columns.append((SORT_COLUMNS[field], order))
+
+            # search_after is a lexicographic comparison over the sort
+            for i, value in enumerate(body.get('search_after') or []):
+                column, order = columns[i]
+                params['after{}'.format(i)] = value
+                equal = ['{} = :after{}'.format(c, j)
+                         for j, (c, _) in enumerate(columns[:i])]
+                compare = '{} {} :after{}'.format(
+                    column, '<' if order == 'desc' else '>', i)
+                where.append('({})'.format(' AND '.join(equal + [compare])))
+
+            sql = 'SELECT * FROM ({})'.format(matches)
+            if where:
+                sql += ' WHERE ' + ' OR '.join(where)
+            sql += ' ORDER BY ' + ', '.join(
+                '{} {}'.format(column, order) for column, order in columns)
+            sql += ' LIMIT :size OFFSET :offset'
+            params.update(size=size, offset=offset)
+
+            hits = []
+            for row in connection.execute(text(sql), **params):
+                rowid, source, hit_version, score = row[:4]
+                source = json.loads(source)
+                hit = {'_index': index, '_type': doc_type,
+                       '_id': unicode(rowid), '_score': score,
+                       'sort': [score if c == 'score' else rowid
+                                for c, _ in columns]}
+                includes = body.get('_source', True)
+                if isinstance(includes, list):
+                    hit['_source'] = dict((field, source[field])
+                                          for field in includes
+                                          if field in source)
+                elif includes is not False:
+                    hit['_source'] = source
+                if body.get('version'):
+                    hit['_version'] = hit_version
+                if highlighted:
+                    hit['highlight'] = {}
+                    for field, fragment in zip(highlighted, row[4:]):
+                        found = highlight_fragments(highlight, field,
+                                                    fragment, source)
+                        if found:
+                            hit['highlight'][field] = found
+                hits.append(hit)
+
+        return self._response(start, total, hits)
+
+    def msearch(self, body, **kwargs):
+        """Carry out several searches, see search.
+
+           :param body: A list of alternating header dicts, with the 'index'
+                        and 'type', and search bodies.
+
+           :returns: A response in the same format as the ElasticSearch
+                     multi search API.
+        """
+        responses = []
+        for header, search_body in zip(body[::2], body[1::2]):
+            try:
+                responses.append(self.search(header['index'], header['type'],
+                                             body=search_body))
+            except (TransportError, ValueError) as e:
+                responses.append({'error': unicode(e),
+                                  'status': getattr(e, 'status_code', 400)})
+        return {'responses': responses}
+
+    def _response(self, start, total, hits):
+        return {
+            'took': int((time.time() - start) * 1000),
+            'timed_out': False,
+            'hits': {
+                'total': total,
+                'max_score': max([hit['_score'] for hit in hits] or [None]),
+                'hits': hits,
+            },
+        }
@@ -8,12 +8,302 @@
     :license: MIT, see LICENSE for more details.
 """
 from __future__ import unicode_literals
+import base64
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from functools import partial
 import elasticsearch
-from sqlalchemy import event
+from elasticsearch import helpers
+from sqlalchemy import event, func, inspect, and_, or_
+from sqlalchemy.orm import Session, object_session
+
+from cache import GenerationCache
+from query import parse_query, split_clauses
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# All the models that have been made searchable keyed on their index and
+# doc_type, in the order they were made searchable.
+searchable_models = OrderedDict()
+
+# Index settings used unless the model overrides them with __es_settings__,
+# and the settings used while a new index is being loaded.
+DEFAULT_INDEX_SETTINGS = {'refresh_interval': '1s', 'number_of_replicas': 1}
+LOADING_INDEX_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+# The most words of a search used by fallback_search, and the most results
+# it returns when the search isn't paginated.
+FALLBACK_MAX_TERMS = 5
+FALLBACK_MAX_RESULTS = 100
+
+# How long in seconds a PrefixIndex is used before it is reloaded from the
+# database, to pick up changes made by other processes.
+SUGGEST_MAX_AGE = 300
+
+# The sort order used for paginated searches. The id is used as a tie-breaker
+# so that every hit has a unique position to continue on from.
+DEFAULT_SORT = [{'_score': 'desc'}, {'id': 'asc'}]
+
+# The tags matched words are wrapped in by highlighting, and the number of
+# characters in each highlighted fragment. Fields without a match return
+# this many characters from their start instead.
+HIGHLIGHT_TAGS = ('<mark>', '</mark>')
+HIGHLIGHT_FRAGMENT_SIZE = 150
 
 
 #-- Helpers ------------------------------------------------------------------#
+def get_document(item):
+    """Build the document that will be stored in ElasticSearch for an item.
+
+       :param item: The SQLAlchemy database object to be indexed.
+
+       :returns: A dict of the items '__es_fields__' and their values. The id
+                 is always included so it can be sorted on.
+    """
+    data = {'id': item.id}
+    for field in item.__es_fields__:
+        data[field] = getattr(item, field)
+    return data
+
+
+def has_changes(item, fields):
+    """Check if any of the fields of an item have been changed, can be used
+       from the mapper before_update and after_update events.
+
+       Setting a field to the value it already has isn't a change.
+
+       :param item: The SQLAlchemy database object.
+       :param fields: A list of the names of the fields to check.
+
+       :returns: True if any of the fields have changed.
+    """
+    attrs = inspect(item).attrs
+    return any(attrs[field].history.has_changes() for field in fields)
+
+
+def _ignore_set(target, value, oldvalue, initiator):
+    "An attribute set listener that does nothing, see make_searchable."
+
+
+def get_version(item):
+    """Get the version of an item for external versioning.
+
+       :param item: The SQLAlchemy database object.
+
+       :returns: The value of the items '__es_version__' field or None if
+                 the model isn't versioned.
+    """
+    field = getattr(item, '__es_version__', None)
+    return getattr(item, field) if field else None
+
+
+def index_action(item, index=None):
+    """Build a bulk 'index' action for an item. If the model is versioned
+       the action uses the version as an external version.
+
+       :param item: The SQLAlchemy database object to be indexed.
+       :param index: The index to add the item to, defaults to the models
+                     '__es_index__'.
+
+       :returns: A dict in the format expected by elasticsearch.helpers.bulk
+    """
+    action = {
+        '_op_type': 'index',
+        '_index': index or item.__es_index__,
+        '_type': item.__es_doc_type__,
+        '_id': item.id,
+        '_source': get_document(item),
+    }
+    version = get_version(item)
+    if version is not None:
+        action.update(_version=version, _version_type='external')
+    return action
+
+
+def delete_action(model, item_id, version=None):
+    """Build a bulk 'delete' action for an item.
+
+       :param model: The SQLAlchemy database model of the item.
+       :param item_id: The id of the item to be removed from the index.
+       :param version: An optional external version for the delete, it has
+                       to be higher than the indexed version.
+
+       :returns: A dict in the format expected by elasticsearch.helpers.bulk
+    """
+    action = {
+        '_op_type': 'delete',
+        '_index': model.__es_index__,
+        '_type': model.__es_doc_type__,
+        '_id': item_id,
+    }
+    if version is not None:
+        action.update(_version=version, _version_type='external')
+    return action
+
+
+def query_text(query):
+    """Get the text the user searched for out of an ElasticSearch query.
+
+       Understands the 'query_string', 'simple_query_string', 'match',
+       'multi_match' and 'match_all' queries.
+
+       :param query: The 'query' part of an ElasticSearch search body.
+
+       :returns: The text searched for or None for 'match_all'.
+
+       :raises ValueError: If the query isn't one that is understood.
+    """
+    for query_type in ('query_string', 'simple_query_string', 'multi_match'):
+        if query_type in query:
+            return query[query_type]['query']
+    if 'match' in query:
+        value = query['match'].values()[0]
+        return value['query'] if isinstance(value, dict) else value
+    if not query or 'match_all' in query:
+        return None
+    raise ValueError("Unsupported query {!r}".format(query))
+
+
+def index_settings(model, loading=False):
+    """Get the settings for an index for a model.
+
+       :param model: The SQLAlchemy database model.
+       :param loading: If True use settings for quickly loading documents
+                       into a new index, with refreshes and replicas off.
+
+       :returns: A dict of index settings.
+    """
+    settings = dict(DEFAULT_INDEX_SETTINGS)
+    settings.update(getattr(model, '__es_settings__', {}))
+    if loading:
+        settings.update(LOADING_INDEX_SETTINGS)
+    return settings
+
+
+def index_definition(model, loading=False):
+    """Build the body used to create a new index for a model.
+
+       :param model: The SQLAlchemy database model.
+       :param loading: See index_settings.
+
+       :returns: A dict with the 'settings' and 'mappings' for the index.
+    """
+    return {
+        'settings': index_settings(model, loading),
+        'mappings': {model.__es_doc_type__: model.__es_mapping__},
+    }
+
+
+def new_index_name(model):
+    """Get a name for a new versioned index for a model. The models
+       '__es_index__' is used as an alias pointing at the current version.
+
+       :param model: The SQLAlchemy database model.
+
+       :returns: The name for the new index.
+    """
+    return '{}_{}'.format(model.__es_index__,
+                          datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+
+
+def swap_alias(es_client, alias, index):
+    """Point an alias at an index, and only that index, in one atomic update
+       so that searches using the alias never see a partial index.
+
+       :param es_client: A elasicsearch-py Elasticsearch object to use for the
+                         interactions with ElasticSearch.
+       :param alias: The name of the alias.
+       :param index: The name of the index to point it at.
+
+       :returns: A list of the indexes the alias used to point at.
+    """
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    old_indexes = []
+    if es_client.indices.exists_alias(name=alias):
+        old_indexes = list(es_client.indices.get_alias(name=alias).keys())
+        actions = [{'remove': {'index': old, 'alias': alias}}
+                   for old in old_indexes] + actions
+    elif es_client.indices.exists(index=alias):
+        # An index from before aliases were used has the name we need, it has
+        # to go before the alias can be added.
+        log.warning("Deleting index '%s' to replace it with an alias", alias)
+        es_client.indices.delete(index=alias)
+
+    es_client.indices.update_aliases(body={'actions': actions})
+    return [old for old in old_indexes if old != index]
+
+
+def iter_chunks(model, batch_size, query=None):
+    """Stream all the rows of a model from the database in chunks.
+
+       Uses keyset pagination on the primary key rather than OFFSET so every
+       chunk costs the same no matter how far through the table we are, and
+       only one chunk is ever held in memory at a time.
+
+       :param model: The SQLAlchemy database model to stream.
+       :param batch_size: The number of rows in each chunk.
+       :param query: An optional query to stream from, defaults to all rows of
+                     the model.
+
+       :returns: A generator of lists of at most batch_size items ordered by
+                 id.
+    """
+    if query is None:
+        query = model.query
+    query = query.order_by(model.id)
+
+    last_id = None
+    while True:
+        chunk_query = query
+        if last_id is not None:
+            chunk_query = chunk_query.filter(model.id > last_id)
+
+        chunk = chunk_query.limit(batch_size).all()
+        if not chunk:
+            return
+
+        last_id = chunk[-1].id
+        yield chunk
+
+
+def do_bulk(es_client, actions, **bulk_kwargs):
+    """Send a list of actions to ElasticSearch using the bulk API.
+
+       Failures are collected and returned rather than raised so that callers
+       working through many chunks can report on them and carry on.
+
+       :param es_client: A elasicsearch-py Elasticsearch object to use for the
+                         interactions with ElasticSearch.
+       :param actions: A list of bulk actions, see index_action.
+       :param **bulk_kwargs: The remaining kwargs are passed to the
+                             es_client.bulk function.
+
+       :returns: A tuple of the number of successful actions and a list of the
+                 errors for the failed ones.
+    """
+    success, errors = helpers.bulk(es_client, actions,
+                                   chunk_size=max(len(actions), 1),
+                                   raise_on_error=False,
+                                   raise_on_exception=False,
+                                   **bulk_kwargs)
+
+    # If a document can't be found to delete assume it has already been
+    # deleted, and a version conflict means a newer version of the document
+    # has already been indexed.
+    missing = [error for error in errors
+               if error.get('delete', {}).get('status') == 404 or
+               error.values()[0].get('status') == 409]
+    return success + len(missing), [e for e in errors if e not in missing]
+
+
 def do_index_item(es_client, item):
     """Take the passed item and add it to the index using the passed
        ElasticSearch client.
@@ -22,14 +312,16 @@ def do_index_item(es_client, item):
                          interactions with ElasticSearch.
        :param item: The SQLAlchemy database object to be indexed.
     """
-    data = {}
-    for field in item.__es_fields__:
-        data[field] = getattr(item, field)
-
+    version = get_version(item)
+    version_kwargs = {}
+    if version is not None:
+        # Allow the same version so that a document can be repaired.
+        version_kwargs = {'version': version, 'version_type': 'external_gte'}
     es_client.index(index=item.__es_index__,
                     doc_type=item.__es_doc_type__,
-                    body=data,
-                    id=item.id)
+                    body=get_document(item),
+                    id=item.id,
+                    **version_kwargs)
 
 
 def do_delete_item(es_client, model, item):
@@ -49,17 +341,626 @@ def do_delete_item(es_client, model, item):
         pass
 
 
-def es_search(cls, es_client, **search_kwargs):
+def iter_db_versions(model, batch_size=1000, query=None):
+    """Stream the id and version of every row of a model in id order without
+       loading the rows.
+
+       :param model: The SQLAlchemy database model, it must be versioned.
+       :param batch_size: The number of rows to read at a time.
+       :param query: An optional query of the model to filter the rows.
+
+       :returns: A generator of (id, version) tuples.
+    """
+    version = getattr(model, model.__es_version__)
+    if query is None:
+        query = model.query
+    query = query.with_entities(model.id, version)
+    for chunk in iter_chunks(model, batch_size, query):
+        for item_id, item_version in chunk:
+            yield item_id, item_version
+
+
+def iter_index_versions(es_client, model, batch_size=1000):
+    """Stream the id and version of every document for a model in the index
+       in id order, using search_after so it costs the same for every page.
+
+       :param es_client: A elasicsearch-py Elasticsearch object to use for the
+                         interactions with ElasticSearch.
+       :param model: The SQLAlchemy database model.
+       :param batch_size: The number of documents to fetch at a time.
+
+       :returns: A generator of (id, version) tuples.
+    """
+    body = {
+        'query': {'match_all': {}},
+        'size': batch_size,
+        'sort': [{'id': 'asc'}],
+        '_source': False,
+        'version': True,
+    }
+    while True:
+        response = es_client.search(index=model.__es_index__,
+                                    doc_type=model.__es_doc_type__,
+                                    body=body)
+        hits = response['hits']['hits']
+        for hit in hits:
+            yield int(hit['_id']), hit.get('_version')
+        if len(hits) < batch_size:
+            return
+        body['search_after'] = hits[-1]['sort']
+
+
+def diff_versions(db_versions, index_versions):
+    """Merge join two streams of (id, version) tuples, both in id order, to
+       find the items that are out of date in the index.
+
+       :param db_versions: The (id, version) tuples from the database, see
+                           iter_db_versions.
+       :param index_versions: The (id, version) tuples from the index, see
+                              iter_index_versions.
+
+       :returns: A generator of (id, db_version, index_version) tuples where
+                 the versions differ, a version is None if the id is missing
+                 from that side.
+    """
+    done = (None, None)
+    db_iter, index_iter = iter(db_versions), iter(index_versions)
+    db_item, index_item = next(db_iter, done), next(index_iter, done)
+    while db_item is not done or index_item is not done:
+        if index_item is done or (db_item is not done and
+                                  db_item[0] < index_item[0]):
+            yield db_item[0], db_item[1], None
+            db_item = next(db_iter, done)
+        elif db_item is done or index_item[0] < db_item[0]:
+            yield index_item[0], None, index_item[1]
+            index_item = next(index_iter, done)
+        else:
+            if db_item[1] != index_item[1]:
+                yield db_item[0], db_item[1], index_item[1]
+            db_item, index_item = next(db_iter, done), next(index_iter, done)
+
+
+class SearchCache(GenerationCache):
+    """Caches the responses from ElasticSearch for es_search.
+
+       Every key includes the generation of the index, which is bumped
+       whenever documents in the index change, so an edit invalidates all of
+       the cached searches for the index at once, see GenerationCache.
+
+       The hits and misses attributes count how the cache has been used by
+       this process.
+    """
+    def __init__(self, backend):
+        """Create a new SearchCache
+
+           :param backend: A werkzeug BaseCache to store the responses in,
+                           it should be shared between processes if there is
+                           more than one.
+        """
+        super(SearchCache, self).__init__(backend)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, search_kwargs):
+        """Build the cache key for a search.
+
+           :param search_kwargs: The kwargs passed to es_client.search
+
+           :returns: A string key that includes the index generation.
+        """
+        index = search_kwargs['index']
+        digest = hashlib.sha1(json.dumps(search_kwargs, sort_keys=True))
+        return 'search:{}:{}:{}'.format(index, self.generation(index),
+                                        digest.hexdigest())
+
+    def get(self, key):
+        """Get the cached response for a search.
+
+           :param key: The key of the search, see key.
+
+           :returns: The cached response or None.
+        """
+        response = self.backend.get(key)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def set(self, key, response):
+        """Cache the response for a search.
+
+           :param key: The key the search was looked up with before it was
+                       sent, so a response for a search that was running when
+                       the index was invalidated is stored under the old
+                       generation and never used.
+           :param response: The response from es_client.search
+        """
+        self.backend.set(key, response)
+
+    def stats(self):
+        """Get the number of hits and misses for this process.
+
+           :returns: A dict with 'hits' and 'misses'.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def _search_cache(model):
+    """Get the search cache of a model, if it has one that isn't a
+       NullCache.
+
+       :param model: A searchable model, or None.
+
+       :returns: A SearchCache or None.
+    """
+    cache = getattr(model, 'es_cache', None)
+    if cache is not None and cache.enabled:
+        return cache
+    return None
+
+
+def is_unavailable(error):
+    """Check if an error from ElasticSearch means it can't be used at the
+       moment, rather than that the request was wrong.
+
+       :param error: An elasticsearch TransportError.
+
+       :returns: True for connection errors, timeouts and 5xx responses.
+    """
+    status = error.status_code
+    return isinstance(error, elasticsearch.exceptions.ConnectionError) or \
+        not isinstance(status, int) or status >= 500
+
+
+class CircuitOpenError(elasticsearch.exceptions.ConnectionError):
+    "Raised instead of calling ElasticSearch while the circuit is open."
+
+
+class CircuitBreaker(object):
+    """Wraps an ElasticSearch client so that once it has failed a number of
+       times in a row calls fail straight away, rather than each one waiting
+       for a timeout. After reset_timeout seconds one call is let through to
+       test ElasticSearch, if it works calls are let through again.
+
+       Calls can also be given a default 'request_timeout' by name, and all
+       other attributes are passed through to the client. Only connection
+       errors, timeouts and 5xx responses count as failures. Safe to share
+       between threads.
+    """
+    def __init__(self, es_client, threshold=5, reset_timeout=30,
+                 timeouts=None):
+        """Create a new CircuitBreaker
+
+           :param es_client: A elasicsearch-py Elasticsearch object to wrap.
+           :param threshold: The number of failures in a row that opens the
+                             circuit.
+           :param reset_timeout: The number of seconds to wait before testing
+                                 ElasticSearch again once the circuit is open.
+           :param timeouts: A dict of client method names to the number of
+                            seconds to wait for them, e.g. {'search': 2}.
+        """
+        self.es_client = es_client
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.timeouts = timeouts or {}
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        "True if calls are currently failing without calling ElasticSearch."
+        return self.opened_at is not None and \
+            time.time() - self.opened_at < self.reset_timeout
+
+    def allow(self):
+        """Check if a call can be made.
+
+           :returns: True if the circuit is closed, or if it is time to test
+                     ElasticSearch again.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            # Hold the circuit open for everyone else while this call tests
+            # ElasticSearch.
+            self.opened_at = time.time()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                log.info("ElasticSearch is back, closing the circuit")
+            self.failures = 0
+            self.opened_at = None
+
+    def reset(self):
+        "Close the circuit and forget any failures, without a log message."
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.warning("ElasticSearch failed %s times, opening the "
+                                "circuit for %s seconds", self.failures,
+                                self.reset_timeout)
+                self.opened_at = time.time()
+
+    def call(self, name, *args, **kwargs):
+        """Call a method of the client through the circuit breaker.
+
+           :param name: The name of the client method.
+           :param *args: Passed to the method.
+           :param **kwargs: Passed to the method.
+
+           :returns: The result of the method.
+
+           :raises CircuitOpenError: If the circuit is open.
+        """
+        if not self.allow():
+            raise CircuitOpenError('N/A', 'Circuit open for {}'.format(name))
+        if self.timeouts.get(name):
+            kwargs.setdefault('request_timeout', self.timeouts[name])
+
+        try:
+            result = getattr(self.es_client, name)(*args, **kwargs)
+        except elasticsearch.exceptions.TransportError as e:
+            if is_unavailable(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self.es_client, name)
+        if not callable(attr):
+            return attr
+        return partial(self.call, name)
+
+
+class SearchResults(list):
+    """A page of search results in the order returned by ElasticSearch.
+
+       Behaves like a list with the extra attributes:
+       * 'total' the total number of hits for the query.
+       * 'next_cursor' an opaque cursor for the following page or None.
+       * 'prev_cursor' an opaque cursor for the previous page or None.
+       * 'degraded' True if ElasticSearch couldn't be used and the results
+         came from fallback_search.
+       * 'highlights' a dict of the unicode id of each result to its
+         highlighted fragments, see highlight.
+    """
+    def __init__(self, items=(), total=0, next_cursor=None, prev_cursor=None,
+                 degraded=False, highlights=None):
+        super(SearchResults, self).__init__(items)
+        self.total = total
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.degraded = degraded
+        self.highlights = highlights or {}
+
+    def highlight(self, item):
+        """Get the highlighted fragments of a result.
+
+           :param item: One of the results.
+
+           :returns: A dict of field name to a list of HTML fragments, with
+                     the matched words wrapped in HIGHLIGHT_TAGS. Empty if
+                     highlighting wasn't asked for.
+        """
+        return self.highlights.get(unicode(item.id), {})
+
+
+class SearchHit(object):
+    """A read-only search result built from the '_source' of a hit, for
+       pages that only need to list results and not load them from the
+       database.
+    """
+    def __init__(self, model, hit):
+        """Create a new SearchHit
+
+           :param model: The SQLAlchemy database model the hit is for.
+           :param hit: The hit from the ElasticSearch response.
+        """
+        source = dict(hit.get('_source', {}))
+        source.setdefault('id', hit['_id'])
+        for field in model.__es_fields__:
+            source.setdefault(field, None)
+        object.__setattr__(self, 'model', model)
+        object.__setattr__(self, '_source', source)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_source'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SearchHit is read only")
+
+    def __repr__(self):
+        """Unicode representation of the hit.
+
+           :returns: The Unicode representation of the SearchHit.
+        """
+        return u'SearchHit({0} - {1})'.format(self.model.__name__, self.id)
+
+
+def encode_cursor(sort_values):
+    """Turn the sort values of a hit into a cursor that is safe to use in a
+       URL.
+
+       :param sort_values: The 'sort' list of a hit from ElasticSearch.
+
+       :returns: An opaque string.
+    """
+    return base64.urlsafe_b64encode(json.dumps(sort_values))
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a list of sort values.
+
+       :param cursor: A cursor created by encode_cursor.
+
+       :returns: The list of sort values.
+
+       :raises ValueError: If the cursor isn't valid.
+    """
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, UnicodeError):
+        raise ValueError("Invalid cursor {!r}".format(cursor))
+    if not isinstance(sort_values, list):
+        raise ValueError("Invalid cursor {!r}".format(cursor))
+    return sort_values
+
+
+def reverse_sort(sort):
+    """Reverse the direction of a sort so we can page backwards.
+
+       :param sort: A list of ElasticSearch sort clauses like DEFAULT_SORT.
+
+       :returns: A new list with every direction flipped.
+    """
+    flip = {'asc': 'desc', 'desc': 'asc'}
+    return [dict((field, flip[order]) for field, order in clause.items())
+            for clause in sort]
+
+
+def hydrate_hits(cls, ids):
+    """Fetch the items for a list of ids from the database in the same order
+       as the ids.
+
+       :param cls: The SQLAlchemy database model of the items.
+       :param ids: A list of ids as returned by ElasticSearch.
+
+       :returns: A list of items, ids that aren't in the database are skipped.
+    """
+    if not ids:
+        return []
+
+    # We need to use the unicode of the item.id when matching since
+    # ElasticSearch returns the id a unicode string even if it is an int.
+    items = dict((unicode(item.id), item)
+                 for item in cls.query.filter(cls.id.in_(ids)).all())
+    return [items[item_id] for item_id in ids if item_id in items]
+
+
+def highlight_body(fields):
+    """Build the 'highlight' part of a search body.
+
+       The text is HTML escaped with the matched words wrapped in
+       HIGHLIGHT_TAGS, so the fragments can be put straight into a page.
+
+       :param fields: A dict of field name to the number of fragments of
+                      HIGHLIGHT_FRAGMENT_SIZE to return for it, 0 highlights
+                      the whole field as a single fragment.
+
+       :returns: A dict to use as the 'highlight' of a search body.
+    """
+    highlight_fields = {}
+    for field, fragments in fields.items():
+        highlight_fields[field] = {'number_of_fragments': fragments}
+        if fragments:
+            highlight_fields[field].update(
+                fragment_size=HIGHLIGHT_FRAGMENT_SIZE,
+                no_match_size=HIGHLIGHT_FRAGMENT_SIZE)
+    return {
+        'encoder': 'html',
+        'pre_tags': [HIGHLIGHT_TAGS[0]],
+        'post_tags': [HIGHLIGHT_TAGS[1]],
+        'fields': highlight_fields,
+    }
+
+
+def page_body(body, size, after=None, before=None):
+    """Build the search body for a page of results sorted by DEFAULT_SORT.
+
+       :param body: The search body to add the paging to, it isn't changed.
+       :param size: The number of results in each page.
+       :param after: A cursor, only return the page of results after it.
+       :param before: A cursor, only return the page of results before it.
+
+       :returns: A new search body.
+
+       :raises ValueError: If the after or before cursor isn't valid.
+    """
+    body = dict(body or {})
+    # Ask for one extra hit so we know if there is another page.
+    body['size'] = size + 1
+    body['sort'] = DEFAULT_SORT
+    if before:
+        body['sort'] = reverse_sort(DEFAULT_SORT)
+        body['search_after'] = decode_cursor(before)
+    elif after:
+        body['search_after'] = decode_cursor(after)
+    return body
+
+
+def build_results(cls, response, size=None, after=None, before=None,
+                  hydrate=None):
+    """Turn a search response into SearchResults, see es_search.
+
+       :param cls: The SQLAlchemy database model that was searched.
+       :param response: The response from ElasticSearch.
+       :param size: The page size the search was made with, see page_body.
+       :param after: The after cursor the search was made with.
+       :param before: The before cursor the search was made with.
+       :param hydrate: If the results are loaded from the database.
+
+       :returns: A SearchResults list of the results objects.
+    """
+    hits = response.get('hits', {}).get('hits', [])
+    total = response.get('hits', {}).get('total', 0)
+
+    next_cursor, prev_cursor = None, None
+    if size:
+        more = len(hits) > size
+        hits = hits[:size]
+        if before:
+            hits.reverse()
+        if hits:
+            first, last = hits[0].get('sort'), hits[-1].get('sort')
+            if more or before:
+                next_cursor = encode_cursor(last)
+            if (more and before) or after:
+                prev_cursor = encode_cursor(first)
+
+    if hydrate is None:
+        hydrate = getattr(cls, '__es_hydrate__', True)
+
+    if hydrate:
+        items = hydrate_hits(cls, [hit['_id'] for hit in hits])
+    else:
+        items = [SearchHit(cls, hit) for hit in hits]
+    highlights = dict((unicode(hit['_id']), hit['highlight'])
+                      for hit in hits if 'highlight' in hit)
+    return SearchResults(items, total, next_cursor, prev_cursor,
+                         highlights=highlights)
+
+
+def fallback_search(cls, body=None, size=None, after=None, before=None,
+                    hydrate=None):
+    """Search the database with LIKE, for when ElasticSearch can't be used.
+
+       The first FALLBACK_MAX_TERMS words and phrases of the query are
+       matched against the '__es_fallback_fields__' of the model, or the
+       '__es_fields__' if it has none, with the '+' and '-' operators
+       applied, see split_clauses. Items are returned oldest first, so there
+       is no relevance ranking. The cursors are compatible with es_search
+       with a score of 0 for every item. At most size, or
+       FALLBACK_MAX_RESULTS, items are loaded and the total isn't counted.
+
+       :param cls: The SQLAlchemy database model to search.
+       :param body: The ElasticSearch search body, see query_text for the
+                    queries that are understood.
+       :param size: The number of results in each page.
+       :param after: A cursor, only return the page of results after it.
+       :param before: A cursor, only return the page of results before it.
+       :param hydrate: If False the results are SearchHit objects, see
+                       es_search.
+
+       :returns: A SearchResults list with total None and degraded True.
+
+       :raises ValueError: If the after or before cursor isn't valid or the
+                           query isn't understood.
+    """
+    text = query_text((body or {}).get('query', {}))
+    fields = getattr(cls, '__es_fallback_fields__', cls.__es_fields__)
+    query = cls.query
+    if text is not None:
+        must, should, must_not = split_clauses(
+            parse_query(text)[:FALLBACK_MAX_TERMS])
+        if not must and not should:
+            return SearchResults(total=None, degraded=True)
+
+        def matches(clause):
+            pattern = '%{}%'.format(' '.join(clause[1]).replace('_', '\\_'))
+            # Empty fields are compared as '' so must not clauses keep them
+            return or_(*[func.coalesce(getattr(cls, field), '').like(
+                pattern, escape='\\') for field in fields])
+
+        if must:
+            condition = and_(*[matches(clause) for clause in must])
+        else:
+            condition = or_(*[matches(clause) for clause in should])
+        query = query.filter(condition,
+                             *[~matches(clause) for clause in must_not])
+
+    order = cls.id
+    if before:
+        query = query.filter(cls.id < decode_cursor(before)[-1])
+        order = cls.id.desc()
+    elif after:
+        query = query.filter(cls.id > decode_cursor(after)[-1])
+
+    items = query.order_by(order).limit((size or FALLBACK_MAX_RESULTS) +
+                                        1).all()
+
+    next_cursor, prev_cursor = None, None
+    more = len(items) > (size or FALLBACK_MAX_RESULTS)
+    items = items[:size or FALLBACK_MAX_RESULTS]
+    if before:
+        items.reverse()
+    if size and items:
+        if more or before:
+            next_cursor = encode_cursor([0, items[-1].id])
+        if (more and before) or after:
+            prev_cursor = encode_cursor([0, items[0].id])
+
+    if hydrate is None:
+        hydrate = getattr(cls, '__es_hydrate__', True)
+    if not hydrate:
+        items = [SearchHit(cls, {'_id': item.id,
+                                 '_source': get_document(item)})
+                 for item in items]
+    return SearchResults(items, None, next_cursor, prev_cursor, True)
+
+
+def es_search(cls, es_client, size=None, after=None, before=None,
+              hydrate=None, highlight=None, **search_kwargs):
     """Search in ElasticSearch for this item.
 
+       If a size is given the results are paginated with 'search_after',
+       sorted by DEFAULT_SORT, and the cursors on the results can be passed
+       back in as after or before to get the next or previous page. This
+       costs the same no matter how deep the page is.
+
        :param es_client: The ElasticSearch client that we want to use for
                          searching.
+       :param size: The number of results in each page.
+       :param after: A cursor, only return the page of results after it.
+       :param before: A cursor, only return the page of results before it.
+       :param hydrate: If True the results are loaded from the database, if
+                       False they are SearchHit objects built from the
+                       '_source' of each hit without touching the database.
+                       Defaults to cls.__es_hydrate__ or True if it isn't
+                       set.
+       :param highlight: An optional dict of field name to number of
+                         fragments, see highlight_body. The fragments are
+                         returned by SearchResults.highlight, so a page of
+                         results doesn't need the whole of each field.
        :param **search_kwargs: The remaining kwargs are passed to the
                                es_clinet.search function. The index is always
                                set to cls.__es_index__ and the doc_type is set
                                to cls.__es_doc_type__.
 
-       :returns: A list of the results objects
+       If ElasticSearch can't be reached, answers with a 5xx error, or the
+       circuit breaker around it is open, the results come from
+       fallback_search instead.
+
+       :returns: A SearchResults list of the results objects
+
+       :raises ValueError: If the after or before cursor isn't valid.
     """
     DEFAULTS = {
         'index': cls.__es_index__,
@@ -69,29 +970,386 @@ def es_search(cls, es_client, **search_kwargs):
     # Overwrite with the fixed values
     search_kwargs.update(DEFAULTS)
 
+    if size:
+        search_kwargs['body'] = page_body(search_kwargs.get('body'), size,
+                                          after, before)
+    if highlight:
+        search_kwargs['body'] = dict(search_kwargs.get('body') or {},
+                                     highlight=highlight_body(highlight))
+
     # Get our ordered results from ES
-    es_results = es_client.search(**search_kwargs)
-    hits = es_results.get('hits', {}).get('hits', [])
-    ids = [hit['_id'] for hit in hits]
+    cache = _search_cache(cls)
+    cache_key = cache.key(search_kwargs) if cache else None
+    es_results = cache.get(cache_key) if cache else None
+    if es_results is None:
+        try:
+            es_results = es_client.search(**search_kwargs)
+        except elasticsearch.exceptions.TransportError as e:
+            if not is_unavailable(e):
+                raise
+            log.warning("Search failed, falling back to the database: %s", e)
+            return fallback_search(cls, search_kwargs.get('body'), size,
+                                   after, before, hydrate)
+        # Partial results from a search that hit its timeout or
+        # terminate_after aren't cached.
+        if cache and not (es_results.get('timed_out') or
+                          es_results.get('terminated_early')):
+            cache.set(cache_key, es_results)
+    return build_results(cls, es_results, size, after, before, hydrate)
 
-    # Bail out early if we got no ids back
-    if not ids:
-        return []
 
-    # Fetch all the results from the database then order them to match the
-    # resutls that we got from ElasticSearch
-    #
-    # We need to use the unicode of the item.id when searching since
-    # ElasticSearch returns the id a unicode string even if it is an int.
-    results = list(cls.query.filter(cls.id.in_(ids)).all())
+def multi_search(es_client, body, models=None, size=10, hydrate=None):
+    """Search several searchable models with the same query in a single
+       msearch request, so it costs one round trip to ElasticSearch no
+       matter how many models are searched.
+
+       :param es_client: The ElasticSearch client that we want to use for
+                         searching.
+       :param body: The search body used for every model.
+       :param models: A list of the models to search, defaults to all of the
+                      models that have been made searchable.
+       :param size: The number of results for each model, the first page of
+                    the results for es_search with the same size.
+       :param hydrate: See es_search, defaults to the '__es_hydrate__' of
+                       each model.
 
-    results.sort(key=lambda item: ids.index(unicode(item.id)))
+       :returns: An OrderedDict of model to SearchResults in the order of
+                 models. A model whose search fails has empty results.
+    """
+    if models is None:
+        models = searchable_models.values()
+    models = list(models)
+    if not models:
+        return OrderedDict()
+
+    search_body = page_body(body, size)
+    request = []
+    for model in models:
+        request.append({'index': model.__es_index__,
+                        'type': model.__es_doc_type__})
+        request.append(search_body)
 
+    try:
+        responses = es_client.msearch(body=request)['responses']
+    except elasticsearch.exceptions.TransportError as e:
+        if not is_unavailable(e):
+            raise
+        log.warning("Search failed, falling back to the database: %s", e)
+        return OrderedDict((model, fallback_search(model, search_body, size,
+                                                   hydrate=hydrate))
+                           for model in models)
+
+    results = OrderedDict()
+    for model, response in zip(models, responses):
+        if 'error' in response:
+            log.error("Search of %s failed: %s", model.__es_index__,
+                      response['error'])
+            results[model] = SearchResults()
+        else:
+            results[model] = build_results(model, response, size,
+                                           hydrate=hydrate)
     return results
 
 
+#-- Typeahead ----------------------------------------------------------------#
+class PrefixIndex(object):
+    """An in-memory index of one field of a model for typeahead suggestions.
+
+       The values are kept in a sorted list so a lookup is a binary search
+       for the prefix followed by a short scan. It is loaded from the
+       database the first time it is used and kept current by the session
+       hooks added by make_searchable. Changes made by other processes are
+       picked up when it is reloaded every max_age seconds, by one caller
+       while the others carry on with the values already loaded. Safe to
+       share between threads.
+    """
+    def __init__(self, model, field, max_age=SUGGEST_MAX_AGE):
+        """Create a new PrefixIndex
+
+           :param model: The SQLAlchemy database model to index.
+           :param field: The name of the field to index.
+           :param max_age: The number of seconds to use the index for before
+                           reloading it.
+        """
+        self.model = model
+        self.field = field
+        self.max_age = max_age
+        self.loaded_at = None
+        # A sorted list of (key, id) and a dict of id to (key, value)
+        self._keys = []
+        self._values = {}
+        self._lock = threading.Lock()
+        # Held while loading so only one caller loads at a time
+        self._load_lock = threading.Lock()
+
+    @staticmethod
+    def normalize(value):
+        "Get the key for a value, lower case with the whitespace collapsed."
+        return ' '.join((value or '').lower().split())
+
+    def load(self, batch_size=1000):
+        "Load all the values from the database, replacing the current ones."
+        column = getattr(self.model, self.field)
+        query = self.model.query.session.query(self.model.id, column)
+        values = {}
+        for chunk in iter_chunks(self.model, batch_size, query):
+            for item_id, value in chunk:
+                values[item_id] = (self.normalize(value), value)
+        keys = sorted((key, item_id) for item_id, (key, _) in values.items())
+
+        with self._lock:
+            self._keys, self._values = keys, values
+            self.loaded_at = time.time()
+
+    def _reload(self):
+        """Load the values if they haven't been, or reload them if they are
+           older than max_age.
+
+           Until the values are first loaded every caller waits for them.
+           After that if they are being reloaded the other callers don't wait
+           and use the values they have.
+        """
+        if self.loaded_at is None:
+            with self._load_lock:
+                if self.loaded_at is None:
+                    self.load()
+        elif time.time() - self.loaded_at >= self.max_age and \
+                self._load_lock.acquire(False):
+            try:
+                if time.time() - self.loaded_at >= self.max_age:
+                    self.load()
+            finally:
+                self._load_lock.release()
+
+    def _remove(self, item_id):
+        if item_id in self._values:
+            key = (self._values.pop(item_id)[0], item_id)
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def update(self, item_id, value):
+        """Add or replace the value for an item.
+
+           :param item_id: The id of the item.
+           :param value: The new value of the field.
+        """
+        with self._lock:
+            if self.loaded_at is None:
+                return
+            self._remove(item_id)
+            key = self.normalize(value)
+            self._values[item_id] = (key, value)
+            bisect.insort(self._keys, (key, item_id))
+
+    def remove(self, item_id):
+        """Remove an item.
+
+           :param item_id: The id of the item.
+        """
+        with self._lock:
+            self._remove(item_id)
+
+    def suggest(self, prefix, limit=10):
+        """Find the items with a value starting with prefix, ignoring case
+           and whitespace.
+
+           :param prefix: The text typed so far.
+           :param limit: The maximum number of suggestions.
+
+           :returns: A list of (id, value) tuples in value order.
+        """
+        self._reload()
+
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+
+        suggestions = []
+        with self._lock:
+            start = bisect.bisect_left(self._keys, (prefix,))
+            for key, item_id in self._keys[start:start + limit]:
+                if not key.startswith(prefix):
+                    break
+                suggestions.append((item_id, self._values[item_id][1]))
+        return suggestions
+
+
+#-- Session Hooks ------------------------------------------------------------#
+def _caches_for(actions):
+    """Find the search caches for the models the actions are for.
+
+       :param actions: A list of bulk actions.
+
+       :returns: A list of (index, SearchCache) tuples, for the caches that
+                 can hold anything.
+    """
+    caches = []
+    for key in set((action['_index'], action['_type']) for action in actions):
+        cache = _search_cache(searchable_models.get(key))
+        if cache is not None:
+            caches.append((key[0], cache))
+    return caches
+
+
+def send_actions(es_client, actions):
+    """Send actions for changed documents to ElasticSearch and invalidate any
+       cached searches for their indexes.
+
+       If any of the indexes have a cache that isn't a NullCache the request
+       waits for the next scheduled refresh, rather than forcing one, so
+       that the changes are searchable before the cache is invalidated.
+       Otherwise a search made in between could cache results from before
+       the change.
+
+       :param es_client: A elasicsearch-py Elasticsearch object to use for the
+                         interactions with ElasticSearch.
+       :param actions: A list of bulk actions.
+
+       :returns: A tuple of the number of successful actions and a list of the
+                 errors for the failed ones, see do_bulk.
+    """
+    caches = _caches_for(actions)
+    bulk_kwargs = {'refresh': 'wait_for'} if caches else {}
+    try:
+        return do_bulk(es_client, actions, **bulk_kwargs)
+    finally:
+        for index, cache in caches:
+            cache.invalidate(index)
+
+
+def get_pending(session, es_client):
+    """Get the index operations waiting for the session to be committed.
+
+       :param session: The SQLAlchemy session the changes were made in.
+       :param es_client: The ElasticSearch client the operations are for.
+
+       :returns: An OrderedDict of bulk actions keyed on index, doc_type and
+                 id, so only the last operation for each document is kept.
+    """
+    pending = session.info.setdefault('es_pending', {})
+    return pending.setdefault(es_client, OrderedDict())
+
+
+def send_pending(session):
+    """Send all of the pending operations for a session to ElasticSearch as
+       one bulk request per client. Called after the session is committed.
+
+       :param session: The SQLAlchemy session that has been committed.
+    """
+    pending = session.info.pop('es_pending', {})
+    for es_client, actions in pending.items():
+        if not actions:
+            continue
+        success, errors = send_actions(es_client, list(actions.values()))
+        for error in errors:
+            log.error("Failed to update the index: %s", error)
+
+
+def discard_pending(session):
+    """Throw away the pending operations when the session is rolled back so
+       that changes that never made it to the database aren't indexed.
+
+       :param session: The SQLAlchemy session that has been rolled back.
+    """
+    session.info.pop('es_pending', None)
+    session.info.pop('es_suggest', None)
+
+
+def apply_suggestions(session):
+    """Apply the changes made in a session to the PrefixIndexes once the
+       session is committed.
+
+       :param session: The SQLAlchemy session that has been committed.
+    """
+    for prefix_index, item_id, value in session.info.pop('es_suggest', []):
+        if value is None:
+            prefix_index.remove(item_id)
+        else:
+            prefix_index.update(item_id, value)
+
+
+#-- Outbox -------------------------------------------------------------------#
+def drain_outbox(es_client, outbox, batch_size=500, max_backoff=300):
+    """Send one batch of changes from the outbox to ElasticSearch.
+
+       The outbox only records which documents have changed, the document is
+       built from the current state of the row when the batch is sent. So
+       entries can be retried in any order and an entry for a row that no
+       longer exists becomes a delete.
+
+       Entries that are sent successfully are removed from the outbox, failed
+       entries are retried later with an exponential backoff.
+
+       :param es_client: A elasicsearch-py Elasticsearch object to use for the
+                         interactions with ElasticSearch.
+       :param outbox: The SQLAlchemy database model for the outbox.
+       :param batch_size: The maximum number of entries to send.
+       :param max_backoff: The longest time in seconds to wait before retrying
+                           a failed entry.
+
+       :returns: A tuple of the number of entries sent and the number that
+                 failed.
+    """
+    session = outbox.query.session
+    now = datetime.utcnow()
+    entries = outbox.query.filter(outbox.next_attempt <= now)\
+                          .order_by(outbox.id)\
+                          .limit(batch_size)\
+                          .all()
+    if not entries:
+        return 0, 0
+
+    # Group the entries on the document they are for, several changes to
+    # the same document only need to be sent once.
+    documents = OrderedDict()
+    for entry in entries:
+        key = (entry.index, entry.doc_type, entry.item_id)
+        documents.setdefault(key, []).append(entry)
+
+    ids = {}
+    for index, doc_type, item_id in documents:
+        ids.setdefault((index, doc_type), []).append(item_id)
+
+    actions = []
+    for (index, doc_type), item_ids in ids.items():
+        model = searchable_models[(index, doc_type)]
+        items = dict((item.id, item) for item in
+                     model.query.filter(model.id.in_(item_ids)).all())
+        for item_id in item_ids:
+            if item_id in items:
+                actions.append(index_action(items[item_id]))
+            else:
+                actions.append(delete_action(model, item_id))
+
+    success, errors = send_actions(es_client, actions)
+
+    # Errors are matched on the doc_type and id only, ElasticSearch reports
+    # the concrete index behind an alias rather than the alias that was sent.
+    failed = set()
+    for error in errors:
+        for op_type, info in error.items():
+            failed.add((info.get('_type'), int(info.get('_id'))))
+
+    retried = 0
+    for (index, doc_type, item_id), key_entries in documents.items():
+        if (doc_type, item_id) in failed:
+            retried += 1
+            for entry in key_entries:
+                entry.attempts += 1
+                delay = min(2 ** entry.attempts, max_backoff)
+                entry.next_attempt = now + timedelta(seconds=delay)
+        else:
+            for entry in key_entries:
+                session.delete(entry)
+    session.commit()
+
+    if errors:
+        log.error("Failed to send %s changes to the index, first error: %s",
+                  retried, errors[0])
+    return len(documents) - retried, retried
+
+
 #-- Main ---------------------------------------------------------------------#
-def make_searchable(es_client, model):
+def make_searchable(es_client, model, outbox=None, cache=None):
     """Take a SQLAlchemy database model and add hook to make sure it is
        added, updated and remove for the Elastic Search Models. Also adds the
        classmehod 'es_search' for simple searching.
@@ -102,19 +1360,126 @@ def make_searchable(es_client, model):
          to.
        * '__es_doc_type__' is the Docuemnt type for this model.
        * '__es_fields__' is a list of fields to be included in the index.
+       * '__es_mapping__' is the ElasticSearch mapping for the doc_type.
+
+       The model can also set '__es_settings__' to override the index
+       settings, see index_settings.
+
+       The model can also set '__es_hydrate__' to False to have es_search
+       return SearchHit objects built from the index instead of loading the
+       results from the database.
+
+       Updates are only indexed if one of the '__es_fields__' has changed.
+
+       The model can also set '__es_version__' to the name of an integer
+       field, it is incremented whenever one of the '__es_fields__' changes.
+       Documents are then indexed with it as an external version so that an
+       older change sent late can't overwrite a newer one, and the index can
+       be checked against the database, see diff_versions. The model should
+       use it as a mapper 'version_id_col' with 'version_id_generator' set to
+       False to stop concurrent changes overwriting each other.
+
+       The model can also set '__es_suggest__' to the name of a field to
+       get typeahead suggestions for, they are available from the
+       PrefixIndex model.es_suggest.
+
+       Any number of models can be made searchable, each with its own index.
+       They are all searched together by multi_search.
+
+       Changes are not sent to ElasticSearch as they are flushed, instead they
+       are collected on the session and sent as a single bulk request once the
+       session has been committed. If the session is rolled back they are
+       discarded.
+
+       If an outbox model is passed the changes are instead written to the
+       outbox in the same transaction as the change itself, and it is up to a
+       separate worker to send them to ElasticSearch, see drain_outbox.
 
        :param es_client: A elasicsearch-py Elasticsearch object to use for the
                          interactions with ElasticSearch.
        :param model: The SQLAlchemy database model to make searchable.
+       :param outbox: An optional SQLAlchemy database model to use as an
+                      outbox, see models.IndexOutbox.
+       :param cache: An optional werkzeug BaseCache to cache searches in, it
+                     is available as model.es_cache, see SearchCache.
     """
+    searchable_models[(model.__es_index__, model.__es_doc_type__)] = model
+
+    def add_to_outbox(mapper, connection, target):
+        connection.execute(outbox.__table__.insert(),
+                           index=model.__es_index__,
+                           doc_type=model.__es_doc_type__,
+                           item_id=target.id,
+                           attempts=0,
+                           next_attempt=datetime.utcnow())
+
     def index_item(mapper, connection, target):
-        do_index_item(es_client, target)
+        key = (model.__es_index__, model.__es_doc_type__, target.id)
+        pending = get_pending(object_session(target), es_client)
+        pending.pop(key, None)
+        pending[key] = index_action(target)
 
     def delete_item(mapper, connection, target):
-        do_delete_item(es_client, model, target)
+        key = (model.__es_index__, model.__es_doc_type__, target.id)
+        pending = get_pending(object_session(target), es_client)
+        pending.pop(key, None)
+        version = get_version(target)
+        pending[key] = delete_action(
+            model, target.id, version + 1 if version is not None else None)
+
+    def bump_version(mapper, connection, target):
+        field = model.__es_version__
+        setattr(target, field, (getattr(target, field) or 0) + 1)
+
+    def if_changed(hook, fields):
+        """Wrap an after_update hook so it is only called if one of the
+           fields has changed.
+        """
+        def changed_hook(mapper, connection, target):
+            if has_changes(target, fields):
+                hook(mapper, connection, target)
+        return changed_hook
+
+    def suggest_item(mapper, connection, target):
+        value = getattr(target, model.__es_suggest__)
+        suggest = object_session(target).info.setdefault('es_suggest', [])
+        suggest.append((model.es_suggest, target.id, value or ''))
+
+    def unsuggest_item(mapper, connection, target):
+        suggest = object_session(target).info.setdefault('es_suggest', [])
+        suggest.append((model.es_suggest, target.id, None))
+
+    # Updates that don't change any of the indexed fields are skipped. The
+    # fields need active history so that the old value is loaded when an
+    # expired field is set, otherwise every set looks like a change.
+    fields = model.__es_fields__
+    for field in fields:
+        event.listen(getattr(model, field), 'set', _ignore_set,
+                     active_history=True)
+    if getattr(model, '__es_version__', None):
+        event.listen(model, 'before_update', if_changed(bump_version, fields))
+
+    if outbox is not None:
+        event.listen(model, 'after_insert', add_to_outbox)
+        event.listen(model, 'after_update', if_changed(add_to_outbox, fields))
+        event.listen(model, 'after_delete', add_to_outbox)
+    else:
+        event.listen(model, 'after_insert', index_item)
+        event.listen(model, 'after_update', if_changed(index_item, fields))
+        event.listen(model, 'after_delete', delete_item)
+
+    model.es_suggest = None
+    if getattr(model, '__es_suggest__', None):
+        model.es_suggest = PrefixIndex(model, model.__es_suggest__)
+        event.listen(model, 'after_insert', suggest_item)
+        event.listen(model, 'after_update',
+                     if_changed(suggest_item, [model.__es_suggest__]))
+        event.listen(model, 'after_delete', unsuggest_item)
 
-    event.listen(model, 'after_insert', index_item)
-    event.listen(model, 'after_update', index_item)
-    event.listen(model, 'after_delete', delete_item)
+    if not event.contains(Session, 'after_commit', send_pending):
+        event.listen(Session, 'after_commit', send_pending)
+        event.listen(Session, 'after_commit', apply_suggestions)
+        event.listen(Session, 'after_rollback', discard_pending)
 
+    model.es_cache = SearchCache(cache) if cache is not None else None
     model.es_search = classmethod(partial(es_search, es_client=es_client))
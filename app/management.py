@@ -8,9 +8,27 @@
     :license: MIT, see LICENSE for more details.
 """
 from __future__ import unicode_literals
+import re
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from flask.ext.script import Manager, prompt_bool, prompt_pass
-from app import es, Snippet, User, db
-from make_searchable import do_index_item, do_delete_item
+from sqlalchemy import type_coerce
+from app import app, es, Snippet, User, IndexOutbox, db
+from make_searchable import do_index_item, do_delete_item, do_bulk, \
+    drain_outbox, index_action, delete_action, iter_chunks, \
+    index_definition, index_settings, new_index_name, swap_alias, \
+    iter_db_versions, iter_index_versions, diff_versions, \
+    LOADING_INDEX_SETTINGS
+from models import COMPRESS_THRESHOLD, COMPRESSED_MARKER
+from rendering import RENDERER_KEY, render_key, render_markdown, \
+    render_excerpt
+
+
+# How far before the start of a rebuild to look for changes to catch up on,
+# to allow for the clocks of the web servers being a little out.
+CATCH_UP_MARGIN = timedelta(minutes=1)
 
 
 #-- ES Management commands ---------------------------------------------------#
@@ -47,19 +65,391 @@ def delete(snippet_id):
     print "Snippet '{}' has been deleted from the index".format(snippet_id)
 
 
-@es_manager.command
-def rebuild():
-    "Remove and reindex all Snippets"
-    if prompt_bool(
-            "Are you sure you want to rebuild the index"):
-        es.delete_by_query(index=Snippet.__es_index__,
-                           doc_type=Snippet.__es_doc_type__,
-                           q='*')
-        print "All items deleted from the index"
-        for snippet in Snippet.query.all():
-            do_index_item(es, snippet)
-            print "Snippet '{} - {}' has been reindexed".format(snippet.id,
-                                                                snippet.title)
+class _Progress(object):
+    "Keeps track of and prints the progress of a bulk operation"
+    def __init__(self, total):
+        """Start tracking progress
+
+           :param total: The total number of items that will be processed
+        """
+        self.total = total
+        self.success = 0
+        self.failed = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return max(time.time() - self.start, 0.001)
+
+    def update(self, result):
+        """Record the result of one chunk and print the progress.
+
+           :param result: The tuple returned by _bulk_chunk
+        """
+        first_id, last_id, success, errors = result
+        self.success += success
+        self.failed += len(errors)
+        if errors:
+            print "Chunk {} - {} had {} failures, first error: {}".format(
+                first_id, last_id, len(errors), errors[0])
+
+        done = self.success + self.failed
+        print "Indexed {}/{} ({:.0f} per second)".format(
+            done, self.total, done / self.elapsed)
+
+
+def _push_app_context():
+    """Give each worker thread its own app context, and with it its own
+       ElasticSearch client, for the life of the pool.
+    """
+    app.app_context().push()
+
+
+def _bulk_chunk(actions):
+    """Send one chunk of actions to ElasticSearch, run in the worker pool.
+
+       :param actions: The list of bulk actions for the chunk.
+
+       :returns: A tuple of the first and last ids in the chunk, the number of
+                 successful actions and the list of errors.
+    """
+    success, errors = do_bulk(es, actions)
+    return actions[0]['_id'], actions[-1]['_id'], success, errors
+
+
+def _load_index(index, batch_size, workers, query=None):
+    """Stream all of the Snippets into an index.
+
+       :param index: The name of the index to load the Snippets into, None
+                     for the index the Snippet alias points at.
+       :param batch_size: The number of Snippets per bulk request.
+       :param workers: The number of bulk requests to send in parallel.
+       :param query: An optional query to only load some of the Snippets.
+
+       :returns: The _Progress of the load.
+    """
+    if query is None:
+        query = Snippet.query
+    progress = _Progress(query.count())
+
+    # Rows are read from the database in this thread and only the bulk
+    # requests are handed to the pool. Only a bounded number of chunks are
+    # kept in flight so that memory use doesn't grow with the table.
+    pool = ThreadPool(workers, initializer=_push_app_context)
+    pending = deque()
+    try:
+        for chunk in iter_chunks(Snippet, batch_size, query):
+            actions = [index_action(snippet, index) for snippet in chunk]
+            pending.append(pool.apply_async(_bulk_chunk, (actions,)))
+            db.session.expunge_all()
+
+            while pending and (len(pending) > workers or pending[0].ready()):
+                progress.update(pending.popleft().get())
+
+        while pending:
+            progress.update(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+
+    return progress
+
+
+@es_manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                   default=500, help="Number of Snippets per bulk request")
+@es_manager.option('-w', '--workers', dest='workers', type=int, default=1,
+                   help="Number of bulk requests to send in parallel")
+def rebuild(batch_size, workers):
+    """Reindex all Snippets into a new index and switch searches over to it
+       once it is complete"""
+    if not prompt_bool("Are you sure you want to rebuild the index"):
+        return
+
+    alias = Snippet.__es_index__
+    index = new_index_name(Snippet)
+    started = datetime.utcnow()
+    es.indices.create(index=index,
+                      body=index_definition(Snippet, loading=True))
+    print "Created index {}".format(index)
+
+    try:
+        progress = _load_index(index, batch_size, workers)
+        if progress.failed:
+            raise RuntimeError("{} Snippets failed to index".format(
+                progress.failed))
+    except BaseException:
+        es.indices.delete(index=index)
+        print "Rebuild failed, removed index {}. {} is unchanged".format(
+            index, alias)
+        raise
+
+    settings = index_settings(Snippet)
+    es.indices.put_settings(index=index, body={'index': dict(
+        (key, settings[key]) for key in LOADING_INDEX_SETTINGS)})
+    es.indices.refresh(index=index)
+
+    old_indexes = swap_alias(es, alias, index)
+    print "{} now points at {}".format(alias, index)
+    for old in old_indexes:
+        es.indices.delete(index=old)
+        print "Removed old index {}".format(old)
+
+    # Changes made during the load were sent to the old index, send them
+    # again now that the alias points at the new one. Thanks to external
+    # versioning anything already there is left alone.
+    print "Catching up on changes made during the rebuild"
+    changed = Snippet.query.filter(
+        Snippet.updated_at >= started - CATCH_UP_MARGIN)
+    catch_up = _load_index(None, batch_size, workers, changed)
+
+    # Snippets deleted during the load may have been loaded before they were
+    # deleted, and there is no row left to catch up on, so compare the whole
+    # index with the database to remove them.
+    print "Removing Snippets deleted during the rebuild"
+    es.indices.refresh(index=alias)
+    counts, repaired, failed = _reconcile(batch_size)
+
+    if Snippet.es_cache is not None:
+        Snippet.es_cache.invalidate(alias)
+
+    if catch_up.failed or failed:
+        raise RuntimeError(
+            "{} changes made during the rebuild failed to index, run "
+            "'./manage.py es verify' to fix them".format(
+                catch_up.failed + failed))
+
+    print "Reindexed {} Snippets in {:.1f} seconds, {} removed".format(
+        progress.success, progress.elapsed, counts['extra'])
+
+
+def _parse_since(since):
+    """Parse a time for 'es sync --since'.
+
+       :param since: Either a UTC time like '2015-06-01' or
+                     '2015-06-01T12:30:00', or a period before now like '30m',
+                     '12h' or '2d'.
+
+       :returns: A UTC datetime.
+
+       :raises ValueError: If the time can't be parsed.
+    """
+    match = re.match(r'^(\d+)([mhd])$', since)
+    if match:
+        unit = {'m': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+        return datetime.utcnow() - timedelta(**{unit: int(match.group(1))})
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(since, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Unable to parse time '{}'".format(since))
+
+
+@es_manager.option('-s', '--since', dest='since', required=True,
+                   help="UTC time like 2015-06-01T12:30 or a period like 2h")
+@es_manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                   default=500, help="Number of Snippets per bulk request")
+@es_manager.option('-w', '--workers', dest='workers', type=int, default=1,
+                   help="Number of bulk requests to send in parallel")
+def sync(since, batch_size, workers):
+    "Reindex the Snippets changed since a time"
+    try:
+        since = _parse_since(since)
+    except ValueError as e:
+        print e
+        return
+
+    query = Snippet.query.filter(Snippet.updated_at >= since)
+    progress = _load_index(None, batch_size, workers, query)
+
+    if Snippet.es_cache is not None:
+        Snippet.es_cache.invalidate(Snippet.__es_index__)
+
+    print "Synced {} Snippets changed since {} with {} failures".format(
+        progress.success, since.isoformat(), progress.failed)
+
+
+def _repair(differences):
+    """Fix the documents that differ between the database and the index.
+
+       :param differences: A list of (id, db_version, index_version) tuples
+                           from diff_versions.
+
+       :returns: A tuple of the number of successful actions and a list of the
+                 errors for the failed ones, see do_bulk.
+    """
+    ids = [item_id for item_id, _, _ in differences]
+    snippets = dict((snippet.id, snippet) for snippet in
+                    Snippet.query.filter(Snippet.id.in_(ids)).all())
+
+    actions = []
+    for item_id, db_version, index_version in differences:
+        snippet = snippets.get(item_id)
+        # An index version that is ahead of the database would block the
+        # external versioned update, so remove the document first.
+        if snippet is None or (index_version is not None and
+                               index_version > snippet.version):
+            actions.append(delete_action(Snippet, item_id))
+        if snippet is not None:
+            actions.append(index_action(snippet))
+    db.session.expunge_all()
+    return do_bulk(es, actions)
+
+
+def _reconcile(batch_size, dry_run=False):
+    """Compare the index with the database and fix any differences.
+
+       :param batch_size: The number of ids to compare, and fix, at a time.
+       :param dry_run: If True only count the differences.
+
+       :returns: A tuple of a dict of the number of Snippets 'missing' from
+                 the index, 'stale' in the index and 'extra' in the index
+                 but not the database, the number of fixes sent and the
+                 number that failed.
+    """
+    counts = {'missing': 0, 'stale': 0, 'extra': 0}
+    repaired, failed = 0, 0
+
+    differences = diff_versions(iter_db_versions(Snippet, batch_size),
+                                iter_index_versions(es, Snippet, batch_size))
+    batch = []
+    for difference in differences:
+        item_id, db_version, index_version = difference
+        if index_version is None:
+            counts['missing'] += 1
+        elif db_version is None:
+            counts['extra'] += 1
+        else:
+            counts['stale'] += 1
+        batch.append(difference)
+
+        if len(batch) >= batch_size and not dry_run:
+            success, errors = _repair(batch)
+            repaired, failed = repaired + success, failed + len(errors)
+            batch = []
+
+    if batch and not dry_run:
+        success, errors = _repair(batch)
+        repaired, failed = repaired + success, failed + len(errors)
+    return counts, repaired, failed
+
+
+@es_manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                   default=1000, help="Number of ids to compare at a time")
+@es_manager.option('-n', '--dry-run', dest='dry_run', action='store_true',
+                   default=False, help="Only report the differences")
+def verify(batch_size, dry_run):
+    "Compare the index with the database and fix any differences"
+    start = time.time()
+    counts, repaired, failed = _reconcile(batch_size, dry_run)
+
+    print ("{missing} Snippets missing from the index, {stale} out of date "
+           "and {extra} in the index but not the database").format(**counts)
+    if not dry_run:
+        if Snippet.es_cache is not None and repaired:
+            Snippet.es_cache.invalidate(Snippet.__es_index__)
+        print "Sent {} fixes, {} failed, in {:.1f} seconds".format(
+            repaired, failed, time.time() - start)
+
+
+@es_manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                   default=500, help="Number of changes per bulk request")
+@es_manager.option('-i', '--interval', dest='interval', type=float,
+                   default=1.0, help="Seconds to wait when there is no work")
+def worker(batch_size, interval):
+    "Send changes from the outbox to ElasticSearch until stopped"
+    print "Sending changes from the outbox, press Ctrl+C to stop"
+    try:
+        while True:
+            try:
+                sent, failed = drain_outbox(es, IndexOutbox, batch_size)
+            except Exception as e:
+                # Keep going if the database is briefly unavailable, nothing
+                # is removed from the outbox until it has been sent.
+                db.session.rollback()
+                print "Unable to process the outbox: {}".format(e)
+                sent, failed = 0, 0
+
+            if sent or failed:
+                print "Sent {} changes, {} failed".format(sent, failed)
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        print "Stopped"
+
+
+#-- Snippet Management commands ----------------------------------------------#
+snippet_manager = Manager(usage="Manage Snippets")
+
+
+@snippet_manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                        default=500, help="Number of Snippets at a time")
+def render(batch_size):
+    "Render and store the HTML and excerpts of Snippets that aren't current"
+    table = Snippet.__table__
+    query = Snippet.query.filter(db.or_(
+        Snippet.html_key.is_(None),
+        ~Snippet.html_key.startswith(RENDERER_KEY + ':')))
+
+    count = 0
+    for chunk in iter_chunks(Snippet, batch_size, query):
+        for snippet in chunk:
+            # Written with SQL rather than the ORM so that the version and
+            # updated_at are left alone, the text hasn't changed.
+            db.session.execute(
+                table.update().where(table.c.id == snippet.id).values(
+                    html=unicode(render_markdown(snippet.text)),
+                    excerpt=unicode(render_excerpt(snippet.text)),
+                    html_key=render_key(snippet.text),
+                    updated_at=table.c.updated_at))
+        db.session.commit()
+        count += len(chunk)
+    print "Rendered {} Snippets".format(count)
+
+
+@snippet_manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                        default=500, help="Number of Snippets at a time")
+@snippet_manager.option('-a', '--after', dest='after', type=int, default=0,
+                        help="Only Snippets with an id greater than this")
+def compress(batch_size, after):
+    """Compress the text and HTML of Snippets saved before they were
+       compressed.
+
+       Each batch is committed as it is done, and Snippets that are already
+       compressed are skipped, so it can be stopped and run again. Use
+       --after with the last id printed to skip the Snippets already done.
+    """
+    table = Snippet.__table__
+
+    def uncompressed(column):
+        # The stored value, rather than the text CompressedText turns it
+        # into.
+        stored = type_coerce(column, db.Text)
+        return db.and_(db.func.length(stored) > COMPRESS_THRESHOLD,
+                       ~stored.startswith(COMPRESSED_MARKER))
+
+    query = db.session.query(Snippet.id, Snippet.text, Snippet.html,
+                             Snippet.version)\
+        .filter(Snippet.id > after,
+                db.or_(uncompressed(table.c.text),
+                       uncompressed(table.c.html)))
+
+    count = 0
+    for chunk in iter_chunks(Snippet, batch_size, query):
+        for id, text, html, version in chunk:
+            # CompressedText compresses the text and HTML as they are
+            # written. The version and updated_at are left alone as they are
+            # the same, and rows edited since they were read are skipped.
+            result = db.session.execute(
+                table.update().where(db.and_(
+                    table.c.id == id, table.c.version == version)).values(
+                    text=text, html=html, updated_at=table.c.updated_at))
+            count += result.rowcount
+        db.session.commit()
+        print "Compressed {} Snippets, up to id {}".format(count,
+                                                           chunk[-1].id)
+    print "Compressed {} Snippets".format(count)
 
 
 #-- User Management commands -------------------------------------------------#
@@ -8,13 +8,245 @@
     :license: MIT, see LICENSE for more details.
 """
 from __future__ import unicode_literals
+import base64
+import zlib
+from datetime import datetime
+from functools import partial
+from itertools import count
 import bcrypt
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
 from flask.ext.login import UserMixin
+from sqlalchemy import and_, type_coerce
+from sqlalchemy.orm import load_only, scoped_session
+from sqlalchemy.sql.expression import SelectBase
+from sqlalchemy.types import Text, TypeDecorator
+
+
+# The create_engine options for connection pools, which SQLite doesn't use.
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+# Text longer than this many characters is stored compressed, see
+# CompressedText.
+COMPRESS_THRESHOLD = 4 * 1024
+# Stored values that start with this are compressed, the control character
+# keeps it from being confused with anything typed into a form.
+COMPRESSED_MARKER = '\x01z:'
 
 
 #-- SQLAlchemy Setup ---------------------------------------------------------#
-db = SQLAlchemy()
+def sqlite_pragmas(pragmas):
+    """Get a pool connect listener that sets PRAGMAs on new SQLite
+       connections.
+
+       :param pragmas: A dict of PRAGMA names and values, like
+                       {'journal_mode': 'WAL'}.
+
+       :returns: A function for the pool 'connect' event.
+    """
+    statements = ['PRAGMA {}={}'.format(name, value)
+                  for name, value in sorted(pragmas.items())]
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+    return on_connect
+
+
+class RoutingSession(_SignallingSession):
+    """A session that can send its reads to a read replica.
+
+       Sessions use the primary database until use_replica is called, then
+       SELECTs go to a replica while flushes and other statements stay on
+       the primary. Once the session has written anything its reads go back
+       to the primary, so it always sees its own changes.
+    """
+    def __init__(self, db, **options):
+        self._db = db
+        self._replica = None
+        # True once the session has sent a write to the primary.
+        self.wrote = False
+        super(RoutingSession, self).__init__(db, **options)
+
+    def use_replica(self):
+        """Send the reads of this session to the next replica, if any are
+           configured, until it next writes.
+        """
+        self._replica = self._db.get_replica(self.app)
+
+    def use_primary(self):
+        "Send all of the statements of this session to the primary."
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        """Get the engine for a statement.
+
+           :param mapper: The mapper of the model being queried, if any.
+           :param clause: The statement being run, if any.
+
+           :returns: A replica engine for SELECTs when one is in use,
+                     otherwise the engine Flask-SQLAlchemy would use.
+        """
+        if self._flushing or (clause is not None and
+                              not isinstance(clause, SelectBase)):
+            self.wrote = True
+            self._replica = None
+        elif self._replica is not None and clause is not None:
+            return self._replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy with engine options for production from the app
+       config.
+
+       * SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW, SQLALCHEMY_POOL_TIMEOUT
+         and SQLALCHEMY_POOL_RECYCLE size the pool for server databases and
+         are ignored for SQLite, which opens a connection for each session.
+       * SQLITE_PRAGMAS are set on each new SQLite connection.
+       * SQLALCHEMY_STATEMENT_TIMEOUT is the number of milliseconds a
+         PostgreSQL statement can run for before it is cancelled.
+       * SQLALCHEMY_REPLICAS is a list of SQLALCHEMY_BINDS names of read
+         replicas of the primary database, see RoutingSession.
+    """
+    def __init__(self, *args, **kwargs):
+        # Shared by all sessions so replicas are used in turn.
+        self._replica_counter = count()
+        super(Database, self).__init__(*args, **kwargs)
+
+    def create_scoped_session(self, options=None):
+        """Create the scoped session, of RoutingSessions.
+
+           :param options: A dict of keyword arguments for the sessions, and
+                           an optional 'scopefunc'.
+
+           :returns: A scoped_session.
+        """
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return scoped_session(partial(RoutingSession, self, **options),
+                              scopefunc=scopefunc)
+
+    def get_replica(self, app):
+        """Get the engine of the next read replica, round-robin.
+
+           :param app: The Flask app.
+
+           :returns: An engine or None if there are no replicas.
+        """
+        replicas = app.config.get('SQLALCHEMY_REPLICAS')
+        if not replicas:
+            return None
+        bind = replicas[next(self._replica_counter) % len(replicas)]
+        return self.get_engine(app, bind)
+
+    def apply_driver_hacks(self, app, info, options):
+        """Add the engine options from the app config before the engine is
+           created.
+
+           :param app: The Flask app.
+           :param info: The URL of the database.
+           :param options: A dict of the create_engine keyword arguments.
+        """
+        if info.drivername.startswith('sqlite'):
+            for option in POOL_OPTIONS:
+                options.pop(option, None)
+        super(Database, self).apply_driver_hacks(app, info, options)
+
+        if info.drivername.startswith('sqlite'):
+            pragmas = app.config.get('SQLITE_PRAGMAS')
+            if pragmas:
+                options.setdefault('pool_events', []).append(
+                    (sqlite_pragmas(pragmas), 'connect'))
+        elif info.drivername in ('postgresql', 'postgresql+psycopg2'):
+            timeout = app.config.get('SQLALCHEMY_STATEMENT_TIMEOUT')
+            if timeout:
+                # Set as a connection option, a SET statement would be
+                # rolled back when the connection is returned to the pool.
+                connect_args = options.setdefault('connect_args', {})
+                connect_args['options'] = '-c statement_timeout={}'.format(
+                    int(timeout))
+
+
+db = Database()
+
+
+#-- Column Types -------------------------------------------------------------#
+def compress_text(value, threshold=COMPRESS_THRESHOLD, level=6):
+    """Compress text for storing in a CompressedText column.
+
+       :param value: The text, or None.
+       :param threshold: Text this many characters long or shorter is stored
+                         as it is.
+       :param level: The zlib compression level.
+
+       :returns: The text itself, or COMPRESSED_MARKER followed by the base64
+                 of the zlib compressed UTF-8 if that is shorter. Text that
+                 starts with the marker is always compressed so it can be
+                 told apart.
+    """
+    if value is None:
+        return None
+    marked = value.startswith(COMPRESSED_MARKER)
+    if len(value) <= threshold and not marked:
+        return value
+    data = base64.b64encode(zlib.compress(value.encode('utf-8'), level))
+    compressed = COMPRESSED_MARKER + data.decode('ascii')
+    if len(compressed) >= len(value) and not marked:
+        return value
+    return compressed
+
+
+def decompress_text(value):
+    """Get the text back from a value stored by compress_text.
+
+       :param value: The stored value, or None.
+
+       :returns: The text.
+    """
+    if value is None or not value.startswith(COMPRESSED_MARKER):
+        return value
+    data = base64.b64decode(value[len(COMPRESSED_MARKER):])
+    return zlib.decompress(data).decode('utf-8')
+
+
+class CompressedText(TypeDecorator):
+    """A text column that stores long values zlib compressed, so large
+       pastes take less space in the database and less I/O to load.
+
+       Values are base64 encoded so the column stays a text column, and
+       values stored before it was compressed are read as they are. Queries
+       with LIKE only match the text of values that aren't compressed, they
+       never match the base64 of the ones that are.
+    """
+    impl = Text
+
+    class comparator_factory(TypeDecorator.Comparator):
+        def like(self, other, escape=None):
+            # The stored value, rather than the text CompressedText turns it
+            # into.
+            stored = type_coerce(self.expr, Text)
+            return and_(~stored.startswith(COMPRESSED_MARKER),
+                        stored.like(other, escape=escape))
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=6, *args,
+                 **kwargs):
+        """Create a new CompressedText
+
+           :param threshold: Values this many characters long or shorter are
+                             stored as they are.
+           :param level: The zlib compression level.
+        """
+        super(CompressedText, self).__init__(*args, **kwargs)
+        self.threshold = threshold
+        self.level = level
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value, self.threshold, self.level)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
 
 
 #-- Models -------------------------------------------------------------------#
@@ -24,10 +256,42 @@ class Snippet(db.Model):
     __es_index__ = 'snippets'
     __es_doc_type__ = 'snippet'
     __es_fields__ = ['title', 'text']
+    # The database search used while ElasticSearch is down can't match the
+    # text of long Snippets as it is compressed, so it searches the start of
+    # it in the excerpt as well.
+    __es_fallback_fields__ = ['title', 'text', 'excerpt']
+    __es_mapping__ = {
+        'properties': {
+            'id': {'type': 'integer'},
+            'title': {'type': 'text'},
+            'text': {'type': 'text'},
+        }
+    }
+    __es_suggest__ = 'title'
+    # Documents are indexed with the version as an external version so an
+    # older change can never overwrite a newer one.
+    __es_version__ = 'version'
+    # Search results are only listed so build them from the index rather
+    # than loading them from the database.
+    __es_hydrate__ = False
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(64))
-    text = db.Column(db.Text())
+    text = db.Column(CompressedText())
+    updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    # The text, and an excerpt of it, rendered to HTML when it was last
+    # written, see app.rendering.store_rendered.
+    html = db.Column(CompressedText())
+    excerpt = db.Column(db.Text())
+    html_key = db.Column(db.String(53))
+
+    # The version is incremented by make_searchable when an indexed field
+    # changes, and an update fails if the row has been changed since it was
+    # loaded.
+    __mapper_args__ = {'version_id_col': version,
+                       'version_id_generator': False}
 
     def __init__(self, title, text):
         """Create a new Snippet
@@ -45,6 +309,60 @@ class Snippet(db.Model):
         """
         return u'Snippet({0} - {1})'.format(self.id, self.title)
 
+    @classmethod
+    def listing(cls):
+        """Query for Snippets on listing pages, which only show the title
+           and excerpt so the text and HTML aren't loaded. The version is
+           loaded for the panel cache keys.
+
+           :returns: A query of Snippets with only the listed columns loaded.
+        """
+        return cls.query.options(load_only('id', 'title', 'excerpt',
+                                           'html_key', 'version'))
+
+    @classmethod
+    def newest(cls, limit=10, before=None):
+        """Query for the newest Snippets for the listing pages.
+
+           Older pages continue from the id of the last Snippet on the page
+           before rather than using OFFSET, so every page is a short range
+           scan of the primary key no matter how far back it is.
+
+           :param limit: The number of Snippets to list.
+           :param before: Only list Snippets with an id less than this.
+
+           :returns: A listing query of Snippets, newest first.
+        """
+        query = cls.listing()
+        if before is not None:
+            query = query.filter(cls.id < before)
+        return query.order_by(cls.id.desc()).limit(limit)
+
+
+class IndexOutbox(db.Model):
+    """Class for changes waiting to be sent to ElasticSearch.
+
+       A row is written in the same transaction as each change to a
+       searchable model and removed once the change has been indexed.
+    """
+    __tablename__ = 'index_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64), nullable=False)
+    doc_type = db.Column(db.String(64), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime, nullable=False,
+                             default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        """Unicode representation of the outbox entry.
+
+           :returns: The Unicode representation of the IndexOutbox entry.
+        """
+        return u'IndexOutbox({0} - {1}/{2}/{3})'.format(
+            self.id, self.index, self.doc_type, self.item_id)
+
 
 class User(db.Model, UserMixin):
     "Class to represent Users"
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    Query
+    ~~~~~
+    Turns what users type into the search box into ElasticSearch queries that
+    are cheap to run.
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import re
+
+
+# Limits on the queries users can run, each clause is a word or a phrase.
+MAX_QUERY_LENGTH = 256
+MAX_CLAUSES = 10
+# Prefix searches like 'elas*' are only kept for stems at least this long and
+# only for the first few of them, short prefixes match too many terms.
+MIN_PREFIX_LENGTH = 3
+MAX_PREFIX_TERMS = 2
+
+# The simple_query_string operators users can use: + for must, - for must
+# not, | for or, "phrases" and trailing * for prefixes.
+QUERY_FLAGS = 'AND|OR|NOT|PHRASE|PREFIX|WHITESPACE'
+
+# An optional run of operators followed by a phrase or a word.
+TOKEN_RE = re.compile(r'([+|-]*)("[^"]*"?|[^\s"]+)', re.UNICODE)
+# The characters that are kept in a word, the rest are query syntax.
+WORD_RE = re.compile(r"[^\w.'*?-]", re.UNICODE)
+# Field names and fuzziness from the query_string syntax.
+FIELD_RE = re.compile(r'^[\w.]+:', re.UNICODE)
+FUZZY_RE = re.compile(r'~[\d.]*$', re.UNICODE)
+# Boolean words from the query_string syntax and the operators to use
+# instead, OR is the default so needs no operator.
+BOOLEAN_WORDS = {'AND': '+', '&&': '+', 'OR': '', '||': '', 'NOT': '-'}
+# The words of a clause for backends that match whole words, like the SQLite
+# FTS5 tables and the database fallback search.
+CLAUSE_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+#-- Helpers ------------------------------------------------------------------#
+def clean_word(word, allow_prefix):
+    """Remove everything but a trailing '*' wildcard from a word.
+
+       :param word: A word from a query.
+       :param allow_prefix: If False any trailing '*' is removed as well.
+
+       :returns: A tuple of the cleaned word, which may be empty, and True if
+                 it is a prefix search.
+    """
+    word = WORD_RE.sub('', FUZZY_RE.sub('', FIELD_RE.sub('', word)))
+    prefix = word.endswith('*')
+    word = word.replace('*', '').replace('?', '').strip('-')
+    prefix = prefix and allow_prefix and len(word) >= MIN_PREFIX_LENGTH
+    return word, prefix
+
+
+def rewrite_query(text, max_clauses=MAX_CLAUSES):
+    """Rewrite a users query into a simple_query_string query with limits on
+       how expensive it can be.
+
+       * Only the first max_clauses words and phrases are used.
+       * Regex, fuzzy, field and leading or inner wildcard searches are
+         removed, and the AND, OR and NOT words become operators.
+       * Only the first MAX_PREFIX_TERMS prefix searches with a stem of at
+         least MIN_PREFIX_LENGTH are kept.
+       * '-' is ignored if all of the clauses have it, otherwise the query
+         would match every other document.
+
+       :param text: The text typed into the search box.
+       :param max_clauses: The most words and phrases to use.
+
+       :returns: The query string, or None if nothing searchable is left.
+    """
+    clauses = []
+    prefixes = 0
+    pending = ''
+    for operators, term in TOKEN_RE.findall(text[:MAX_QUERY_LENGTH]):
+        if len(clauses) >= max_clauses:
+            break
+        if not operators and term in BOOLEAN_WORDS:
+            pending = BOOLEAN_WORDS[term]
+            continue
+        operator = operators[-1:] if operators[-1:] in ('+', '-') else ''
+        operator, pending = operator or pending, ''
+
+        if term.startswith('"'):
+            words = [clean_word(word, False)[0]
+                     for word in term.strip('"').split()]
+            words = [word for word in words if word]
+            if not words:
+                continue
+            term = '"{}"'.format(' '.join(words))
+        else:
+            term, prefix = clean_word(term,
+                                      prefixes < MAX_PREFIX_TERMS)
+            if not term:
+                continue
+            if prefix:
+                prefixes += 1
+                term += '*'
+        clauses.append((operator, term))
+
+    if all(operator == '-' for operator, _ in clauses):
+        clauses = [('', term) for _, term in clauses]
+    return ' '.join(operator + term for operator, term in clauses) or None
+
+
+def parse_query(text):
+    """Split a simple_query_string query, like the ones from rewrite_query,
+       into clauses for search backends that can't run it themselves.
+
+       :param text: The query string.
+
+       :returns: A list of (operator, words, prefix) tuples. The operator is
+                 '+' for must, '-' for must not or '' for should, the words
+                 are a list with more than one word for a phrase and prefix
+                 is True for a prefix search. Words joined by other
+                 characters outside a phrase are separate clauses.
+    """
+    clauses = []
+    for operators, term in TOKEN_RE.findall(text):
+        operator = operators[-1:] if operators[-1:] in ('+', '-') else ''
+        words = CLAUSE_WORD_RE.findall(term)
+        if not words:
+            continue
+        if term.startswith('"'):
+            clauses.append((operator, words, False))
+        else:
+            for word in words[:-1]:
+                clauses.append((operator, [word], False))
+            clauses.append((operator, words[-1:], term.endswith('*')))
+    return clauses
+
+
+def split_clauses(clauses):
+    """Sort clauses by how they decide which documents match, like the
+       bool query simple_query_string builds.
+
+       * If there are any must clauses a document has to match all of them
+         and the should clauses are ignored, otherwise it has to match at
+         least one of the should clauses.
+       * It can't match any of the must not clauses, unless they are all
+         there is in which case they are used as should clauses, see
+         rewrite_query.
+
+       :param clauses: A list of clauses from parse_query.
+
+       :returns: A tuple of the lists of the must, should and must not
+                 clauses.
+    """
+    must = [clause for clause in clauses if clause[0] == '+']
+    should = [clause for clause in clauses if clause[0] == '']
+    must_not = [clause for clause in clauses if clause[0] == '-']
+    if not must and not should:
+        return [], must_not, []
+    return must, should, must_not
+
+
+#-- Main ---------------------------------------------------------------------#
+def plan_query(text, fields, max_clauses=MAX_CLAUSES, timeout=None,
+               terminate_after=None):
+    """Build the search body for a users query.
+
+       :param text: The text typed into the search box.
+       :param fields: A list of the fields to search.
+       :param max_clauses: The most words and phrases to use, see
+                           rewrite_query.
+       :param timeout: An optional ElasticSearch time limit like '500ms',
+                       the hits found in that time are returned.
+       :param terminate_after: An optional maximum number of documents to
+                               collect on each shard.
+
+       :returns: A search body or None if there is nothing to search for.
+    """
+    query = rewrite_query(text, max_clauses)
+    if query is None:
+        return None
+
+    body = {
+        'query': {
+            'simple_query_string': {
+                'query': query,
+                'fields': list(fields),
+                'flags': QUERY_FLAGS,
+                'lenient': True,
+            }
+        }
+    }
+    if timeout:
+        body['timeout'] = timeout
+    if terminate_after:
+        body['terminate_after'] = terminate_after
+    return body
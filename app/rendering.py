@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+    Rendering
+    ~~~~~~~~~
+    Renders the markdown of Snippets once per revision and keeps the HTML
+    with the row, so pages don't run Misaka on every request.
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import hashlib
+import json
+import misaka
+from flask import get_template_attribute
+from flask.ext.misaka import markdown, make_flags
+from markupsafe import Markup, escape
+from sqlalchemy import event, inspect
+
+from cache import AppCache, FragmentCache, LRUCache
+
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+
+# The options used to render markdown, by the markdown template filter as
+# well as for the stored HTML.
+MARKDOWN_OPTIONS = {
+    'autolink': True,
+    'escape': True,
+    'fenced_code': True,
+    'no_html': True,
+    'no_intra_emphasis': True,
+    'strikethrough': True,
+    'superscript': True,
+    'safelink': True,
+}
+
+# Fenced code blocks are highlighted on the server with Pygments, which is
+# in the requirements. Without it highlight.js does it in the browser.
+HIGHLIGHT_CODE = pygments is not None
+# The CSS class of the highlighted code blocks.
+HIGHLIGHT_CSS_CLASS = 'highlight'
+
+# The number of characters of the text used for excerpts on listing pages.
+EXCERPT_LENGTH = 250
+
+# HTML rendered for text that isn't stored with a row, like previews and rows
+# rendered with other options, keyed on render_key.
+render_cache = AppCache('RENDER_CACHE')
+# Rendered parts of pages. The 'snippets' group is invalidated whenever a
+# Snippet is written, panels are keyed on the Snippet version instead.
+fragment_cache = FragmentCache(AppCache('FRAGMENT_CACHE'))
+# Highlighted code blocks keyed on the language and a hash of the code. This
+# is per process so that it can be used without an app context.
+code_cache = LRUCache(threshold=1000, default_timeout=0)
+
+
+#-- Helpers ------------------------------------------------------------------#
+def renderer_key(options=None):
+    """Get a short hash of the renderer and its options, HTML rendered with
+       a different renderer is never used.
+
+       :param options: The Misaka options, defaults to MARKDOWN_OPTIONS.
+
+       :returns: A string of 12 hex digits.
+    """
+    if options is None:
+        options = MARKDOWN_OPTIONS
+    data = json.dumps([misaka.__version__, sorted(options.items()),
+                       pygments.__version__ if HIGHLIGHT_CODE else None])
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+# The key of the current renderer, worked out once as the options are fixed.
+RENDERER_KEY = renderer_key()
+
+
+def render_key(text):
+    """Get the key of the HTML for some markdown with the current renderer.
+
+       :param text: The markdown text.
+
+       :returns: A string of the renderer key and the SHA1 of the text.
+    """
+    digest = hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+    return '{}:{}'.format(RENDERER_KEY, digest)
+
+
+def preview_key(title, text):
+    """Get the key of a rendered preview, also used as its ETag.
+
+       :param title: The title being previewed.
+       :param text: The markdown text being previewed.
+
+       :returns: A string of the renderer key and the SHA1 of the title and
+                 text.
+    """
+    data = json.dumps([title, text])
+    return '{}-{}'.format(RENDERER_KEY, hashlib.sha1(data).hexdigest())
+
+
+def highlight_code(code, lang):
+    """Highlight a code block with Pygments, through code_cache.
+
+       :param code: The code in the block.
+       :param lang: The language given for a fenced code block, or None.
+
+       :returns: The HTML for the block. If Pygments isn't installed or
+                 doesn't know the language the code is only escaped, like
+                 Misaka does.
+    """
+    digest = hashlib.sha1(code.encode('utf-8')).hexdigest()
+    key = '{}:{}'.format(lang or '', digest)
+    html = code_cache.get(key)
+    if html is None:
+        lexer = None
+        if HIGHLIGHT_CODE and lang:
+            try:
+                lexer = get_lexer_by_name(lang)
+            except ClassNotFound:
+                pass
+        if lexer is None:
+            html = '<pre><code{}>{}</code></pre>\n'.format(
+                ' class="{}"'.format(escape(lang)) if lang else '',
+                escape(code))
+        else:
+            html = pygments.highlight(
+                code, lexer, HtmlFormatter(cssclass=HIGHLIGHT_CSS_CLASS))
+        code_cache.set(key, html)
+    return html
+
+
+def highlight_css():
+    """Get the Pygments CSS for highlighted code blocks.
+
+       :returns: The CSS, empty if Pygments isn't installed.
+    """
+    if not HIGHLIGHT_CODE:
+        return ''
+    return HtmlFormatter().get_style_defs('.' + HIGHLIGHT_CSS_CLASS)
+
+
+class CodeRenderer(misaka.HtmlRenderer):
+    "A Misaka HTML renderer that highlights code blocks with highlight_code"
+
+    def block_code(self, text, lang):
+        return highlight_code(text, lang)
+
+
+def render_markdown(text):
+    """Render markdown to HTML with MARKDOWN_OPTIONS, code blocks are
+       highlighted if HIGHLIGHT_CODE is set.
+
+       :param text: The markdown text, None is treated as empty.
+
+       :returns: The HTML as Markup.
+    """
+    if not HIGHLIGHT_CODE:
+        return markdown(text or '', **MARKDOWN_OPTIONS)
+    extensions, render_flags = make_flags(**MARKDOWN_OPTIONS)
+    renderer = misaka.Markdown(CodeRenderer(flags=render_flags),
+                               extensions=extensions)
+    return Markup(renderer.render(text or ''))
+
+
+def truncate_text(text, length=EXCERPT_LENGTH):
+    """Cut text down to at most length characters, at the last whole word,
+       like the Jinja truncate filter.
+
+       :param text: The text, None is treated as empty.
+       :param length: The most characters to keep, including the '...'.
+
+       :returns: The text, with '...' on the end if it was cut.
+    """
+    text = text or ''
+    if len(text) <= length:
+        return text
+    return text[:length - 3].rsplit(' ', 1)[0] + '...'
+
+
+def render_excerpt(text):
+    """Render the start of some markdown to HTML for listing pages.
+
+       :param text: The markdown text, None is treated as empty.
+
+       :returns: The HTML as Markup.
+    """
+    return render_markdown(truncate_text(text))
+
+
+def _is_current(item, key_field):
+    key = getattr(item, key_field, None)
+    return bool(key) and key.startswith(RENDERER_KEY + ':')
+
+
+def _render_cached(kind, text, render):
+    key = '{}:{}'.format(kind, render_key(text))
+    html = render_cache.get(key)
+    if html is None:
+        html = unicode(render(text))
+        render_cache.set(key, html)
+    return Markup(html)
+
+
+#-- Main ---------------------------------------------------------------------#
+def rendered(item):
+    """Get the HTML for the text of a Snippet, used as the 'rendered'
+       template filter.
+
+       The HTML stored with the row is used if it was rendered with the
+       current renderer. Otherwise, and for dicts like the ones used for
+       previews, the text is rendered through render_cache.
+
+       :param item: A Snippet or a dict with a 'text' key.
+
+       :returns: The HTML as Markup.
+    """
+    html = getattr(item, 'html', None)
+    if html is not None and _is_current(item, 'html_key'):
+        return Markup(html)
+    text = item['text'] if isinstance(item, dict) else item.text
+    return _render_cached('html', text, render_markdown)
+
+
+def excerpt(item):
+    """Get the HTML for the start of the text of a Snippet, used as the
+       'excerpt' template filter on listing pages.
+
+       Like rendered the stored excerpt is used if it is current, so the
+       text doesn't need to be loaded.
+
+       :param item: A Snippet or a dict with a 'text' key.
+
+       :returns: The HTML as Markup.
+    """
+    html = getattr(item, 'excerpt', None)
+    if html is not None and _is_current(item, 'html_key'):
+        return Markup(html)
+    text = item['text'] if isinstance(item, dict) else item.text
+    return _render_cached('excerpt', text, render_excerpt)
+
+
+def cached_panel(snippet, truncate=False, edit=False):
+    """Render the snippet_panel macro for a saved Snippet through
+       fragment_cache, used as a template global.
+
+       :param snippet: The Snippet.
+       :param truncate: If True show the excerpt rather than the whole text.
+       :param edit: If True show the edit and delete buttons.
+
+       :returns: The panel as Markup.
+    """
+    macro = get_template_attribute('macros.html', 'snippet_panel')
+    key = (snippet.id, snippet.version, RENDERER_KEY, truncate, edit)
+    return fragment_cache.cached(
+        'panels', key, lambda: macro(snippet, truncate=truncate, edit=edit))
+
+
+def store_rendered(model, source='text', html='html', excerpt='excerpt',
+                   key='html_key'):
+    """Render the markdown of a model when it is written and store the HTML,
+       an excerpt for listing pages and their render_key with the row.
+
+       :param model: The SQLAlchemy database model.
+       :param source: The name of the markdown column.
+       :param html: The name of the column to store the HTML in.
+       :param excerpt: The name of the column to store the excerpt in.
+       :param key: The name of the column to store the render_key in.
+    """
+    def fill(mapper, connection, target):
+        text = getattr(target, source)
+        new_key = render_key(text)
+        if getattr(target, key) != new_key:
+            setattr(target, html, unicode(render_markdown(text)))
+            setattr(target, excerpt, unicode(render_excerpt(text)))
+            setattr(target, key, new_key)
+
+    def fill_changed(mapper, connection, target):
+        # Only look at the text if it has been changed, so that updates to
+        # other columns don't need it to be loaded.
+        if inspect(target).attrs[source].history.has_changes():
+            fill(mapper, connection, target)
+
+    event.listen(model, 'before_insert', fill)
+    event.listen(model, 'before_update', fill_changed)
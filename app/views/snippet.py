@@ -9,23 +9,79 @@
 """
 from __future__ import unicode_literals
 from flask import Blueprint, request, render_template, redirect, url_for,\
-    flash, g, jsonify, abort
+    flash, g, json, jsonify, abort, current_app
+from sqlalchemy.orm import defer
+from sqlalchemy.orm.exc import StaleDataError
 
+from app.conditional import conditional, listing_validators, \
+    snippet_validators
 from app.models import db, Snippet
 from app.forms import Confirm_Form, Snippit_Form
+from app.make_searchable import SearchResults
+from app.query import plan_query
+from app.rendering import preview_key, render_cache, fragment_cache
 
 
 mod = Blueprint('snippet', __name__, url_prefix='/snippet')
 
 
+#-- Helpers ------------------------------------------------------------------#
+def _newest_page():
+    """Get the query for the page of newest Snippets asked for, with one
+       extra Snippet to show if there is an older page.
+
+       :returns: A tuple of the page size, the 'before' id and the query.
+    """
+    size = current_app.config['LISTING_PAGE_SIZE']
+    before = request.args.get('before', type=int)
+    return size, before, Snippet.newest(size + 1, before)
+
+
+def newest_validators():
+    "Validators for the pages listing the newest Snippets."
+    return listing_validators(_newest_page()[2])
+
+
+def _results_validators():
+    """Validators for the results page, only the list of the newest
+       Snippets shown when there is no query can be validated.
+    """
+    if request.args.get('q'):
+        return None
+    return newest_validators()
+
+
+def render_newest():
+    """Render a page listing the newest Snippets, the 'before' argument is
+       the id to list older Snippets from. The list is cached until a
+       Snippet is next written.
+
+       :returns: The rendered index template.
+    """
+    size, before, query = _newest_page()
+
+    def render():
+        results = query.all()
+        older = results[size - 1].id if len(results) > size else None
+        return render_template('snippets/newest.html',
+                               results=results[:size], before=before,
+                               older=older)
+
+    body = fragment_cache.cached('snippets', ('newest', size, before), render)
+    return render_template('index.html', body=body)
+
+
 #-- Views - General Pages ----------------------------------------------------#
 @mod.route('/')
+@conditional(_results_validators)
 def results():
     """Results page for searches.
 
-       :results: If there is a query searches ElasticSearch and returns the
-                 results. If there is no query returns the 10 most recently
-                 created Snippets.
+       :results: If there is a query searches ElasticSearch and returns a
+                 page of results, the 'after' and 'before' arguments are
+                 cursors for the next and previous pages. If there is no query
+                 returns a page of the most recently created Snippets, see
+                 render_newest.
     """
     query = request.args.get('q')
 
@@ -35,21 +91,31 @@ def results():
         g.search_form.query.data = query
 
         # Construct the query to be passed to ElasticSearch.
-        body = {
-            "query": {
-                "query_string": {
-                    "query": query,
-                }
-            }
-        }
-
-        results = Snippet.es_search(body=body)
+        config = current_app.config
+        body = plan_query(query, Snippet.__es_fields__,
+                          max_clauses=config['SEARCH_MAX_CLAUSES'],
+                          timeout=config['SEARCH_TIMEOUT'],
+                          terminate_after=config['SEARCH_TERMINATE_AFTER'])
+
+        try:
+            results = SearchResults()
+            if body is not None:
+                # Only the matching fragments of the text are shown so the
+                # rest of it isn't needed.
+                body['_source'] = ['id', 'title']
+                results = Snippet.es_search(
+                    body=body,
+                    size=config['SEARCH_PAGE_SIZE'],
+                    after=request.args.get('after'),
+                    before=request.args.get('before'),
+                    highlight={'title': 0, 'text': 2})
+        except ValueError:
+            abort(400)
         return render_template('snippets/results.html',
                                results=results,
                                query=query)
     else:
-        results = Snippet.query.order_by(-Snippet.id).limit(10).all()
-        return render_template('index.html', results=results)
+        return render_newest()
 
 
 @mod.route('/new', methods=['GET', 'POST'])
@@ -79,23 +145,71 @@ def new_snippet():
 def render():
     """Endpoint for Ajax requests to render markdown for a preview
 
+       The response has an ETag of a hash of the title and text, so an
+       unchanged preview sent with If-None-Match gets a 304 and the rendered
+       fragments are kept in the render cache for repeats.
+
        :returns: JSON containing a the rendered snippet data as a html
                  fragment.
     """
-    if not request.json:
+    limit = current_app.config['RENDER_MAX_LENGTH']
+    if request.content_length > limit:
+        abort(413)
+    # Chunked requests don't have a Content-Length, so never read more than
+    # the limit whatever it says.
+    body = request.stream.read(limit + 1)
+    if len(body) > limit:
+        abort(413)
+    if request.mimetype != 'application/json':
+        abort(400)
+    try:
+        preview = json.loads(body)
+    except ValueError:
+        abort(400)
+    if not preview:
         abort(400)
 
     data = {
-        'text': request.json.get('text', ''),
-        'title': request.json.get('title', '')
+        'text': preview.get('text', ''),
+        'title': preview.get('title', '')
     }
 
-    html = render_template('snippets/render.html', snippet=data)
-    return jsonify({'html': html})
+    etag = preview_key(data['title'], data['text'])
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        key = 'preview:' + etag
+        html = render_cache.get(key)
+        if html is None:
+            html = render_template('snippets/render.html', snippet=data)
+            render_cache.set(key, html)
+        response = jsonify({'html': html})
+    response.set_etag(etag)
+    return response
+
+
+@mod.route('/typeahead')
+def typeahead():
+    """Endpoint for Ajax requests for Snippet titles starting with the text
+       typed into the search box so far.
+
+       :returns: JSON containing a list of the matching titles with the id
+                 and url of each Snippet.
+    """
+    query = request.args.get('q', '')
+    limit = max(min(request.args.get('limit', 10, type=int), 20), 1)
+
+    suggestions = [
+        {'id': snippet_id, 'title': title,
+         'url': url_for('.get_snippet', id=snippet_id)}
+        for snippet_id, title in Snippet.es_suggest.suggest(query, limit)
+    ]
+    return jsonify({'results': suggestions})
 
 
 #-- Individual Snippet -------------------------------------------------------#
 @mod.route('/<int:id>')
+@conditional(snippet_validators)
 def get_snippet(id):
     """Returns the page for an individual Snippet.
 
@@ -103,7 +217,9 @@ def get_snippet(id):
 
        :resutls: If the id is valid returns the page for the Snippet.
     """
-    snippet = Snippet.query.get_or_404(id)
+    # The page shows the stored HTML, so the text is only loaded if that
+    # has to be rendered again.
+    snippet = Snippet.query.options(defer('text')).get_or_404(id)
     return render_template('snippets/snippet.html', snippet=snippet)
 
 
@@ -132,6 +248,19 @@ def delete_snippet(id):
                            question=question.format(snippet.title))
 
 
+def _edit_conflict(snippet):
+    """Send the user back to edit a Snippet that someone else has saved
+       since they started editing it.
+
+       :param snippet: The Snippet.
+
+       :returns: A redirect to the page for editing the Snippet.
+    """
+    flash("Snippet '{}' was changed while you were editing it, "
+          "please try again".format(snippet.title), 'alert-warning')
+    return redirect(url_for('.edit_snippet', id=snippet.id))
+
+
 @mod.route('/<int:id>/edit', methods=['GET', 'POST'])
 def edit_snippet(id):
     """Page for editing Snippets.
@@ -147,15 +276,24 @@ def edit_snippet(id):
     form = Snippit_Form()
 
     if form.validate_on_submit():
+        # Someone else saved the Snippet after the form was filled in
+        if form.version.data != unicode(snippet.version):
+            return _edit_conflict(snippet)
         snippet.title, snippet.text = form.title.data, form.text.data
         db.session.add(snippet)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            # Someone else saved the Snippet since it was loaded
+            db.session.rollback()
+            return _edit_conflict(snippet)
         flash("Snippet '{}' Updated".format(snippet.title),
               'alert-success')
         return redirect(url_for('.get_snippet', id=snippet.id))
 
     form.title.data = snippet.title
     form.text.data = snippet.text
+    form.version.data = snippet.version
     return render_template('snippets/edit_snippet.html',
                            form=form,
                            snippet=snippet)
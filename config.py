@@ -27,7 +27,78 @@ class BaseConfig(object):
     # >>> import os
     # >>> os.urandom(24)
     SECRET_KEY = 'DEFAULT'
+    # Connection pool for server databases like PostgreSQL, size it to the
+    # number of threads in each worker. These are ignored for SQLite.
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    SQLALCHEMY_POOL_TIMEOUT = 10
+    SQLALCHEMY_POOL_RECYCLE = 60 * 60
+    # Milliseconds a PostgreSQL statement can run for before it is
+    # cancelled, None for no limit.
+    SQLALCHEMY_STATEMENT_TIMEOUT = 5000
+    # Names of SQLALCHEMY_BINDS that are read replicas of the primary. Reads
+    # for GET requests are sent to them in turn, except for clients that
+    # have written in the last SQLALCHEMY_REPLICA_LAG seconds, which read
+    # from the primary so they see their changes.
+    SQLALCHEMY_REPLICAS = []
+    SQLALCHEMY_REPLICA_LAG = 5
+    # PRAGMAs set on each new SQLite connection. WAL lets readers carry on
+    # while a write is in progress and busy_timeout makes writers wait up to
+    # that many milliseconds for the lock rather than failing straight away.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -16 * 1024,
+        'mmap_size': 64 * 1024 * 1024,
+    }
+    # Either 'elasticsearch' or 'sqlite' to use SQLite FTS5 tables in the
+    # database for searching, only for use with SQLite databases.
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'elasticsearch')
     ELASTICSEARCH_HOST = os.environ.get('ELASTICSEARCH_HOST', 'localhost:9200')
+    # Seconds to wait for ElasticSearch when searching and when sending
+    # changes from the web app.
+    ES_SEARCH_TIMEOUT = 2
+    ES_WRITE_TIMEOUT = 5
+    # After ES_BREAKER_THRESHOLD failed calls in a row searches are served
+    # from the database, and changes aren't sent, for ES_BREAKER_RESET
+    # seconds before ElasticSearch is tried again.
+    ES_BREAKER_THRESHOLD = 5
+    ES_BREAKER_RESET = 30
+    # When True changes are written to an outbox table in the same
+    # transaction as the change and sent to ElasticSearch by a separate
+    # worker, see './manage.py es worker'. When False they are sent straight
+    # after each commit.
+    ES_OUTBOX = False
+    # The number of results on each page of search results.
+    SEARCH_PAGE_SIZE = 10
+    # The number of Snippets on each page of the newest Snippets.
+    LISTING_PAGE_SIZE = 10
+    # Limits on the cost of each search, see app.query.plan_query. The hits
+    # found before the timeout, or in the first SEARCH_TERMINATE_AFTER
+    # documents on each shard, are returned.
+    SEARCH_MAX_CLAUSES = 10
+    SEARCH_TIMEOUT = '500ms'
+    SEARCH_TERMINATE_AFTER = 10000
+    # Cache for search results, see app.cache.create_cache for the options.
+    # The 'lru' cache is per process, use 'memcached' or 'redis' when running
+    # more than one process or the outbox worker so edits are seen by all.
+    SEARCH_CACHE_TYPE = 'lru'
+    SEARCH_CACHE_SIZE = 1000
+    SEARCH_CACHE_TIMEOUT = 300
+    # Cache for markdown rendered outside of the stored HTML, like previews.
+    # Entries are keyed on a hash of the text so are never out of date.
+    RENDER_CACHE_TYPE = 'lru'
+    RENDER_CACHE_SIZE = 500
+    RENDER_CACHE_TIMEOUT = 0
+    # Cache for rendered parts of pages, like the front page and Snippet
+    # panels. As with the search cache use 'memcached' or 'redis' when
+    # running more than one process so writes invalidate it for all of them.
+    FRAGMENT_CACHE_TYPE = 'lru'
+    FRAGMENT_CACHE_SIZE = 1000
+    FRAGMENT_CACHE_TIMEOUT = 60 * 60
+    # The largest preview request in bytes, bigger ones get a 413.
+    RENDER_MAX_LENGTH = 256 * 1024
 
 
 class TestConfig(BaseConfig):
@@ -37,6 +108,8 @@ class TestConfig(BaseConfig):
     """
     TESTING = True
     WTF_CSRF_ENABLED = False
+    SEARCH_CACHE_TYPE = 'null'
+    FRAGMENT_CACHE_TYPE = 'null'
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
 
 
@@ -57,3 +130,22 @@ class ProductionConfig(BaseConfig):
     DEBUG = False
     SECRET_KEY = os.environ.get('SECRET_KEY')
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    # A comma separated list of URLs of read replicas.
+    _replicas = os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    SQLALCHEMY_BINDS = dict(('replica{}'.format(i), url)
+                            for i, url in enumerate(_replicas) if url)
+    SQLALCHEMY_REPLICAS = sorted(SQLALCHEMY_BINDS)
+    ES_OUTBOX = True
+    # Edits are indexed by the outbox worker, and made by any of the web
+    # processes, so the search and fragment caches have to be shared for
+    # them to be invalidated. CACHE_SERVERS is a comma separated list of
+    # 'host:port' for CACHE_TYPE, 'memcached' or 'redis', without any they
+    # aren't used.
+    _cache_servers = filter(None,
+                            os.environ.get('CACHE_SERVERS', '').split(','))
+    _cache_type = os.environ.get('CACHE_TYPE', 'memcached') \
+        if _cache_servers else 'null'
+    SEARCH_CACHE_TYPE = _cache_type
+    SEARCH_CACHE_SERVERS = _cache_servers
+    FRAGMENT_CACHE_TYPE = _cache_type
+    FRAGMENT_CACHE_SERVERS = _cache_servers
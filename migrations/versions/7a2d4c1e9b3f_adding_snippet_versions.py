@@ -0,0 +1,32 @@
+"""Adding snippet versions
+
+Revision ID: 7a2d4c1e9b3f
+Revises: 3f1c2a9b7d4e
+Create Date: 2026-10-18 14:03:17.204951
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a2d4c1e9b3f'
+down_revision = '3f1c2a9b7d4e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('snippet', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('snippet', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    # Existing Snippets are treated as changed now so that 'es sync' picks
+    # them all up.
+    op.execute("UPDATE snippet SET updated_at = CURRENT_TIMESTAMP")
+    with op.batch_alter_table('snippet') as batch_op:
+        batch_op.alter_column('updated_at', existing_type=sa.DateTime(), nullable=False)
+    op.create_index(op.f('ix_snippet_updated_at'), 'snippet', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_snippet_updated_at'), table_name='snippet')
+    with op.batch_alter_table('snippet') as batch_op:
+        batch_op.drop_column('version')
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,27 @@
+"""Adding snippet html
+
+Revision ID: c4e81b5f2a60
+Revises: 7a2d4c1e9b3f
+Create Date: 2026-10-18 16:21:42.518302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e81b5f2a60'
+down_revision = '7a2d4c1e9b3f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Existing Snippets are rendered on every read until they are next
+    # saved, or './manage.py snippet render' is run.
+    op.add_column('snippet', sa.Column('html', sa.Text(), nullable=True))
+    op.add_column('snippet', sa.Column('html_key', sa.String(length=53), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('snippet') as batch_op:
+        batch_op.drop_column('html_key')
+        batch_op.drop_column('html')
@@ -0,0 +1,25 @@
+"""Adding snippet excerpt
+
+Revision ID: e0b7d3a19c52
+Revises: c4e81b5f2a60
+Create Date: 2026-10-18 17:05:11.840276
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e0b7d3a19c52'
+down_revision = 'c4e81b5f2a60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('snippet', sa.Column('excerpt', sa.Text(), nullable=True))
+    # Clear the keys so './manage.py snippet render' fills in the excerpts.
+    op.execute("UPDATE snippet SET html_key = NULL")
+
+
+def downgrade():
+    with op.batch_alter_table('snippet') as batch_op:
+        batch_op.drop_column('excerpt')
@@ -9,7 +9,9 @@
 """
 from __future__ import unicode_literals
 import unittest
-from app import app, db
+import mock
+from elasticsearch import Elasticsearch
+from app import app, db, search_client
 
 
 class BaseTestCase(unittest.TestCase):
@@ -22,6 +24,8 @@ class BaseTestCase(unittest.TestCase):
         self.app = app.test_client()
         self.db = db
         self.db.create_all()
+        # Failures in earlier tests mustn't send searches to the database.
+        search_client.reset()
 
     def tearDown(self):
         self.db.session.remove()
@@ -61,3 +65,17 @@ class BaseTestCase(unittest.TestCase):
            :returns: A logged out app session
         """
         return self.app.get('/logout', follow_redirects=True)
+
+    def _mock_bulk(self, **patch_kwargs):
+        """Function for patching out ElasticSearch bulk requests for the rest
+           of the test, so nothing is sent to ElasticSearch
+
+           :param **patch_kwargs: The params passed to mock.patch.object,
+                                  defaults to a response with no items
+
+           :returns: The mock that replaces Elasticsearch.bulk
+        """
+        patch_kwargs.setdefault('return_value', {'items': []})
+        patcher = mock.patch.object(Elasticsearch, 'bulk', **patch_kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
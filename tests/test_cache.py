@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    Cache
+    ~~~~~
+    All test cases relating to the cache backends
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import unittest
+import mock
+from flask import render_template
+from werkzeug.contrib.cache import NullCache
+from app.cache import LRUCache, FragmentCache, create_cache
+from app.models import Snippet
+from app.rendering import fragment_cache
+from base import BaseTestCase
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    "Tests for the LRUCache"
+
+    def test_get_and_set(self):
+        "Test that values can be stored and fetched"
+        cache = LRUCache()
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.get('missing'), None)
+
+    def test_least_recently_used_removed(self):
+        "Test that the least recently used item is removed when full"
+        cache = LRUCache(threshold=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    @mock.patch('app.cache.time')
+    def test_timeout(self, time):
+        "Test that items expire"
+        cache = LRUCache(default_timeout=10)
+        time.return_value = 100
+        cache.set('key', 'value')
+        cache.set('forever', 'value', timeout=0)
+
+        time.return_value = 111
+        self.assertEqual(cache.get('key'), None)
+        self.assertEqual(cache.get('forever'), 'value')
+
+    def test_inc(self):
+        "Test that values can be incremented"
+        cache = LRUCache()
+        self.assertEqual(cache.inc('key'), 1)
+        self.assertEqual(cache.inc('key'), 2)
+
+
+class CreateCacheTestCase(unittest.TestCase):
+    "Tests for creating caches from the config"
+
+    def test_create_lru(self):
+        "Test that the default is a LRU cache using the config"
+        cache = create_cache({'TEST_SIZE': 5}, 'TEST')
+        self.assertTrue(isinstance(cache, LRUCache))
+        self.assertEqual(cache._threshold, 5)
+
+    def test_create_null(self):
+        "Test that we can turn off caching"
+        cache = create_cache({'TEST_TYPE': 'null'}, 'TEST')
+        self.assertTrue(isinstance(cache, NullCache))
+
+    def test_create_unknown(self):
+        "Test that an unknown cache type is rejected"
+        self.assertRaises(ValueError, create_cache,
+                          {'TEST_TYPE': 'unknown'}, 'TEST')
+
+
+class FragmentCacheTestCase(unittest.TestCase):
+    "Tests for the FragmentCache"
+
+    def setUp(self):
+        self.cache = FragmentCache(LRUCache())
+        self.render = mock.Mock(return_value='<p>html</p>')
+
+    def test_cached(self):
+        "Test that a fragment is only rendered once"
+        first = self.cache.cached('group', ('panel', 1), self.render)
+        second = self.cache.cached('group', ('panel', 1), self.render)
+
+        self.assertEqual(first, '<p>html</p>')
+        self.assertEqual(second, '<p>html</p>')
+        self.assertEqual(self.render.call_count, 1)
+
+    def test_invalidate(self):
+        "Test that invalidating a group only drops its fragments"
+        self.cache.cached('group', 'a', self.render)
+        self.cache.cached('other', 'a', self.render)
+
+        self.cache.invalidate('group')
+        self.cache.cached('group', 'a', self.render)
+        self.cache.cached('other', 'a', self.render)
+
+        self.assertEqual(self.render.call_count, 3)
+
+    def test_lost_generation(self):
+        "Test that fragments aren't used if the generation is lost"
+        self.cache.cached('group', 'a', self.render)
+        self.cache.backend.delete('generation:group')
+
+        with mock.patch('app.cache.time', return_value=200):
+            self.cache.cached('group', 'a', self.render)
+
+        self.assertEqual(self.render.call_count, 2)
+
+
+class FragmentInvalidationTestCase(BaseTestCase):
+    "Tests for invalidating fragments when Snippets are written"
+
+    def setUp(self):
+        super(FragmentInvalidationTestCase, self).setUp()
+        self._mock_bulk()
+        patcher = mock.patch.object(fragment_cache, 'invalidate')
+        self.invalidate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_invalidated_on_commit(self):
+        "Test that adding, editing and removing Snippets invalidates"
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+        snippet.title = 'New Title'
+        self.db.session.commit()
+        self.db.session.delete(snippet)
+        self.db.session.commit()
+
+        self.assertEqual(self.invalidate.call_args_list,
+                         [mock.call('snippets')] * 3)
+
+    def test_not_invalidated_on_rollback(self):
+        "Test that changes that are rolled back don't invalidate"
+        self.db.session.add(Snippet('Title', 'Text'))
+        self.db.session.flush()
+        self.db.session.rollback()
+        self.db.session.commit()
+
+        self.assertFalse(self.invalidate.called)
+
+    def test_front_page_cached(self):
+        "Test that the front page is rendered once until a Snippet changes"
+        self._make_item(Snippet, title='Title', text='Text')
+
+        with mock.patch.object(fragment_cache, 'backend', LRUCache()), \
+                mock.patch('app.views.snippet.render_template',
+                           wraps=render_template) as render:
+            first = self.app.get('/')
+            second = self.app.get('/snippet/')
+
+        self.assertIn('Title', first.data)
+        self.assertEqual(first.data, second.data)
+        templates = [call[0][0] for call in render.call_args_list]
+        self.assertEqual(templates.count('snippets/newest.html'), 1)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+    Database
+    ~~~~~~~~
+    All test cases relating to the database engine options
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from app import app
+from app.models import Database, Snippet, sqlite_pragmas, compress_text, \
+    decompress_text, COMPRESSED_MARKER
+from base import BaseTestCase
+
+
+class DatabaseTestCase(unittest.TestCase):
+    "Tests for the engine options taken from the app config"
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.from_object('config.BaseConfig')
+        self.db = Database(self.app)
+
+    def _options(self, uri):
+        options = {}
+        self.db.apply_pool_defaults(self.app, options)
+        self.db.apply_driver_hacks(self.app, make_url(uri), options)
+        return options
+
+    def test_sqlite_options(self):
+        "Test that SQLite gets the PRAGMAs and none of the pool options"
+        options = self._options('sqlite:////tmp/snippets.db')
+
+        for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+            self.assertNotIn(option, options)
+        self.assertEqual(len(options['pool_events']), 1)
+        self.assertEqual(options['pool_events'][0][1], 'connect')
+
+    def test_postgresql_options(self):
+        "Test that PostgreSQL gets the pool options and statement timeout"
+        options = self._options('postgresql://localhost/snippets')
+
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+        self.assertNotIn('pool_events', options)
+
+    def test_no_statement_timeout(self):
+        "Test that the statement timeout can be turned off"
+        self.app.config['SQLALCHEMY_STATEMENT_TIMEOUT'] = None
+        options = self._options('postgresql://localhost/snippets')
+
+        self.assertNotIn('connect_args', options)
+
+    def test_pragmas_set(self):
+        "Test that the PRAGMAs are set on new SQLite connections"
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        pragmas = {'journal_mode': 'WAL', 'busy_timeout': 1234}
+        engine = create_engine(
+            'sqlite:///' + os.path.join(directory, 'test.db'),
+            pool_events=[(sqlite_pragmas(pragmas), 'connect')])
+
+        with engine.connect() as connection:
+            self.assertEqual(
+                connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(
+                connection.execute('PRAGMA busy_timeout').scalar(), 1234)
+
+
+class ReplicaTestCase(BaseTestCase):
+    "Tests for sending reads to read replicas"
+
+    def setUp(self):
+        super(ReplicaTestCase, self).setUp()
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'sqlite:///:memory:',
+            'replica2': 'sqlite:///:memory:',
+        }
+        app.config['SQLALCHEMY_REPLICAS'] = ['replica']
+        # The replica has the tables but none of the rows
+        self.replica = self.db.get_engine(app, 'replica')
+        self.db.Model.metadata.create_all(bind=self.replica)
+        self._mock_bulk()
+
+    def tearDown(self):
+        super(ReplicaTestCase, self).tearDown()
+        self.db.Model.metadata.drop_all(bind=self.replica)
+        del app.config['SQLALCHEMY_BINDS']
+
+    def test_get_reads_replica(self):
+        "Test that GET requests read from the replica"
+        id = self._make_item(Snippet, title='Title', text='Text').id
+        self.db.session.expunge_all()
+
+        rv = self.app.get('/snippet/{}'.format(id))
+
+        self.assertEqual(rv.status_code, 404)
+
+    def test_read_own_writes(self):
+        "Test that a client reads from the primary after it writes"
+        rv = self.app.post('/snippet/new',
+                           data={'title': 'Title', 'text': 'Text'})
+        self.assertEqual(rv.status_code, 302)
+
+        rv = self.app.get('/snippet/1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('Title', rv.data)
+
+        rv = app.test_client().get('/snippet/1')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_writes_use_primary(self):
+        "Test that a session that writes reads from the primary afterwards"
+        with app.test_request_context():
+            session = self.db.session()
+            session.use_replica()
+            self.assertIsNone(Snippet.query.first())
+
+            session.add(Snippet(title='Title', text='Text'))
+            session.commit()
+
+            self.assertTrue(session.wrote)
+            self.assertEqual(Snippet.query.one().title, 'Title')
+            self.assertEqual(
+                self.replica.execute('SELECT count(*) FROM snippet').scalar(),
+                0)
+
+    def test_round_robin(self):
+        "Test that the replicas are used in turn"
+        app.config['SQLALCHEMY_REPLICAS'] = ['replica', 'replica2']
+        engines = [self.db.get_replica(app) for _ in range(3)]
+
+        self.assertIsNot(engines[0], engines[1])
+        self.assertIs(engines[0], engines[2])
+
+    def test_no_replicas(self):
+        "Test that reads stay on the primary without any replicas"
+        app.config['SQLALCHEMY_REPLICAS'] = []
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+
+        rv = self.app.get('/snippet/{}'.format(snippet.id))
+
+        self.assertEqual(rv.status_code, 200)
+
+
+class CompressionTestCase(BaseTestCase):
+    "Tests for storing long text compressed"
+
+    def setUp(self):
+        super(CompressionTestCase, self).setUp()
+        self._mock_bulk()
+
+    def _stored(self, id):
+        return self.db.engine.execute(
+            'SELECT text FROM snippet WHERE id = ?', id).scalar()
+
+    def test_compress_text(self):
+        "Test that only long text is compressed and it can be read back"
+        self.assertEqual(compress_text('short', threshold=10), 'short')
+        self.assertIsNone(compress_text(None))
+
+        text = 'A line of a log file\n' * 100
+        stored = compress_text(text, threshold=10)
+        self.assertTrue(stored.startswith(COMPRESSED_MARKER))
+        self.assertLess(len(stored), len(text))
+        self.assertEqual(decompress_text(stored), text)
+
+    def test_incompressible_text(self):
+        "Test that text that doesn't get shorter is stored as it is"
+        text = base64.b64encode(os.urandom(300)).decode('ascii')
+
+        self.assertEqual(compress_text(text, threshold=10), text)
+
+    def test_marker_in_text(self):
+        "Test that short text starting with the marker is still read back"
+        text = COMPRESSED_MARKER + 'text'
+        stored = compress_text(text)
+
+        self.assertNotEqual(stored, text)
+        self.assertEqual(decompress_text(stored), text)
+
+    def test_snippet_text(self):
+        "Test that the text of Snippets is compressed in the database"
+        text = 'é A line of a log file\n' * 1000
+        id = self._make_item(Snippet, title='Title', text=text).id
+        self.db.session.expunge_all()
+
+        self.assertTrue(self._stored(id).startswith(COMPRESSED_MARKER))
+        self.assertEqual(Snippet.query.get(id).text, text)
+
+    def test_raw_text_read(self):
+        "Test that text stored before it was compressed can be read"
+        id = self._make_item(Snippet, title='Title', text='short').id
+        self.db.engine.execute('UPDATE snippet SET text = ? WHERE id = ?',
+                               'x' * 10000, id)
+        self.db.session.expunge_all()
+
+        self.assertEqual(Snippet.query.get(id).text, 'x' * 10000)
+
+    def test_snippet_html(self):
+        "Test that the rendered HTML of Snippets is compressed too"
+        text = 'A line of a log file\n\n' * 1000
+        id = self._make_item(Snippet, title='Title', text=text).id
+        self.db.session.expunge_all()
+
+        stored = self.db.engine.execute(
+            'SELECT html FROM snippet WHERE id = ?', id).scalar()
+        self.assertTrue(stored.startswith(COMPRESSED_MARKER))
+        self.assertIn('<p>A line of a log file</p>',
+                      Snippet.query.get(id).html)
+
+    def test_page_text_deferred(self):
+        "Test that the page of a Snippet doesn't load the text"
+        id = self._make_item(Snippet, title='Title', text='Text').id
+        self.db.session.expunge_all()
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, self.db.engine,
+                        'before_cursor_execute', record)
+
+        rv = self.app.get('/snippet/{}'.format(id))
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('<p>Text</p>', rv.data)
+        self.assertFalse(any('snippet.text' in statement
+                             for statement in statements))
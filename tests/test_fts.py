@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+    FTS
+    ~~~
+    All test cases relating to the SQLite FTS5 search backend
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import unittest
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from app import app
+from app.fts import FTSClient, match_expression, query_text
+from app.make_searchable import do_bulk, delete_action, es_search, \
+    index_definition, swap_alias, iter_index_versions, multi_search
+from app.models import Snippet
+from base import BaseTestCase
+
+
+class FTSHelpersTestCase(unittest.TestCase):
+    "Tests for the FTS helper functions"
+
+    def test_query_text(self):
+        "Test that the text is found in the supported queries"
+        self.assertEqual(query_text({'query_string': {'query': 'a b'}}), 'a b')
+        self.assertEqual(query_text({'match': {'title': 'a'}}), 'a')
+        self.assertEqual(query_text({'match_all': {}}), None)
+        self.assertRaises(ValueError, query_text, {'regexp': {}})
+
+    def test_match_expression(self):
+        "Test that user input can't use the FTS5 query syntax"
+        self.assertEqual(match_expression('foo NEAR(bar) "baz'),
+                         '"foo" OR "NEAR" OR "bar" OR "baz"')
+        self.assertEqual(match_expression('pre*'), '"pre" *')
+        self.assertEqual(match_expression('!!'), None)
+
+    def test_match_operators(self):
+        "Test that the simple_query_string operators become FTS5 syntax"
+        self.assertEqual(match_expression('python -django'),
+                         '("python") NOT ("django")')
+        self.assertEqual(match_expression('+flask +django other'),
+                         '"flask" AND "django"')
+        self.assertEqual(match_expression('"foo bar" baz*'),
+                         '"foo bar" OR "baz" *')
+
+
+class FTSClientTestCase(BaseTestCase):
+    "Tests for the FTSClient"
+
+    def setUp(self):
+        super(FTSClientTestCase, self).setUp()
+        self.context = app.app_context()
+        self.context.push()
+        self.client = FTSClient(self.db)
+
+    def tearDown(self):
+        self.client.indices.delete(Snippet.__es_index__)
+        self.context.pop()
+        super(FTSClientTestCase, self).tearDown()
+
+    def _index(self, *documents):
+        "Index (id, title, text) tuples"
+        actions = [{'_index': Snippet.__es_index__,
+                    '_type': Snippet.__es_doc_type__,
+                    '_id': doc_id,
+                    '_source': {'id': doc_id, 'title': title, 'text': text}}
+                   for doc_id, title, text in documents]
+        return do_bulk(self.client, actions)
+
+    def _search(self, query, **kwargs):
+        body = {'query': {'query_string': {'query': query}}}
+        return es_search(Snippet, self.client, body=body, hydrate=False,
+                         **kwargs)
+
+    def test_search_ranked(self):
+        "Test that results are found and ranked with bm25"
+        self._index((1, 'Python', 'a snake'),
+                    (2, 'Snakes', 'python python python'),
+                    (3, 'Other', 'nothing to see'))
+
+        results = self._search('python')
+
+        self.assertEqual([hit.id for hit in results], [2, 1])
+        self.assertEqual(results.total, 2)
+        self.assertEqual(results[0].title, 'Snakes')
+
+    def test_search_operators(self):
+        "Test that must, must not and phrase clauses are applied"
+        self._index((1, 'Flask', 'web python'),
+                    (2, 'Django', 'web python'),
+                    (3, 'Both', 'flask and django'),
+                    (4, 'Python', 'python web'))
+
+        self.assertEqual(sorted(hit.id for hit in self._search(
+            'python -django')), [1, 4])
+        self.assertEqual([hit.id for hit in self._search(
+            '+flask +django')], [3])
+        self.assertEqual([hit.id for hit in self._search('"python web"')],
+                         [4])
+
+    def test_highlight(self):
+        "Test that matched words are highlighted and the text escaped"
+        self._index((1, 'Python <3', 'some text about a python'),
+                    (2, 'Other', 'a python & <b>more</b>'))
+
+        results = self._search('python', highlight={'title': 0, 'text': 1})
+        response = self.client.search(
+            Snippet.__es_index__, Snippet.__es_doc_type__,
+            body={'_source': ['title'], 'highlight': {
+                'fields': {'text': {'no_match_size': 4}}}})
+
+        self.assertEqual(results.highlight(results[0]), {
+            'title': ['<mark>Python</mark> &lt;3'],
+            'text': ['some text about a <mark>python</mark>']})
+        self.assertEqual(results.highlight(results[1]), {
+            'text': ['a <mark>python</mark> &amp; &lt;b&gt;more&lt;/b&gt;']})
+        hit = response['hits']['hits'][0]
+        self.assertEqual(hit['_source'], {'title': 'Python <3'})
+        self.assertEqual(hit['highlight'], {'text': ['some']})
+
+    def test_reindex_and_delete(self):
+        "Test that documents can be replaced and removed"
+        self._index((1, 'Old', 'text'))
+        self._index((1, 'New', 'text'))
+        self.assertEqual([hit.title for hit in self._search('text')], ['New'])
+
+        success, errors = do_bulk(self.client, [delete_action(Snippet, 1)])
+        self.assertEqual((success, errors), (1, []))
+        self.assertEqual(len(self._search('text')), 0)
+        self.assertRaises(NotFoundError, self.client.delete,
+                          Snippet.__es_index__, Snippet.__es_doc_type__, 1)
+
+    def test_pagination(self):
+        "Test that search_after pagination works in both directions"
+        self._index(*[(i, 'Title', 'word') for i in range(1, 6)])
+
+        first = self._search('word', size=2)
+        second = self._search('word', size=2, after=first.next_cursor)
+        third = self._search('word', size=2, after=second.next_cursor)
+        back = self._search('word', size=2, before=third.prev_cursor)
+
+        self.assertEqual([hit.id for hit in first], [1, 2])
+        self.assertEqual([hit.id for hit in second], [3, 4])
+        self.assertEqual([hit.id for hit in third], [5])
+        self.assertEqual(third.next_cursor, None)
+        self.assertEqual([hit.id for hit in back], [3, 4])
+
+    def test_prefix_search(self):
+        "Test that prefix searches work"
+        self._index((1, 'Elasticsearch', 'text'))
+        self.assertEqual(len(self._search('elastic*')), 1)
+
+    def test_alias_swap(self):
+        "Test that searches follow an alias to a new index"
+        self._index((1, 'Old', 'word'))
+        index = Snippet.__es_index__ + '_2'
+        self.client.indices.create(index=index,
+                                   body=index_definition(Snippet))
+        do_bulk(self.client, [{'_index': index,
+                               '_type': Snippet.__es_doc_type__,
+                               '_id': 2,
+                               '_source': {'id': 2, 'title': 'New',
+                                           'text': 'word'}}])
+
+        self.assertEqual([hit.title for hit in self._search('word')], ['Old'])
+        self.assertEqual(swap_alias(self.client, Snippet.__es_index__, index),
+                         [])
+        self.assertEqual([hit.title for hit in self._search('word')], ['New'])
+        self.assertFalse(self.client.indices.exists(Snippet.__es_index__ +
+                                                    '_1'))
+        self.client.indices.delete(index)
+
+    def test_external_versions(self):
+        "Test that older versions of a document are rejected"
+        def index(version, title, version_type='external'):
+            return do_bulk(self.client, [{
+                '_index': Snippet.__es_index__,
+                '_type': Snippet.__es_doc_type__,
+                '_id': 1, '_version': version, '_version_type': version_type,
+                '_source': {'id': 1, 'title': title, 'text': 'word'}}])
+
+        index(2, 'New')
+        self.assertEqual(index(1, 'Old'), (1, []))
+        self.assertEqual(index(2, 'Same'), (1, []))
+        self.assertEqual([hit.title for hit in self._search('word')], ['New'])
+        self.assertEqual(list(iter_index_versions(self.client, Snippet)),
+                         [(1, 2)])
+
+        index(2, 'Repaired', 'external_gte')
+        self.assertEqual([hit.title for hit in self._search('word')],
+                         ['Repaired'])
+        self.assertRaises(ConflictError, self.client.index,
+                          Snippet.__es_index__, Snippet.__es_doc_type__,
+                          {'id': 1}, id=1, version=1,
+                          version_type='external')
+
+    def test_msearch(self):
+        "Test that several searches can be made in one call"
+        self._index((1, 'Python', 'a snake'))
+        body = {'query': {'query_string': {'query': 'python'}}}
+
+        results = multi_search(self.client, body, [Snippet], size=5)
+        response = self.client.msearch(body=[
+            {'index': 'missing', 'type': 'missing'}, body])
+
+        self.assertEqual([hit.id for hit in results[Snippet]], [1])
+        self.assertEqual(response['responses'][0]['status'], 404)
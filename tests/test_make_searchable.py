@@ -0,0 +1,802 @@
+# -*- coding: utf-8 -*-
+"""
+    Make Searchable
+    ~~~~~~~~~~~~~~~
+    All test cases relating to the make_searchable helpers
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import re
+import unittest
+from datetime import datetime
+import mock
+from elasticsearch.exceptions import ConnectionError, NotFoundError, \
+    TransportError
+from werkzeug.contrib.cache import NullCache
+from app.cache import LRUCache
+from app.make_searchable import iter_chunks, index_action, do_bulk, \
+    drain_outbox, es_search, encode_cursor, decode_cursor, SearchCache, \
+    swap_alias, CircuitBreaker, CircuitOpenError, PrefixIndex, \
+    diff_versions, iter_db_versions, iter_index_versions, multi_search
+from app.models import Snippet, IndexOutbox, COMPRESSED_MARKER
+from base import BaseTestCase
+
+
+class HelpersTestCase(BaseTestCase):
+    "Tests for the make_searchable helper functions"
+
+    def setUp(self):
+        super(HelpersTestCase, self).setUp()
+        self._mock_bulk()
+
+    def _make_snippets(self, count):
+        """Add Snippets directly to the database without indexing them.
+
+           :param count: The number of Snippets to add
+
+           :returns: A list of the ids of the new Snippets
+        """
+        table = Snippet.__table__
+        self.db.session.execute(table.insert(), [
+            {'title': 'Title {}'.format(i), 'text': 'Text {}'.format(i)}
+            for i in range(count)
+        ])
+        self.db.session.commit()
+        return [snippet.id for snippet in Snippet.query.order_by(Snippet.id)]
+
+    def test_iter_chunks(self):
+        "Test that all rows are streamed once, in order, in fixed size chunks"
+        ids = self._make_snippets(7)
+
+        chunks = list(iter_chunks(Snippet, 3))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual([item.id for chunk in chunks for item in chunk], ids)
+
+    def test_iter_chunks_empty(self):
+        "Test that an empty table produces no chunks"
+        self.assertEqual(list(iter_chunks(Snippet, 3)), [])
+
+    def test_index_action(self):
+        "Test that bulk actions contain the indexed fields"
+        self._make_snippets(1)
+        snippet = Snippet.query.first()
+
+        action = index_action(snippet)
+
+        self.assertEqual(action['_id'], snippet.id)
+        self.assertEqual(action['_index'], Snippet.__es_index__)
+        self.assertEqual(action['_source'], {'id': snippet.id,
+                                             'title': snippet.title,
+                                             'text': snippet.text})
+
+    def test_index_action_versioned(self):
+        "Test that the version is sent as an external version"
+        self._make_snippets(1)
+        snippet = Snippet.query.first()
+        snippet.title = 'New Title'
+        self.db.session.commit()
+
+        action = index_action(snippet)
+
+        self.assertEqual(snippet.version, 2)
+        self.assertEqual(action['_version'], 2)
+        self.assertEqual(action['_version_type'], 'external')
+
+    def test_do_bulk_version_conflict(self):
+        "Test that a version conflict counts as success"
+        es_client = mock.Mock()
+        es_client.bulk.return_value = {'errors': True, 'items': [
+            {'index': {'_id': 1, 'status': 409, 'error': 'conflict'}},
+        ]}
+        actions = [{'_index': 'snippets', '_type': 'snippet', '_id': 1,
+                    '_version': 1, '_version_type': 'external',
+                    '_source': {}}]
+
+        self.assertEqual(do_bulk(es_client, actions), (1, []))
+
+    def test_diff_versions(self):
+        "Test that missing, extra and out of date items are found"
+        db_versions = [(1, 1), (2, 3), (4, 1), (6, 2)]
+        index_versions = [(2, 2), (3, 1), (4, 1), (7, 1)]
+
+        self.assertEqual(list(diff_versions(db_versions, index_versions)), [
+            (1, 1, None), (2, 3, 2), (3, None, 1), (6, 2, None),
+            (7, None, 1),
+        ])
+        self.assertEqual(list(diff_versions([], [])), [])
+
+    def test_iter_versions(self):
+        "Test that id and version pairs are streamed in id order"
+        ids = self._make_snippets(3)
+        self.assertEqual(list(iter_db_versions(Snippet, 2)),
+                         [(item_id, 1) for item_id in ids])
+
+        es_client = mock.Mock()
+        es_client.search.side_effect = [
+            {'hits': {'hits': [{'_id': '1', '_version': 1, 'sort': [1]},
+                               {'_id': '3', '_version': 2, 'sort': [3]}]}},
+            {'hits': {'hits': [{'_id': '4', '_version': 1, 'sort': [4]}]}},
+        ]
+
+        self.assertEqual(list(iter_index_versions(es_client, Snippet, 2)),
+                         [(1, 1), (3, 2), (4, 1)])
+        body = es_client.search.call_args[1]['body']
+        self.assertEqual(body['search_after'], [3])
+        self.assertEqual(body['sort'], [{'id': 'asc'}])
+
+    def test_do_bulk_reports_failures(self):
+        "Test that a failed bulk request is reported rather than raised"
+        self._make_snippets(2)
+        actions = [index_action(item) for item in Snippet.query.all()]
+        es_client = mock.Mock()
+        es_client.bulk.side_effect = ConnectionError('N/A', 'down', None)
+
+        success, errors = do_bulk(es_client, actions)
+
+        self.assertEqual(es_client.bulk.call_count, 1)
+        self.assertEqual(success, 0)
+        self.assertEqual(len(errors), 2)
+
+    def test_swap_alias(self):
+        "Test that an alias is moved to a new index in one update"
+        es_client = mock.Mock()
+        es_client.indices.exists_alias.return_value = True
+        es_client.indices.get_alias.return_value = {'snippets_1': {}}
+
+        old_indexes = swap_alias(es_client, 'snippets', 'snippets_2')
+
+        self.assertEqual(old_indexes, ['snippets_1'])
+        es_client.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove': {'index': 'snippets_1', 'alias': 'snippets'}},
+                {'add': {'index': 'snippets_2', 'alias': 'snippets'}},
+            ]})
+        self.assertFalse(es_client.indices.delete.called)
+
+    def test_swap_alias_replaces_index(self):
+        "Test that an index with the name of the alias is removed first"
+        es_client = mock.Mock()
+        es_client.indices.exists_alias.return_value = False
+        es_client.indices.exists.return_value = True
+
+        old_indexes = swap_alias(es_client, 'snippets', 'snippets_2')
+
+        self.assertEqual(old_indexes, [])
+        es_client.indices.delete.assert_called_once_with(index='snippets')
+        es_client.indices.update_aliases.assert_called_once_with(body={
+            'actions': [{'add': {'index': 'snippets_2', 'alias': 'snippets'}}]
+        })
+
+
+class SearchTestCase(BaseTestCase):
+    "Tests for es_search"
+
+    def setUp(self):
+        super(SearchTestCase, self).setUp()
+        self._mock_bulk()
+        table = Snippet.__table__
+        self.db.session.execute(table.insert(), [
+            {'title': 'Title {}'.format(i), 'text': 'Text'} for i in range(5)
+        ])
+        self.db.session.commit()
+        self.es_client = mock.Mock()
+
+    def _set_hits(self, *ids):
+        "Make the fake ElasticSearch client return hits for the passed ids"
+        hits = [{'_id': unicode(i), '_source': {'id': i}, 'sort': [1.0, i]}
+                for i in ids]
+        self.es_client.search.return_value = {'hits': {'total': 5,
+                                                       'hits': hits}}
+
+    def _search(self, **kwargs):
+        return es_search(Snippet, self.es_client, body={}, **kwargs)
+
+    def test_results_in_hit_order(self):
+        "Test that results are in the ElasticSearch order"
+        self._set_hits(3, 1, 6, 2)
+
+        results = self._search(hydrate=True)
+
+        # 6 isn't in the database so is skipped
+        self.assertEqual([item.id for item in results], [3, 1, 2])
+        self.assertEqual(results.total, 5)
+
+    def test_results_from_source(self):
+        "Test that results can be built without touching the database"
+        hits = [{'_id': '9', '_source': {'id': 9, 'title': 'Title'}}]
+        self.es_client.search.return_value = {'hits': {'total': 1,
+                                                       'hits': hits}}
+
+        results = self._search(hydrate=False)
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].id, 9)
+        self.assertEqual(results[0].title, 'Title')
+        self.assertEqual(results[0].text, None)
+        self.assertRaises(AttributeError, setattr, results[0], 'title', '')
+
+    def test_first_page(self):
+        "Test that the first page only has a next cursor"
+        self._set_hits(1, 2, 3)
+
+        results = self._search(size=2)
+
+        body = self.es_client.search.call_args[1]['body']
+        self.assertEqual(body['size'], 3)
+        self.assertNotIn('search_after', body)
+        self.assertEqual([item.id for item in results], [1, 2])
+        self.assertEqual(decode_cursor(results.next_cursor), [1.0, 2])
+        self.assertEqual(results.prev_cursor, None)
+
+    def test_next_page(self):
+        "Test that a page after a cursor has both cursors"
+        self._set_hits(3, 4, 5)
+
+        results = self._search(size=2, after=encode_cursor([1.0, 2]))
+
+        body = self.es_client.search.call_args[1]['body']
+        self.assertEqual(body['search_after'], [1.0, 2])
+        self.assertEqual([item.id for item in results], [3, 4])
+        self.assertEqual(decode_cursor(results.prev_cursor), [1.0, 3])
+        self.assertEqual(decode_cursor(results.next_cursor), [1.0, 4])
+
+    def test_previous_page(self):
+        "Test that paging backwards reverses the sort and the hits"
+        self._set_hits(2, 1)
+
+        results = self._search(size=2, before=encode_cursor([1.0, 3]))
+
+        body = self.es_client.search.call_args[1]['body']
+        self.assertEqual(body['sort'], [{'_score': 'asc'}, {'id': 'desc'}])
+        self.assertEqual([item.id for item in results], [1, 2])
+        self.assertEqual(results.prev_cursor, None)
+        self.assertEqual(decode_cursor(results.next_cursor), [1.0, 2])
+
+    def test_highlight(self):
+        "Test that highlighting is asked for and fragments are returned"
+        hits = [{'_id': '9', '_source': {'id': 9, 'title': 'Title'},
+                 'highlight': {'text': ['a <mark>word</mark>']}},
+                {'_id': '10', '_source': {'id': 10, 'title': 'Other'}}]
+        self.es_client.search.return_value = {'hits': {'total': 2,
+                                                       'hits': hits}}
+
+        results = self._search(hydrate=False, size=2,
+                               highlight={'title': 0, 'text': 2})
+
+        body = self.es_client.search.call_args[1]['body']
+        self.assertEqual(body['highlight']['encoder'], 'html')
+        self.assertEqual(body['highlight']['fields'], {
+            'title': {'number_of_fragments': 0},
+            'text': {'number_of_fragments': 2, 'fragment_size': 150,
+                     'no_match_size': 150}})
+        self.assertEqual(results.highlight(results[0]),
+                         {'text': ['a <mark>word</mark>']})
+        self.assertEqual(results.highlight(results[1]), {})
+
+    def test_invalid_cursor(self):
+        "Test that a invalid cursor raises a ValueError"
+        self.assertRaises(ValueError, self._search, size=2, after='nope')
+
+    def test_fallback_search(self):
+        "Test that the database is searched when ElasticSearch is down"
+        self.es_client.search.side_effect = ConnectionError('N/A', 'down',
+                                                            None)
+        self.db.session.add(Snippet(title='Other', text='Nothing'))
+        self.db.session.commit()
+        body = {'query': {'query_string': {'query': 'title 100%'}}}
+
+        first = es_search(Snippet, self.es_client, body=body, size=3)
+        second = es_search(Snippet, self.es_client, body=body, size=3,
+                           after=first.next_cursor)
+
+        self.assertTrue(first.degraded)
+        self.assertEqual(first.total, None)
+        self.assertEqual([item.id for item in first], [1, 2, 3])
+        self.assertEqual([item.id for item in second], [4, 5])
+        self.assertEqual(second.next_cursor, None)
+        self.assertEqual(decode_cursor(second.prev_cursor), [0, 4])
+
+    def test_fallback_on_server_error(self):
+        "Test that the database is searched when ElasticSearch has an error"
+        self.es_client.search.side_effect = TransportError(503, 'red', None)
+        body = {'query': {'query_string': {'query': 'title'}}}
+
+        self.assertTrue(es_search(Snippet, self.es_client, body=body).degraded)
+
+        self.es_client.search.side_effect = TransportError(400, 'bad', None)
+        self.assertRaises(TransportError, es_search, Snippet, self.es_client,
+                          body=body)
+
+    def test_fallback_operators(self):
+        "Test that the database search applies the '+' and '-' operators"
+        self.es_client.search.side_effect = ConnectionError('N/A', 'down',
+                                                            None)
+        self.db.session.add(Snippet(title='Flask', text='python'))
+        self.db.session.add(Snippet(title='Django', text='python'))
+        self.db.session.commit()
+
+        def search(query):
+            body = {'query': {'simple_query_string': {'query': query}}}
+            return [item.title for item in
+                    es_search(Snippet, self.es_client, body=body)]
+
+        self.assertEqual(search('python -django'), ['Flask'])
+        self.assertEqual(search('+python +django'), ['Django'])
+
+    def test_fallback_compressed(self):
+        "Test that the database search finds Snippets with compressed text"
+        self.es_client.search.side_effect = ConnectionError('N/A', 'down',
+                                                            None)
+        text = 'Needle\n\n' + 'A line of a log file\n' * 1000 + 'Buried'
+        id = self._make_item(Snippet, title='Long', text=text).id
+        stored = self.db.engine.execute(
+            'SELECT text FROM snippet WHERE id = ?', id).scalar()
+
+        def search(query):
+            body = {'query': {'simple_query_string': {'query': query}}}
+            return [item.title for item in
+                    es_search(Snippet, self.es_client, body=body)]
+
+        self.assertTrue(stored.startswith(COMPRESSED_MARKER))
+        self.assertEqual(search('needle'), ['Long'])
+        self.assertEqual(search('log'), ['Long'])
+        self.assertEqual(search('log -needle'), [])
+        # Words past the excerpt can't be found, but the compressed data
+        # is never matched either.
+        self.assertEqual(search('buried'), [])
+        self.assertEqual(search(re.findall('[A-Za-z0-9]{8,}', stored)[0]),
+                         [])
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    "Tests for the CircuitBreaker"
+
+    def setUp(self):
+        self.es_client = mock.Mock()
+        self.breaker = CircuitBreaker(self.es_client, threshold=2,
+                                      reset_timeout=30,
+                                      timeouts={'search': 2})
+
+    def _fail(self, error):
+        self.es_client.search.side_effect = error
+        self.assertRaises(type(error), self.breaker.search, index='i')
+
+    def test_timeouts(self):
+        "Test that calls are given a request_timeout by name"
+        self.breaker.search(index='i')
+        self.breaker.bulk([])
+
+        self.es_client.search.assert_called_once_with(index='i',
+                                                      request_timeout=2)
+        self.es_client.bulk.assert_called_once_with([])
+
+    @mock.patch('time.time')
+    def test_opens_and_resets(self, time):
+        "Test that the circuit opens after failures and is tested later"
+        time.return_value = 1000
+        self._fail(ConnectionError('N/A', 'down', None))
+        self.assertFalse(self.breaker.is_open)
+        self._fail(ConnectionError('N/A', 'down', None))
+        self.assertTrue(self.breaker.is_open)
+
+        self.assertRaises(CircuitOpenError, self.breaker.search, index='i')
+        self.assertEqual(self.es_client.search.call_count, 2)
+
+        time.return_value = 1030
+        self.es_client.search.side_effect = None
+        self.breaker.search(index='i')
+        self.assertFalse(self.breaker.is_open)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_reset(self):
+        "Test that a reset closes the circuit and forgets the failures"
+        self._fail(ConnectionError('N/A', 'down', None))
+        self._fail(ConnectionError('N/A', 'down', None))
+        self.breaker.reset()
+
+        self.assertFalse(self.breaker.is_open)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_client_errors_not_counted(self):
+        "Test that a 4xx response doesn't count as a failure"
+        for i in range(3):
+            self._fail(NotFoundError(404, 'missing'))
+        self.assertFalse(self.breaker.is_open)
+
+
+class MultiSearchTestCase(BaseTestCase):
+    "Tests for searching several models at once"
+
+    class Other(object):
+        "A searchable model that is never loaded from the database"
+        __es_index__ = 'others'
+        __es_doc_type__ = 'other'
+        __es_fields__ = ['name']
+        __es_hydrate__ = False
+
+    def setUp(self):
+        super(MultiSearchTestCase, self).setUp()
+        self.db.session.execute(Snippet.__table__.insert(), [
+            {'title': 'Title {}'.format(i), 'text': 'Text'} for i in range(3)
+        ])
+        self.db.session.commit()
+        self.es_client = mock.Mock()
+
+    def _hits(self, *ids):
+        return {'hits': {'total': len(ids), 'hits': [
+            {'_id': unicode(i), '_source': {'id': i, 'name': 'Name'},
+             'sort': [1.0, i]} for i in ids]}}
+
+    def test_one_request(self):
+        "Test that all the models are searched in one msearch request"
+        self.es_client.msearch.return_value = {'responses': [
+            self._hits(3, 1, 2), self._hits(7)]}
+        body = {'query': {'match_all': {}}}
+
+        results = multi_search(self.es_client, body,
+                               [Snippet, self.Other], size=2, hydrate=None)
+
+        self.assertEqual(self.es_client.msearch.call_count, 1)
+        request = self.es_client.msearch.call_args[1]['body']
+        self.assertEqual(request[0], {'index': 'snippets', 'type': 'snippet'})
+        self.assertEqual(request[2], {'index': 'others', 'type': 'other'})
+        self.assertEqual(request[1]['size'], 3)
+        self.assertEqual(results.keys(), [Snippet, self.Other])
+        self.assertEqual([item.id for item in results[Snippet]], [3, 1])
+        self.assertNotEqual(results[Snippet].next_cursor, None)
+        self.assertEqual([item.name for item in results[self.Other]],
+                         ['Name'])
+
+    def test_failed_model(self):
+        "Test that a model that fails to search has no results"
+        self.es_client.msearch.return_value = {'responses': [
+            self._hits(1), {'error': 'IndexMissingException[others]'}]}
+
+        results = multi_search(self.es_client, {}, [Snippet, self.Other])
+
+        self.assertEqual(len(results[Snippet]), 1)
+        self.assertEqual(len(results[self.Other]), 0)
+
+    def test_server_error(self):
+        "Test that the database is searched when ElasticSearch has an error"
+        self.es_client.msearch.side_effect = TransportError(503, 'red', None)
+
+        results = multi_search(self.es_client, {}, [Snippet])
+
+        self.assertTrue(results[Snippet].degraded)
+
+
+class SearchCacheTestCase(BaseTestCase):
+    "Tests for caching searches"
+
+    def setUp(self):
+        super(SearchCacheTestCase, self).setUp()
+        self.es_client = mock.Mock()
+        self.es_client.search.return_value = {'hits': {'total': 0,
+                                                       'hits': []}}
+        self.cache = SearchCache(LRUCache())
+        patcher = mock.patch.object(Snippet, 'es_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _search(self, query):
+        body = {'query': {'query_string': {'query': query}}}
+        return es_search(Snippet, self.es_client, body=body)
+
+    def test_repeated_search_cached(self):
+        "Test that the same search is only sent to ElasticSearch once"
+        self._search('test')
+        self._search('test')
+        self._search('other')
+
+        self.assertEqual(self.es_client.search.call_count, 2)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_invalidate(self):
+        "Test that invalidating the index stops the cache being used"
+        self._search('test')
+        self.cache.invalidate(Snippet.__es_index__)
+        self._search('test')
+
+        self.assertEqual(self.es_client.search.call_count, 2)
+
+    def test_invalidated_during_search(self):
+        "Test that a search running when the index changes isn't cached"
+        def search(**kwargs):
+            self.cache.invalidate(Snippet.__es_index__)
+            return {'hits': {'total': 0, 'hits': []}}
+        self.es_client.search.side_effect = search
+        self._search('test')
+        self.es_client.search.side_effect = None
+        self._search('test')
+
+        self.assertEqual(self.es_client.search.call_count, 2)
+
+    @mock.patch('app.cache.time')
+    def test_lost_generation(self, time):
+        "Test that losing the generation doesn't bring back old responses"
+        time.return_value = 100
+        self._search('test')
+        self.cache.backend.delete('generation:snippets')
+        time.return_value = 101
+        self._search('test')
+
+        self.assertEqual(self.es_client.search.call_count, 2)
+
+
+class SessionHooksTestCase(BaseTestCase):
+    "Tests for sending changes to ElasticSearch when the session commits"
+
+    def setUp(self):
+        super(SessionHooksTestCase, self).setUp()
+        self.context = self.app.application.app_context()
+        self.context.push()
+        self.bulk = self._mock_bulk(side_effect=self._bulk_response)
+
+    def tearDown(self):
+        super(SessionHooksTestCase, self).tearDown()
+        self.context.pop()
+
+    def _bulk_response(self, body, **kwargs):
+        "Fake bulk response where every action succeeds"
+        items = [{op: dict(meta, status=200)}
+                 for action in body if len(action) == 1
+                 for op, meta in action.items()
+                 if op in ('index', 'delete')]
+        return {'items': items}
+
+    def _actions(self):
+        """Get the action lines sent in all bulk requests
+
+           :returns: A list of (op_type, id) tuples for each bulk request
+        """
+        return [[(op, meta['_id'])
+                 for action in call[0][0] if len(action) == 1
+                 for op, meta in action.items()]
+                for call in self.bulk.call_args_list]
+
+    def test_one_bulk_request_per_commit(self):
+        "Test that all the changes in a commit are sent in one request"
+        for i in range(5):
+            self.db.session.add(Snippet('Title', 'Text'))
+        self.db.session.commit()
+
+        self.assertEqual(self._actions(),
+                         [[('index', i) for i in range(1, 6)]])
+
+    def test_nothing_sent_before_commit(self):
+        "Test that flushing doesn't send anything to ElasticSearch"
+        self.db.session.add(Snippet('Title', 'Text'))
+        self.db.session.flush()
+
+        self.assertFalse(self.bulk.called)
+
+    def test_rollback_discards_changes(self):
+        "Test that rolled back changes are never sent to ElasticSearch"
+        self.db.session.add(Snippet('Title', 'Text'))
+        self.db.session.flush()
+        self.db.session.rollback()
+        self.db.session.commit()
+
+        self.assertFalse(self.bulk.called)
+
+    def test_last_change_wins(self):
+        "Test that only the last operation for each item is sent"
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+        self.bulk.reset_mock()
+
+        snippet.title = 'Updated'
+        self.db.session.flush()
+        self.db.session.delete(snippet)
+        self.db.session.commit()
+
+        self.assertEqual(self._actions(), [[('delete', 1)]])
+
+    def test_unchanged_updates_skipped(self):
+        "Test that updates that don't change an indexed field aren't sent"
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+        self.bulk.reset_mock()
+
+        snippet.title = 'Title'
+        self.db.session.commit()
+        snippet.updated_at = datetime(2015, 1, 1)
+        self.db.session.commit()
+        self.assertFalse(self.bulk.called)
+        self.assertEqual(snippet.version, 1)
+
+        snippet.text = 'Updated'
+        self.db.session.commit()
+        self.assertEqual(self._actions(), [[('index', 1)]])
+        self.assertEqual(snippet.version, 2)
+
+    def test_commit_invalidates_cache(self):
+        "Test that committing a change invalidates the search cache"
+        cache = SearchCache(LRUCache())
+        with mock.patch.object(Snippet, 'es_cache', cache):
+            generation = cache.generation(Snippet.__es_index__)
+            self._make_item(Snippet, title='Title', text='Text')
+
+            self.assertNotEqual(cache.generation(Snippet.__es_index__),
+                                generation)
+            self.assertEqual(self.bulk.call_args[1]['refresh'],
+                             'wait_for')
+
+    def test_null_cache_not_waited_for(self):
+        "Test that a commit doesn't wait for a refresh for a NullCache"
+        cache = SearchCache(NullCache())
+        with mock.patch.object(Snippet, 'es_cache', cache):
+            self._make_item(Snippet, title='Title', text='Text')
+
+            self.assertNotIn('refresh', self.bulk.call_args[1])
+
+    def test_no_cache_not_waited_for(self):
+        "Test that a commit doesn't wait for a refresh without a cache"
+        with mock.patch.object(Snippet, 'es_cache', None):
+            self._make_item(Snippet, title='Title', text='Text')
+
+            self.assertNotIn('refresh', self.bulk.call_args[1])
+
+
+class PrefixIndexTestCase(BaseTestCase):
+    "Tests for typeahead suggestions"
+
+    def setUp(self):
+        super(PrefixIndexTestCase, self).setUp()
+        self.context = self.app.application.app_context()
+        self.context.push()
+        self._mock_bulk()
+        table = Snippet.__table__
+        self.db.session.execute(table.insert(), [
+            {'title': title, 'text': 'Text'}
+            for title in ['Python  Lists', 'python dicts', 'Perl', 'Go']
+        ])
+        self.db.session.commit()
+        self.index = PrefixIndex(Snippet, 'title')
+
+    def tearDown(self):
+        super(PrefixIndexTestCase, self).tearDown()
+        self.context.pop()
+
+    def test_suggest(self):
+        "Test that prefixes match ignoring case and whitespace"
+        self.assertEqual(self.index.suggest('PYTHON '),
+                         [(2, 'python dicts'), (1, 'Python  Lists')])
+        self.assertEqual(self.index.suggest('python l'),
+                         [(1, 'Python  Lists')])
+        self.assertEqual(self.index.suggest('p', limit=1),
+                         [(3, 'Perl')])
+        self.assertEqual(self.index.suggest(' '), [])
+
+    def test_update_and_remove(self):
+        "Test that changed and removed values are found"
+        self.index.load()
+        self.index.update(4, 'Pascal')
+        self.index.remove(3)
+        self.assertEqual(self.index.suggest('p'),
+                         [(4, 'Pascal'), (2, 'python dicts'),
+                          (1, 'Python  Lists')])
+        self.assertEqual(self.index.suggest('go'), [])
+
+    @mock.patch('time.time')
+    def test_reload(self, time):
+        "Test that the index is reloaded once it is too old"
+        time.return_value = 1000
+        self.index.suggest('go')
+        self.db.session.execute(Snippet.__table__.insert(),
+                                [{'title': 'Gopher', 'text': 'Text'}])
+        self.db.session.commit()
+
+        self.assertEqual(len(self.index.suggest('go')), 1)
+        time.return_value = 1000 + self.index.max_age
+        self.assertEqual(len(self.index.suggest('go')), 2)
+
+    @mock.patch('time.time')
+    def test_one_reload(self, time):
+        "Test that callers don't wait while the index is being reloaded"
+        time.return_value = 1000
+        self.index.suggest('go')
+        time.return_value = 1000 + self.index.max_age
+
+        with mock.patch.object(self.index, 'load') as load:
+            self.index._load_lock.acquire()
+            try:
+                self.assertEqual(self.index.suggest('go'), [(4, 'Go')])
+            finally:
+                self.index._load_lock.release()
+            self.assertFalse(load.called)
+
+            self.index.suggest('go')
+            self.assertEqual(load.call_count, 1)
+
+    def test_session_hooks(self):
+        "Test that committed changes update the models index"
+        Snippet.es_suggest.load()
+        snippet = Snippet.query.get(3)
+        snippet.title = 'Ruby'
+        self.db.session.commit()
+        self.db.session.add(Snippet('Rust', 'Text'))
+        self.db.session.rollback()
+
+        self.assertEqual(Snippet.es_suggest.suggest('r'), [(3, 'Ruby')])
+        self.db.session.delete(Snippet.query.get(3))
+        self.db.session.commit()
+        self.assertEqual(Snippet.es_suggest.suggest('r'), [])
+
+
+class OutboxTestCase(BaseTestCase):
+    "Tests for sending changes from the outbox"
+
+    def setUp(self):
+        super(OutboxTestCase, self).setUp()
+        self.es_client = mock.Mock()
+        self.es_client.bulk.side_effect = self._bulk_response
+
+    def _bulk_response(self, body, **kwargs):
+        "Fake bulk response where every action succeeds"
+        items = [{op: dict(meta, status=200)}
+                 for action in body if len(action) == 1
+                 for op, meta in action.items()
+                 if op in ('index', 'delete')]
+        return {'items': items}
+
+    def _add_entries(self, *item_ids):
+        "Add entries to the outbox for Snippets with the passed ids"
+        for item_id in item_ids:
+            self.db.session.add(IndexOutbox(index=Snippet.__es_index__,
+                                            doc_type=Snippet.__es_doc_type__,
+                                            item_id=item_id))
+        self.db.session.commit()
+
+    def test_drain_outbox(self):
+        "Test that current rows are indexed and missing rows are deleted"
+        self.db.session.execute(Snippet.__table__.insert(),
+                                {'title': 'Title', 'text': 'Text'})
+        self._add_entries(1, 1, 2)
+
+        sent, failed = drain_outbox(self.es_client, IndexOutbox)
+
+        self.assertEqual((sent, failed), (2, 0))
+        body = self.es_client.bulk.call_args[0][0]
+        self.assertEqual(body[0], {'index': {'_index': 'snippets',
+                                             '_type': 'snippet', '_id': 1,
+                                             '_version': 1,
+                                             '_version_type': 'external'}})
+        self.assertEqual(body[2], {'delete': {'_index': 'snippets',
+                                              '_type': 'snippet', '_id': 2}})
+        self.assertEqual(IndexOutbox.query.count(), 0)
+
+    def test_drain_outbox_failure(self):
+        "Test that failed entries are kept and retried later"
+        self._add_entries(1)
+        self.es_client.bulk.side_effect = ConnectionError('N/A', 'down', None)
+
+        sent, failed = drain_outbox(self.es_client, IndexOutbox)
+
+        self.assertEqual((sent, failed), (0, 1))
+        entry = IndexOutbox.query.one()
+        self.assertEqual(entry.attempts, 1)
+
+        # The entry isn't due yet so nothing is sent
+        self.assertEqual(drain_outbox(self.es_client, IndexOutbox), (0, 0))
+        self.assertEqual(self.es_client.bulk.call_count, 1)
+
+    def test_drain_outbox_item_failure(self):
+        """Test that failed items are kept when ElasticSearch reports the
+           index behind the alias
+        """
+        self.db.session.execute(Snippet.__table__.insert(),
+                                {'title': 'Title', 'text': 'Text'})
+        self._add_entries(1)
+        self.es_client.bulk.side_effect = None
+        self.es_client.bulk.return_value = {'errors': True, 'items': [
+            {'index': {'_index': 'snippets_20260101000000',
+                       '_type': 'snippet', '_id': '1', 'status': 429,
+                       'error': 'rejected'}}]}
+
+        sent, failed = drain_outbox(self.es_client, IndexOutbox)
+
+        self.assertEqual((sent, failed), (0, 1))
+        self.assertEqual(IndexOutbox.query.one().attempts, 1)
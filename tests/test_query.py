@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    Query
+    ~~~~~
+    All test cases relating to planning search queries
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import unittest
+from app.query import plan_query, rewrite_query, parse_query, \
+    split_clauses
+
+
+class RewriteQueryTestCase(unittest.TestCase):
+    "Tests for rewrite_query"
+
+    def test_operators(self):
+        "Test that the simple_query_string operators are kept"
+        self.assertEqual(rewrite_query('a -b +c | "d e"'), 'a -b +c "d e"')
+        self.assertEqual(rewrite_query('a AND b NOT c OR d'), 'a +b -c d')
+
+    def test_expensive_syntax_removed(self):
+        "Test that regex, fuzzy, field and wildcard searches are removed"
+        self.assertEqual(rewrite_query('/ab.*c/ foo~2 title:bar'),
+                         'ab.c foo bar')
+        self.assertEqual(rewrite_query('*foo b?r (baz)'), 'foo br baz')
+
+    def test_prefix_limits(self):
+        "Test that only a few long prefix searches are kept"
+        self.assertEqual(rewrite_query('py* elas* pyth* java*'),
+                         'py elas* pyth* java')
+
+    def test_max_clauses(self):
+        "Test that only the first clauses are used"
+        self.assertEqual(rewrite_query('a b c d', max_clauses=2), 'a b')
+
+    def test_only_negative(self):
+        "Test that a query can't only exclude documents"
+        self.assertEqual(rewrite_query('-a -b'), 'a b')
+
+    def test_nothing_left(self):
+        "Test that None is returned when there is nothing to search for"
+        self.assertEqual(rewrite_query('!! * ""'), None)
+
+
+class ParseQueryTestCase(unittest.TestCase):
+    "Tests for parse_query and split_clauses"
+
+    def test_parse_query(self):
+        "Test that the operators, phrases and prefixes are found"
+        self.assertEqual(parse_query('a -b +"c d" pre* e.f'),
+                         [('', ['a'], False), ('-', ['b'], False),
+                          ('+', ['c', 'd'], False), ('', ['pre'], True),
+                          ('', ['e'], False), ('', ['f'], False)])
+        self.assertEqual(parse_query('!! ""'), [])
+
+    def test_split_clauses(self):
+        "Test that should clauses are ignored when there are must clauses"
+        must, should, must_not = split_clauses(parse_query('a +b -c'))
+
+        self.assertEqual(must, [('+', ['b'], False)])
+        self.assertEqual(should, [('', ['a'], False)])
+        self.assertEqual(must_not, [('-', ['c'], False)])
+
+    def test_only_negative(self):
+        "Test that must not clauses are used when they are all there is"
+        self.assertEqual(split_clauses(parse_query('-a')),
+                         ([], [('-', ['a'], False)], []))
+
+
+class PlanQueryTestCase(unittest.TestCase):
+    "Tests for plan_query"
+
+    def test_plan_query(self):
+        "Test that the search body has the query and the limits"
+        body = plan_query('foo*', ['title'], timeout='1s',
+                          terminate_after=100)
+
+        query = body['query']['simple_query_string']
+        self.assertEqual(query['query'], 'foo*')
+        self.assertEqual(query['fields'], ['title'])
+        self.assertEqual(body['timeout'], '1s')
+        self.assertEqual(body['terminate_after'], 100)
+        self.assertEqual(plan_query('!!', ['title']), None)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    Rendering
+    ~~~~~~~~~
+    All test cases relating to rendering and storing Snippet markdown
+
+    :copyright: (c) 2015 by Thomas O'Donnell.
+    :license: MIT, see LICENSE for more details.
+"""
+from __future__ import unicode_literals
+import misaka
+import mock
+from flask.ext.misaka import make_flags
+from app.models import Snippet
+from app.rendering import RENDERER_KEY, MARKDOWN_OPTIONS, CodeRenderer, \
+    render_key, rendered, excerpt, truncate_text, highlight_code, \
+    code_cache
+from base import BaseTestCase
+
+
+class RenderingTestCase(BaseTestCase):
+    "Tests for storing the rendered HTML of Snippets"
+
+    def setUp(self):
+        super(RenderingTestCase, self).setUp()
+        self.context = self.app.application.app_context()
+        self.context.push()
+        self._mock_bulk()
+
+    def tearDown(self):
+        super(RenderingTestCase, self).tearDown()
+        self.context.pop()
+
+    def test_render_key(self):
+        "Test that the key depends on the renderer and the text"
+        self.assertTrue(render_key('a').startswith(RENDERER_KEY + ':'))
+        self.assertNotEqual(render_key('a'), render_key('b'))
+        self.assertEqual(render_key(None), render_key(''))
+
+    def test_truncate_text(self):
+        "Test that text is cut at a whole word"
+        self.assertEqual(truncate_text('short', 10), 'short')
+        self.assertEqual(truncate_text('some longer text', 12), 'some...')
+        self.assertEqual(truncate_text(None), '')
+
+    def test_rendered_on_write(self):
+        "Test that the HTML is stored on insert and replaced on edit"
+        snippet = self._make_item(Snippet, title='Title', text='*old*')
+        self.assertEqual(snippet.html, '<p><em>old</em></p>\n')
+        self.assertEqual(snippet.html_key, render_key('*old*'))
+
+        snippet.text = '**new**'
+        self.db.session.commit()
+
+        self.assertEqual(snippet.html, '<p><strong>new</strong></p>\n')
+        self.assertEqual(snippet.html_key, render_key('**new**'))
+
+    def test_excerpt_on_write(self):
+        "Test that a rendered excerpt of the start of the text is stored"
+        snippet = self._make_item(Snippet, title='Title',
+                                  text='*word* ' * 100)
+
+        self.assertTrue(snippet.excerpt.startswith('<p><em>word</em> '))
+        self.assertTrue(snippet.excerpt.endswith('...</p>\n'))
+        self.assertEqual(excerpt(snippet), snippet.excerpt)
+
+    def test_listing_defers_text(self):
+        "Test that listing pages don't load the text or the HTML"
+        self._make_item(Snippet, title='Title', text='*Text*')
+        self.db.session.expunge_all()
+
+        snippet = Snippet.listing().one()
+
+        self.assertEqual(excerpt(snippet), '<p><em>Text</em></p>\n')
+        self.assertNotIn('text', snippet.__dict__)
+        self.assertNotIn('html', snippet.__dict__)
+
+    @mock.patch('app.rendering.render_markdown')
+    def test_other_changes_not_rendered(self, render_markdown):
+        "Test that changing only the title doesn't render the text again"
+        render_markdown.return_value = '<p>Text</p>'
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+        calls = render_markdown.call_count
+
+        snippet.title = 'New Title'
+        self.db.session.commit()
+
+        self.assertEqual(render_markdown.call_count, calls)
+
+    def test_stored_html_used(self):
+        "Test that the stored HTML is used while it is current"
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+        snippet.html = '<p>Stored</p>'
+
+        with mock.patch('app.rendering.render_markdown') as render_markdown:
+            self.assertEqual(rendered(snippet), '<p>Stored</p>')
+            self.assertFalse(render_markdown.called)
+
+        snippet.html_key = 'oldrenderer:' + snippet.html_key.split(':')[1]
+        self.assertEqual(rendered(snippet), '<p>Text</p>\n')
+
+    def test_preview_rendered(self):
+        "Test that dicts like the ones used for previews are rendered"
+        self.assertEqual(rendered({'title': 'Title', 'text': '*a*'}),
+                         '<p><em>a</em></p>\n')
+
+
+class HighlightTestCase(BaseTestCase):
+    "Tests for highlighting code blocks on the server"
+
+    def _render(self, text):
+        extensions, render_flags = make_flags(**MARKDOWN_OPTIONS)
+        renderer = misaka.Markdown(CodeRenderer(flags=render_flags),
+                                   extensions=extensions)
+        return renderer.render(text)
+
+    def test_plain_code_matches_misaka(self):
+        "Test that code that isn't highlighted is escaped like Misaka does"
+        block = '<pre><code class="nosuchlanguage">if a &lt; b:\n</code></pre>'
+        extensions, render_flags = make_flags(**MARKDOWN_OPTIONS)
+
+        self.assertIn(block, misaka.html('```nosuchlanguage\nif a < b:\n```',
+                                         extensions=extensions,
+                                         render_flags=render_flags))
+        self.assertIn(block, self._render('```nosuchlanguage\nif a < b:\n```'))
+
+    def test_code_cached(self):
+        "Test that each block is highlighted once for each language"
+        code_cache.clear()
+        html = highlight_code('x = 1\n', 'python')
+
+        self.assertEqual(len(code_cache), 1)
+        self.assertEqual(highlight_code('x = 1\n', 'python'), html)
+        highlight_code('x = 1\n', 'ruby')
+        self.assertEqual(len(code_cache), 2)
+
+    def test_highlighted(self):
+        "Test that code in a known language is highlighted"
+        html = self._render('```python\nimport this\n```\n')
+        self.assertIn('<div class="highlight">', html)
+
+    def test_stylesheet(self):
+        "Test that the highlighting stylesheet can be fetched"
+        rv = self.app.get('/highlight.css')
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'text/css')
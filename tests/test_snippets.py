@@ -9,9 +9,13 @@
 """
 from __future__ import unicode_literals
 import json
+import logging
 import os
+from io import BytesIO
 import unittest
+import mock
 import vcr
+from flask import render_template
 from app import Snippet
 from base import BaseTestCase
 
@@ -66,6 +70,37 @@ class NoSnippetsTestCase(BaseTestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertIn('No results for query', rv.data)
 
+    def test_search_nothing_to_search(self):
+        """Test that a query with nothing to search for isn't sent to
+           ElasticSearch.
+        """
+        rv = self.app.get('/snippet/?q=*!?')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('No results for query', rv.data)
+
+    def test_search_invalid_cursor(self):
+        """Test that we get a 400 when the page cursor isn't valid."""
+        rv = self.app.get('/snippet/?q=test&after=nope')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_typeahead(self):
+        """Test that titles starting with the query are suggested."""
+        self.db.session.execute(Snippet.__table__.insert(), [
+            {'title': 'Title', 'text': 'Text'},
+            {'title': 'Other', 'text': 'Text'},
+        ])
+        self.db.session.commit()
+        Snippet.es_suggest.load()
+
+        rv = self.app.get('/snippet/typeahead?q=tit')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data)['results'], [
+            {'id': 1, 'title': 'Title', 'url': '/snippet/1'}
+        ])
+
+        rv = self.app.get('/snippet/typeahead?q=tit&limit=-1')
+        self.assertEqual(len(json.loads(rv.data)['results']), 1)
+
     def test_search_no_query(self):
         """Test that we get the correct answer when there is no query."""
         rv = self.app.get('/snippet/')
@@ -84,6 +119,67 @@ class NoSnippetsTestCase(BaseTestCase):
         self.assertIn(data['title'], rv_json['html'])
         self.assertIn(data['text'], rv_json['html'])
 
+    def test_preview_render_conditional(self):
+        """Test that an unchanged preview gets a 304 and a changed one is
+           rendered again
+        """
+        data = json.dumps({'title': 'Title', 'text': 'Text'})
+        headers = [('Content-Type', 'application/json')]
+
+        first = self.app.post('/snippet/render', data=data, headers=headers)
+        etag = first.headers['ETag']
+        repeat = self.app.post('/snippet/render', data=data,
+                               headers=headers + [('If-None-Match', etag)])
+        changed = self.app.post('/snippet/render',
+                                data=json.dumps({'title': 'Title',
+                                                 'text': 'New'}),
+                                headers=headers + [('If-None-Match', etag)])
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(repeat.status_code, 304)
+        self.assertEqual(repeat.headers['ETag'], etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertIn('New', json.loads(changed.data)['html'])
+
+    def test_preview_render_cached(self):
+        """Test that repeated previews are served from the cache"""
+        data = json.dumps({'title': 'Title', 'text': 'Cached Text'})
+        headers = [('Content-Type', 'application/json')]
+
+        with mock.patch('app.views.snippet.render_template',
+                        wraps=render_template) as render:
+            first = self.app.post('/snippet/render', data=data,
+                                  headers=headers)
+            second = self.app.post('/snippet/render', data=data,
+                                   headers=headers)
+
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(first.data, second.data)
+
+    def test_preview_render_too_large(self):
+        """Test that we get 413s when the preview is too large"""
+        data = json.dumps({'title': 'Title',
+                           'text': 'x' * (256 * 1024)})
+
+        rv = self.app.post('/snippet/render', data=data,
+                           headers=[('Content-Type', 'application/json')])
+        self.assertEqual(rv.status_code, 413)
+
+    def test_preview_render_chunked_too_large(self):
+        """Test that we get 413s for large previews without a length"""
+        data = json.dumps({'title': 'Title',
+                           'text': 'x' * (256 * 1024)})
+
+        # A chunked request, the server reads the body to the end
+        environ = {'CONTENT_LENGTH': '',
+                   'HTTP_TRANSFER_ENCODING': 'chunked',
+                   'wsgi.input_terminated': True}
+        rv = self.app.post('/snippet/render',
+                           input_stream=BytesIO(data),
+                           content_type='application/json',
+                           environ_overrides=environ)
+        self.assertEqual(rv.status_code, 413)
+
     def test_preview_render_not_valid(self):
         """Test that we get 400s on when not JSON"""
         data = {'title': 'Test Title',
@@ -101,6 +197,22 @@ class NoSnippetsTestCase(BaseTestCase):
 class SnippetTestCase(BaseTestCase):
     """Test Case for all tests when Snippets have been added"""
 
+    def setUp(self):
+        super(SnippetTestCase, self).setUp()
+        # Requests that don't match the cassettes are logged rather than
+        # raised, so watch the log to fail on them.
+        log = logging.getLogger('app.make_searchable')
+        self.logged = []
+        for level in ('warning', 'error'):
+            patcher = mock.patch.object(log, level)
+            self.logged.append(patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(SnippetTestCase, self).tearDown()
+        for logged in self.logged:
+            self.assertFalse(logged.called, logged.call_args)
+
     @my_vcr.use_cassette()
     def test_create_snippet(self):
         """Test the creation of a snippet"""
@@ -119,7 +231,8 @@ class SnippetTestCase(BaseTestCase):
         snippet = self._make_item(Snippet, title='Title', text='Text')
 
         data = {'title': 'Test Title Update',
-                'text': 'Test Text Update'}
+                'text': 'Test Text Update',
+                'version': snippet.version}
         rv = self.app.post('/snippet/{}/edit'.format(snippet.id), data=data)
 
         snippet = Snippet.query.get(snippet.id)
@@ -158,3 +271,169 @@ class SnippetTestCase(BaseTestCase):
 
         self.assertEqual(rv.status_code, 200)
         self.assertIn('No results for query', rv.data)
+
+
+class EditConflictTestCase(BaseTestCase):
+    """Test Case for Snippets edited by two users at once"""
+
+    def setUp(self):
+        super(EditConflictTestCase, self).setUp()
+        self._mock_bulk()
+        self.snippet = self._make_item(Snippet, title='Title', text='Text')
+        self.id = self.snippet.id
+
+    def _edit(self, version):
+        data = {'title': 'Mine', 'text': 'Mine', 'version': version}
+        return self.app.post('/snippet/{}/edit'.format(self.id), data=data)
+
+    def test_version_in_form(self):
+        """Test that the edit form carries the version of the Snippet"""
+        rv = self.app.get('/snippet/{}/edit'.format(self.id))
+
+        self.assertIn('name="version" type="hidden" value="1"', rv.data)
+
+    def test_saved_by_someone_else(self):
+        """Test that an edit of an older version isn't saved"""
+        self.snippet.text = 'Theirs'
+        self.db.session.commit()
+        self.db.session.expunge_all()
+
+        rv = self._edit(1)
+
+        self.assertEqual(rv.status_code, 302)
+        self.assertTrue(rv.location.endswith(
+            '/snippet/{}/edit'.format(self.id)))
+        self.db.session.expunge_all()
+        self.assertEqual(Snippet.query.get(self.id).text, 'Theirs')
+
+    def test_current_version_saved(self):
+        """Test that an edit of the current version is saved"""
+        rv = self._edit(1)
+
+        self.assertEqual(rv.status_code, 302)
+        self.db.session.expunge_all()
+        self.assertEqual(Snippet.query.get(self.id).text, 'Mine')
+
+
+class ConditionalTestCase(BaseTestCase):
+    """Test Case for conditional GETs of Snippet and listing pages"""
+
+    def setUp(self):
+        super(ConditionalTestCase, self).setUp()
+        self._mock_bulk()
+
+    def _get(self, url, etag=None, since=None):
+        headers = []
+        if etag:
+            headers.append(('If-None-Match', etag))
+        if since:
+            headers.append(('If-Modified-Since', since))
+        return self.app.get(url, headers=headers)
+
+    def test_snippet_not_modified(self):
+        """Test that a Snippet page the client has gets a 304 until the
+           Snippet is edited
+        """
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+        url = '/snippet/{}'.format(snippet.id)
+
+        first = self._get(url)
+        etag = first.headers['ETag']
+        repeat = self._get(url, etag=etag)
+        since = self._get(url, since=first.headers['Last-Modified'])
+        snippet.text = 'New Text'
+        self.db.session.commit()
+        changed = self._get(url, etag=etag)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('no-cache', first.headers['Cache-Control'])
+        self.assertEqual(repeat.status_code, 304)
+        self.assertEqual(repeat.data, '')
+        self.assertEqual(since.status_code, 304)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+
+    def test_missing_snippet(self):
+        """Test that a missing Snippet is still a 404"""
+        self.assertEqual(self._get('/snippet/1', etag='"x"').status_code, 404)
+
+    def test_listing_not_modified(self):
+        """Test that the listing pages get a 304 until a Snippet is added,
+           edited or removed
+        """
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+        etag = self._get('/').headers['ETag']
+
+        self.assertEqual(self._get('/', etag=etag).status_code, 304)
+        self.assertEqual(self._get('/snippet/', etag=etag).status_code, 304)
+
+        snippet.title = 'New Title'
+        self.db.session.commit()
+        self.assertEqual(self._get('/', etag=etag).status_code, 200)
+
+        etag = self._get('/').headers['ETag']
+        self.db.session.delete(snippet)
+        self.db.session.commit()
+        self.assertEqual(self._get('/', etag=etag).status_code, 200)
+
+    def test_flashed_messages_not_cached(self):
+        """Test that a page with flashed messages is always rendered"""
+        snippet = self._make_item(Snippet, title='Title', text='Text')
+        url = '/snippet/{}'.format(snippet.id)
+        etag = self._get(url).headers['ETag']
+
+        with self.app.session_transaction() as session:
+            session['_flashes'] = [('alert-success', 'Saved')]
+        rv = self._get(url, etag=etag)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('Saved', rv.data)
+        self.assertIn('private', rv.headers['Cache-Control'])
+
+
+class NewestPagesTestCase(BaseTestCase):
+    """Test Case for paging through the newest Snippets"""
+
+    def setUp(self):
+        super(NewestPagesTestCase, self).setUp()
+        self.db.session.execute(Snippet.__table__.insert(), [
+            {'title': 'Title {}'.format(i), 'text': 'Text'}
+            for i in range(1, 6)
+        ])
+        self.db.session.commit()
+        self.page_size = self.app.application.config['LISTING_PAGE_SIZE']
+        self.app.application.config['LISTING_PAGE_SIZE'] = 2
+
+    def tearDown(self):
+        self.app.application.config['LISTING_PAGE_SIZE'] = self.page_size
+        super(NewestPagesTestCase, self).tearDown()
+
+    def test_pages(self):
+        """Test that each page continues from the last id of the one before
+        """
+        first = self.app.get('/')
+        second = self.app.get('/?before=4')
+        last = self.app.get('/snippet/?before=2')
+
+        self.assertIn('Title 5', first.data)
+        self.assertIn('Title 4', first.data)
+        self.assertNotIn('Title 3', first.data)
+        self.assertIn('/?before=4', first.data)
+        self.assertIn('Title 3', second.data)
+        self.assertIn('Title 2', second.data)
+        self.assertIn('/?before=2', second.data)
+        self.assertIn('Title 1', last.data)
+        self.assertNotIn('Older &rarr;', last.data)
+
+    def test_past_the_end(self):
+        """Test that there is a message after the oldest Snippet"""
+        rv = self.app.get('/?before=1')
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('There are no older snippets', rv.data)
+
+    def test_no_offset(self):
+        """Test that older pages don't use OFFSET"""
+        self.assertNotIn('OFFSET', str(Snippet.newest(3, 100)))
+        self.assertEqual([snippet.id for snippet in Snippet.newest(3, 4)],
+                         [3, 2, 1])